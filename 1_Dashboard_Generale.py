@@ -1,9 +1,7 @@
 # 1_Dashboard_Generale.py
 import streamlit as st
-import streamlit_authenticator as stauth
 import pandas as pd
 import utils
-import plotly.express as px
 import plotly.graph_objects as go
 from datetime import datetime, timedelta
 import time 
@@ -11,6 +9,178 @@ import time
 # Configurazione della pagina all'inizio
 st.set_page_config(page_title="Dashboard Portafoglio", layout="wide")
 
+# --- SEZIONI DELLA DASHBOARD (FRAMMENTI CON RIESECUZIONE INDIPENDENTE) ---
+def attendi_rivalidazione(username, nome):
+    """Controlla ogni pochi secondi la rilettura in background del foglio; quando termina riesegue la pagina con i dati nuovi."""
+    if utils.rivalidazione_in_corso(username, nome):
+        st.caption("🔄 Aggiornamento dal foglio in corso: stai vedendo l'ultimo snapshot salvato.")
+    else:
+        st.rerun()
+
+INTERVALLI_AGGIORNAMENTO_KPI = {"Disattivato": None, "Ogni minuto": 60, "Ogni 5 minuti": 300, "Ogni 15 minuti": 900}
+
+def mostra_kpi(df_filtrato, simboli_live=None):
+    """KPI principali; con i prezzi live riapplica le quotazioni correnti a ogni riesecuzione del frammento."""
+    if simboli_live:
+        quotazioni = utils.scarica_quotazioni_live(simboli_live)
+        df_filtrato = utils.applica_quotazioni_live(df_filtrato, quotazioni)
+        if not quotazioni.empty:
+            st.caption(f"KPI calcolati con i prezzi delle {quotazioni['Aggiornato Alle'].iloc[0].strftime('%H:%M:%S')}")
+
+    total_cost = df_filtrato['Cost Base'].sum()
+    total_current_value = df_filtrato['Valore Titoli Real'].sum()
+    total_gain = total_current_value - total_cost
+    total_gain_perc = (total_gain / total_cost) * 100 if total_cost > 0 else 0
+
+    # Con le vendite il costo totale è quello delle quote ancora detenute e il P/L realizzato è mostrato a parte
+    realizzato = df_filtrato['P/L Realizzato'].sum() if 'P/L Realizzato' in df_filtrato.columns else 0.0
+    colonne = st.columns(4 if realizzato else 3)
+    colonne[0].metric("Valore Attuale", f"€ {total_current_value:,.2f}")
+    colonne[1].metric("Costo Totale", f"€ {total_cost:,.2f}")
+    colonne[2].metric("Guadagno/Perdita", f"€ {total_gain:,.2f}", f"{total_gain_perc:.2f}%")
+    if realizzato:
+        colonne[3].metric("P/L Realizzato", f"€ {realizzato:,.2f}", help="Ricavi delle vendite meno il costo delle quote vendute (metodo da 'appconfig').")
+
+@utils.frammento
+def mostra_rendimenti(df_filtrato):
+    """Rendimento money-weighted (XIRR) e time-weighted (TWR), per portafoglio e per ticker."""
+    valori_finali = df_filtrato.groupby('Ticker')['Valore Titoli Real'].sum()
+    xirr = utils.calcola_xirr(df_filtrato[['Ticker', 'Data Acquisto', 'Importo Operazione']], valori_finali)
+    twr = utils.calcola_twr(df_filtrato[utils.COLONNE_VALUTAZIONE], st.session_state.get('current_user'))
+
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Rendimento Annuo (XIRR)", f"{xirr.get('Portafoglio', float('nan')):.2%}",
+                help="Money-weighted: tiene conto di quando e quanto hai investito (acquisti e vendite alla loro data, valore finale = valore attuale).")
+    if 'Portafoglio' in twr.index:
+        col2.metric("Rendimento Time-Weighted", f"{twr.loc['Portafoglio', 'TWR']:.2%}",
+                    help="Neutrale rispetto ai versamenti: misura solo l'andamento dei titoli posseduti (prezzi storici Yahoo Finance in EUR).")
+        col3.metric("TWR Annualizzato", f"{twr.loc['Portafoglio', 'TWR Annualizzato']:.2%}")
+
+    with st.expander("Rendimenti per ticker"):
+        tabella = pd.concat([xirr, twr[['TWR', 'TWR Annualizzato']]], axis=1).drop(index='Portafoglio', errors='ignore')
+        st.dataframe((tabella.sort_values('XIRR', ascending=False) * 100).round(2), use_container_width=True,
+                     column_config={c: st.column_config.NumberColumn(c, format="%.2f%%") for c in tabella.columns})
+
+@utils.frammento
+def mostra_allocazione(df_filtrato, df_filtrato_tipo):
+    """Treemap, torta e barre dell'allocazione per ticker, oggi o a una data passata (fotografia as-of)."""
+    import plotly.express as px  # import differito: la schermata di login non lo paga
+    st.header("Visualizzazioni di Allocazione")
+    oggi = datetime.now().date()
+    prima_data = df_filtrato_tipo['Data Acquisto'].min().date()
+    data_fotografia = oggi
+    if prima_data < oggi:
+        data_fotografia = st.slider("Allocazione alla data", min_value=prima_data, max_value=oggi, value=oggi, format="DD/MM/YYYY",
+                                    help="Nelle date passate: quote possedute e chiusure di quel giorno (Yahoo Finance, in EUR).")
+    if data_fotografia >= oggi:
+        alloc_df = df_filtrato.groupby('Ticker')['Valore Titoli Real'].sum().reset_index()
+    else:
+        # L'indice è in cache: spostare il cursore costa solo una ricerca binaria per ticker
+        indice = utils.indice_storico_portafoglio(df_filtrato_tipo[utils.COLONNE_FOTOGRAFIA], st.session_state.get('current_user'))
+        fotografia = utils.fotografia_portafoglio(indice, data_fotografia)
+        if indice['ticker_mancanti']:
+            st.caption(f"Senza prezzi storici (esclusi dal valore): {', '.join(indice['ticker_mancanti'])}")
+        if fotografia['Valore'].sum() <= 0:
+            st.info("Nessuna posizione valorizzabile alla data selezionata."); return
+        alloc_df = fotografia['Valore'].rename('Valore Titoli Real').reset_index()
+        alloc_df = alloc_df[alloc_df['Valore Titoli Real'] > 0]
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Valore alla data", f"€ {fotografia['Valore'].sum():,.2f}")
+        c2.metric("Costo alla data", f"€ {fotografia['Cost Base'].sum():,.2f}")
+        c3.metric("Posizioni aperte", len(fotografia))
+        with st.expander(f"Posizioni al {data_fotografia.strftime('%d/%m/%Y')}"):
+            st.dataframe(fotografia.sort_values('Valore', ascending=False), use_container_width=True, column_config={
+                'Quote': st.column_config.NumberColumn(format="%.4f"),
+                'Cost Base': st.column_config.NumberColumn(format="€ %.2f"),
+                'PMC': st.column_config.NumberColumn(format="€ %.4f"),
+                'Prezzo': st.column_config.NumberColumn(format="€ %.4f"),
+                'Valore': st.column_config.NumberColumn(format="€ %.2f"),
+                'Peso': st.column_config.ProgressColumn(format="%.2f", min_value=0, max_value=1),
+            })
+    tab1, tab2, tab3 = st.tabs(["Treemap", "Grafico a Torta", "Grafico a Barre"])
+    with tab1:
+        fig_treemap = px.treemap(alloc_df, path=['Ticker'], values='Valore Titoli Real', title='Allocazione Portafoglio per Ticker', color_discrete_sequence=px.colors.qualitative.Pastel)
+        fig_treemap.update_traces(textinfo='label+percent root')
+        st.plotly_chart(fig_treemap, use_container_width=True)
+    with tab2:
+        fig_pie = px.pie(alloc_df, values='Valore Titoli Real', names='Ticker', title='Allocazione per Ticker')
+        st.plotly_chart(fig_pie, use_container_width=True)
+    with tab3:
+        alloc_df_sorted = alloc_df.sort_values('Valore Titoli Real', ascending=True)
+        fig_bar = px.bar(alloc_df_sorted, x='Valore Titoli Real', y='Ticker', orientation='h', title='Valore per Ticker')
+        st.plotly_chart(fig_bar, use_container_width=True)
+
+@utils.frammento
+def mostra_andamento_cumulativo(df_filtrato_tipo, start_date, end_date):
+    """Costo cumulativo vs. valore reale storico del portafoglio filtrato."""
+    st.header("Andamento Cumulativo del Portafoglio Filtrato")
+    if df_filtrato_tipo.empty: return
+
+    # 1. Calcola il costo cumulativo
+    df_costo = df_filtrato_tipo.sort_values('Data Acquisto')
+    df_costo['Costo Cumulativo'] = df_costo['Cost Base'].cumsum()
+
+    # 2. Calcola il valore storico REALE
+    with st.spinner("Calcolo del valore storico del portafoglio..."):
+        # Solo le colonne che servono alla valutazione: i prezzi live non invalidano la cache dello storico.
+        # La serie calcolata è salvata come snapshot: alla riapertura si disegna subito e si ricalcola in background.
+        df_valutazione = df_filtrato_tipo[utils.COLONNE_VALUTAZIONE]
+        username = st.session_state.get('current_user')
+        andamento, _, _ = utils.carica_con_snapshot(username, f"andamento_{utils.impronta_dati(df_valutazione)}",
+                                                    lambda: utils.calcola_valore_e_dividendi(df_valutazione, username))
+        historical_value = andamento['Valore']
+
+    ticker_mancanti = andamento.attrs.get('ticker_mancanti', [])
+    if ticker_mancanti:
+        st.warning(f"Prezzi non disponibili su Yahoo Finance per: {', '.join(ticker_mancanti)}. Il valore storico li esclude.")
+
+    if historical_value.empty:
+        st.warning("Impossibile calcolare il valore storico del portafoglio. Potrebbe esserci un problema con i dati dei ticker da Yahoo Finance.")
+        return
+
+    fig_cumulative = go.Figure()
+
+    # Aggiungi la traccia del COSTO (linea a gradini/tratteggiata)
+    fig_cumulative.add_trace(go.Scatter(
+        x=df_costo['Data Acquisto'], 
+        y=df_costo['Costo Cumulativo'],
+        mode='lines', 
+        name='Costo Totale Cumulativo',
+        line=dict(color='red', dash='dot', shape='hv'), # 'hv' per gradini
+        fill=None
+    ))
+    
+    # Aggiungi la traccia del VALORE REALE (linea continua e area)
+    fig_cumulative.add_trace(go.Scatter(
+        x=historical_value.index, 
+        y=historical_value.values,
+        mode='lines', 
+        name='Valore Reale del Portafoglio',
+        line=dict(color='green', shape='spline'),
+        fill='tozeroy', 
+        fillcolor='rgba(0,255,0,0.1)'
+    ))
+
+    # Valore più dividendi incassati (rendimento totale), solo se ci sono stati stacchi
+    if andamento['Dividendi Cumulati'].iloc[-1] > 0:
+        fig_cumulative.add_trace(go.Scatter(
+            x=andamento.index,
+            y=andamento['Valore'] + andamento['Dividendi Cumulati'],
+            mode='lines',
+            name='Valore + Dividendi Incassati',
+            line=dict(color='darkgreen', dash='dash')
+        ))
+
+    fig_cumulative.update_layout(
+        title="Andamento del Costo vs. Valore Reale Storico",
+        yaxis_title="Valore (€)",
+        legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01)
+    )
+    # Applica lo zoom temporale selezionato dall'utente
+    fig_cumulative.update_xaxes(range=[start_date, end_date])
+    
+    st.plotly_chart(fig_cumulative, use_container_width=True)
+
 # --- FUNZIONE PRINCIPALE PER INCAPSULARE L'INTERA LOGICA DELL'APP ---
 def main():
     """Funzione principale che gestisce l'autenticazione e la visualizzazione della dashboard."""
@@ -18,6 +188,7 @@ def main():
     # --- SEZIONE 1: CONFIGURAZIONE AUTENTICAZIONE DA st.secrets ---
     # Questo blocco viene eseguito solo una volta all'avvio grazie a st.session_state
     if 'authenticator' not in st.session_state:
+        import streamlit_authenticator as stauth  # import differito: serve una sola volta per sessione
         try:
             # Legge la configurazione degli utenti da st.secrets
             users_config = st.secrets["database"]["users"]
@@ -61,24 +232,48 @@ def main():
         st.sidebar.title(f"Benvenuto {name}")
 
         if st.sidebar.button("🔄 Aggiorna Dati", use_container_width=True):
-            st.cache_data.clear()
+            # Invalida solo i dati di questo utente: gli altri utenti e i prezzi condivisi restano in cache
+            utils.invalida_cache_utente(username)
+            utils.elimina_snapshot(username)
+            st.session_state.pop('df', None)
+            st.session_state.pop('snapshot_caricati', None)
             st.success("Cache dei dati svuotata. I dati verranno ricaricati.")
             # st.rerun() è implicito dopo un'azione su un bottone, ma a volte
             # è bene essere espliciti se si vuole forzare il ricaricamento immediato.
             time.sleep(1) # Dà tempo all'utente di leggere il messaggio
             st.rerun()
 
-        # Caricamento dati specifico per l'utente loggato
-        if 'df' not in st.session_state or st.session_state.get('current_user') != username:
-            st.session_state.current_user = username
-            with st.spinner(f"Caricamento dati per {name}..."):
-                st.session_state.df = utils.load_and_clean_data(username=username)
+        # Caricamento dati: subito dall'ultimo snapshot, il foglio viene riletto in background quando è vecchio
+        st.session_state.current_user = username
+        with st.spinner(f"Caricamento dati per {name}..."):
+            df_foglio, salvato_il, in_aggiornamento = utils.carica_con_snapshot(username, 'Holding', lambda: utils.carica_holding_foglio(username))
+            # Le colonne che dipendono da 'appconfig' si ricalcolano a ogni esecuzione: lo snapshot contiene solo il foglio
+            config_utente, _ = utils.carica_configurazione_da_foglio(username)
+            st.session_state.df = utils.completa_holding(df_foglio, config_utente)
+        st.sidebar.caption(f"🕒 Dati del foglio di {utils.formatta_eta(time.time() - salvato_il)} fa")
+        if in_aggiornamento:
+            utils.frammento(run_every=2)(attendi_rivalidazione)(username, 'Holding')
 
         df_original = st.session_state.df
         if df_original.empty:
             st.error("Impossibile caricare i dati. Controlla la configurazione del tuo foglio Google.")
             st.stop()
 
+        # --- VALUTAZIONE LIVE: aggiorna solo i prezzi correnti, le transazioni restano in cache ---
+        st.sidebar.header("Valutazione")
+        simboli_live = tuple(sorted(df_original['yf_ticker'].unique()))
+        modalita_live = st.sidebar.toggle("⚡ Prezzi live", value=False, help="Ricalcola valore e guadagno di oggi con le quotazioni correnti di Yahoo Finance (cache di 60 s), senza rileggere il foglio.")
+        if modalita_live:
+            if st.sidebar.button("Aggiorna prezzi", use_container_width=True):
+                utils.scarica_quotazioni_live.clear()
+            quotazioni = utils.scarica_quotazioni_live(simboli_live)
+            if quotazioni.empty:
+                st.sidebar.warning("Quotazioni live non disponibili: uso i valori del foglio.")
+            else:
+                df_original = utils.applica_quotazioni_live(df_original, quotazioni)
+                st.sidebar.caption(f"Prezzi aggiornati alle {quotazioni['Aggiornato Alle'].iloc[0].strftime('%H:%M:%S')}")
+            intervallo_scelto = st.sidebar.selectbox("Aggiornamento automatico KPI", list(INTERVALLI_AGGIORNAMENTO_KPI.keys()))
+
         # --- CODICE DELLA DASHBOARD ---
         st.title("Dashboard Generale del Portafoglio")
 
@@ -100,79 +295,19 @@ def main():
         else:
             st.info(f"Visualizzazione per: {', '.join(tipi_selezionati)} | Periodo: {start_date.strftime('%d/%m/%Y')} - {end_date.strftime('%d/%m/%Y')}")
 
-            total_cost = df_filtrato['Cost Base'].sum()
-            total_current_value = df_filtrato['Valore Titoli Real'].sum()
-            total_gain = total_current_value - total_cost
-            total_gain_perc = (total_gain / total_cost) * 100 if total_cost > 0 else 0
-
-            col1, col2, col3 = st.columns(3)
-            col1.metric("Valore Attuale", f"€ {total_current_value:,.2f}")
-            col2.metric("Costo Totale", f"€ {total_cost:,.2f}")
-            col3.metric("Guadagno/Perdita", f"€ {total_gain:,.2f}", f"{total_gain_perc:.2f}%")
-
-            st.header("Visualizzazioni di Allocazione")
-            alloc_df = df_filtrato.groupby('Ticker')['Valore Titoli Real'].sum().reset_index()
-            tab1, tab2, tab3 = st.tabs(["Treemap", "Grafico a Torta", "Grafico a Barre"])
-            with tab1:
-                fig_treemap = px.treemap(alloc_df, path=['Ticker'], values='Valore Titoli Real', title='Allocazione Portafoglio per Ticker', color_discrete_sequence=px.colors.qualitative.Pastel)
-                fig_treemap.update_traces(textinfo='label+percent root')
-                st.plotly_chart(fig_treemap, use_container_width=True)
-            with tab2:
-                fig_pie = px.pie(alloc_df, values='Valore Titoli Real', names='Ticker', title='Allocazione per Ticker')
-                st.plotly_chart(fig_pie, use_container_width=True)
-            with tab3:
-                alloc_df_sorted = alloc_df.sort_values('Valore Titoli Real', ascending=True)
-                fig_bar = px.bar(alloc_df_sorted, x='Valore Titoli Real', y='Ticker', orientation='h', title='Valore per Ticker')
-                st.plotly_chart(fig_bar, use_container_width=True)
-            
-            st.header("Andamento Cumulativo del Portafoglio Filtrato")
-            # --- NUOVA LOGICA DI CALCOLO PER IL GRAFICO ---
-            if not df_filtrato_tipo.empty:
-                
-                # 1. Calcola il costo cumulativo (questa logica è corretta e rimane)
-                df_costo = df_filtrato_tipo.sort_values('Data Acquisto')
-                df_costo['Costo Cumulativo'] = df_costo['Cost Base'].cumsum()
-
-                # 2. Calcola il valore storico REALE usando la nuova funzione
-                with st.spinner("Calcolo del valore storico del portafoglio..."):
-                    historical_value = utils.calculate_historical_portfolio_value(df_filtrato_tipo)
-
-                if not historical_value.empty:
-                    fig_cumulative = go.Figure()
-
-                    # Aggiungi la traccia del COSTO (linea a gradini/tratteggiata)
-                    fig_cumulative.add_trace(go.Scatter(
-                        x=df_costo['Data Acquisto'], 
-                        y=df_costo['Costo Cumulativo'],
-                        mode='lines', 
-                        name='Costo Totale Cumulativo',
-                        line=dict(color='red', dash='dot', shape='hv'), # 'hv' per gradini
-                        fill=None
-                    ))
-                    
-                    # Aggiungi la traccia del VALORE REALE (linea continua e area)
-                    fig_cumulative.add_trace(go.Scatter(
-                        x=historical_value.index, 
-                        y=historical_value.values,
-                        mode='lines', 
-                        name='Valore Reale del Portafoglio',
-                        line=dict(color='green', shape='spline'),
-                        fill='tozeroy', 
-                        fillcolor='rgba(0,255,0,0.1)'
-                    ))
-
-                    fig_cumulative.update_layout(
-                        title="Andamento del Costo vs. Valore Reale Storico",
-                        yaxis_title="Valore (€)",
-                        legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01)
-                    )
-                    # Applica lo zoom temporale selezionato dall'utente
-                    fig_cumulative.update_xaxes(range=[start_date, end_date])
-                    
-                    st.plotly_chart(fig_cumulative, use_container_width=True)
-                else:
-                    st.warning("Impossibile calcolare il valore storico del portafoglio. Potrebbe esserci un problema con i dati dei ticker da Yahoo Finance.")
-                        
+            # Ogni sezione è un frammento: si riesegue da sola senza ricostruire le altre figure
+            intervallo_kpi = INTERVALLI_AGGIORNAMENTO_KPI[intervallo_scelto] if modalita_live else None
+            utils.frammento(run_every=intervallo_kpi)(mostra_kpi)(df_filtrato, simboli_live if modalita_live else None)
+            mostra_rendimenti(df_filtrato)
+            mostra_allocazione(df_filtrato, df_filtrato_tipo)
+            mostra_andamento_cumulativo(df_filtrato_tipo, start_date, end_date)
+
+        with st.sidebar.expander("📊 Statistiche cache e quota"):
+            st.dataframe(utils.metriche_cache().round(2), use_container_width=True)
+            scheduler = utils.metriche_scheduler_sheets()
+            st.caption(f"Google Sheets: {scheduler['chiamate']} chiamate, {scheduler['in_coda']} in coda, "
+                       f"attesa media {scheduler['attesa_media_s']:.2f} s (max {scheduler['attesa_max_s']:.2f} s), "
+                       f"{scheduler['ritentativi']} ritentativi")
 
     # --- SEZIONE 3: GESTIONE STATI DI LOGIN NON RIUSCITI ---
     elif authentication_status == False:
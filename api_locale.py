@@ -0,0 +1,224 @@
+# api_locale.py
+"""
+API JSON locale, in sola lettura, con le metriche della Dashboard Generale (per fogli di calcolo, display, script).
+
+Riusa i loader e le analisi di utils con le stesse cache e gli stessi snapshot su disco dell'app Streamlit:
+il foglio 'Holding' si rilegge solo quando lo snapshot è più vecchio di utils.ETA_MASSIMA_SNAPSHOT_S, in background.
+
+Endpoint (GET, risposta JSON):
+    /api/kpi           valore attuale, costo totale, guadagno/perdita (€ e %), P/L realizzato dalle vendite
+    /api/allocazione   valore e peso per ticker
+    /api/storico       valore storico giornaliero e dividendi cumulati (prezzi Yahoo Finance in EUR)
+    /api/drawdown      massimo drawdown storico e drawdown corrente
+    /salute            stato del servizio (senza autenticazione)
+Parametro opzionale per tutti gli endpoint /api: ?tipi=ETF,Azione filtra per 'Tipo Transazione' come la dashboard.
+
+Autenticazione: header "Authorization: Bearer <token>". Il token identifica l'utente tramite 'api_token_sha256'
+della sua voce in st.secrets.database.users (impronta SHA-256 del token: nei secrets non c'è il token in chiaro).
+
+Cache: l'ETag di ogni risposta è l'impronta dei dati dell'utente (più il giorno per storico e drawdown, che dipendono
+dai prezzi). Con If-None-Match uguale la risposta è 304 senza ricalcoli né letture del foglio; le risposte già
+calcolate restano in memoria per i client che non inviano l'ETag.
+
+Uso:
+    python api_locale.py                      # http://127.0.0.1:8765
+    python api_locale.py --porta 9000
+    python api_locale.py --genera-token       # nuovo token e riga da aggiungere ai secrets dell'utente
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import math
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import streamlit as st
+import utils
+
+CARTELLA_REPO = os.path.dirname(os.path.abspath(__file__))
+MAX_RISPOSTE_IN_CACHE = 256
+RISORSE_CON_PREZZI = ('storico', 'drawdown')  # cambiano ogni giorno anche a transazioni invariate
+
+# Stato condiviso tra i thread del server: dati correnti per (utente, snapshot), portafogli completati, risposte serializzate
+_MEMORIA_SNAPSHOT = {}
+_PORTAFOGLI = {}
+_RISPOSTE = OrderedDict()
+_LOCK_RISPOSTE = threading.Lock()
+
+# --- AUTENTICAZIONE ---
+def impronta_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def utente_da_token(intestazione: str):
+    """Username associato al token Bearer, oppure None."""
+    if not intestazione or not intestazione.startswith('Bearer '): return None
+    impronta = impronta_token(intestazione[len('Bearer '):].strip())
+    utente_trovato = None
+    for username, voce in st.secrets.database.users.items():
+        atteso = voce.get('api_token_sha256', '')
+        # Confronto a tempo costante su tutti gli utenti: il tempo di risposta non rivela quale voce corrisponde
+        if atteso and hmac.compare_digest(impronta, atteso): utente_trovato = username
+    return utente_trovato
+
+# --- DATI DELL'UTENTE ---
+def portafoglio_utente(username: str):
+    """
+    (Holding, impronta) dallo snapshot condiviso con l'app; il foglio si legge solo senza snapshot o se è vecchio.
+    Le colonne che dipendono da 'appconfig' si aggiungono dopo lo snapshot, con la configurazione corrente.
+    """
+    df_foglio, salvato_il, _ = utils.carica_con_snapshot(username, 'Holding', lambda: utils.carica_holding_foglio(username),
+                                                         memoria=_MEMORIA_SNAPSHOT)
+    config, _ = utils.carica_configurazione_da_foglio(username)
+    chiave = (username, salvato_il, json.dumps(config, sort_keys=True, default=str))
+    if chiave not in _PORTAFOGLI:
+        # Un nuovo snapshot con gli stessi dati ha la stessa impronta: i client continuano a ricevere 304
+        if len(_PORTAFOGLI) > MAX_RISPOSTE_IN_CACHE: _PORTAFOGLI.clear()
+        df = utils.completa_holding(df_foglio, config)
+        _PORTAFOGLI[chiave] = (df, utils.impronta_dati(df) if not df.empty else '')
+    return _PORTAFOGLI[chiave]
+
+def filtra_per_tipi(df, tipi: list):
+    return df[df['Tipo Transazione'].isin(tipi)] if tipi else df
+
+def _numero(valore, decimali: int = 2):
+    """Float per il JSON: NaN e infiniti diventano null."""
+    valore = float(valore)
+    return round(valore, decimali) if math.isfinite(valore) else None
+
+def andamento_utente(username: str, df):
+    """Valore storico e dividendi cumulati, dallo stesso snapshot 'andamento_<impronta>' della dashboard."""
+    df_valutazione = df[utils.COLONNE_VALUTAZIONE]
+    andamento, _, _ = utils.carica_con_snapshot(username, f"andamento_{utils.impronta_dati(df_valutazione)}",
+                                                lambda: utils.calcola_valore_e_dividendi(df_valutazione, username),
+                                                memoria=_MEMORIA_SNAPSHOT)
+    return andamento
+
+# --- RISORSE ---
+def risorsa_kpi(username: str, df) -> dict:
+    costo = df['Cost Base'].sum()
+    valore = df['Valore Titoli Real'].sum()
+    guadagno = valore - costo
+    realizzato = df['P/L Realizzato'].sum() if 'P/L Realizzato' in df.columns else 0.0
+    return {'valore_attuale': _numero(valore), 'costo_totale': _numero(costo), 'guadagno_perdita': _numero(guadagno),
+            'guadagno_perdita_perc': _numero(guadagno / costo * 100) if costo > 0 else 0.0,
+            'pl_realizzato': _numero(realizzato), 'transazioni': len(df)}
+
+def risorsa_allocazione(username: str, df) -> dict:
+    valori = df.groupby('Ticker')['Valore Titoli Real'].sum().sort_values(ascending=False)
+    totale = valori.sum()
+    return {'valore_totale': _numero(totale), 'posizioni': [
+        {'ticker': ticker, 'valore': _numero(valore), 'peso': _numero(valore / totale, 4) if totale > 0 else 0.0}
+        for ticker, valore in valori.items()]}
+
+def risorsa_storico(username: str, df) -> dict:
+    andamento = andamento_utente(username, df)
+    return {'date': andamento.index.strftime('%Y-%m-%d').tolist(),
+            'valore': [_numero(v) for v in andamento['Valore']],
+            'dividendi_cumulati': [_numero(v) for v in andamento['Dividendi Cumulati']],
+            'ticker_mancanti': list(andamento.attrs.get('ticker_mancanti', []))}
+
+def risorsa_drawdown(username: str, df) -> dict:
+    valore = andamento_utente(username, df)['Valore']
+    if valore.empty: return {'massimo_drawdown': None, 'drawdown_corrente': None}
+    # Stessa definizione della pagina Analisi Rischio: perdita percentuale dal massimo precedente
+    massimo_cumulato = valore.cummax()
+    drawdown = (valore - massimo_cumulato) / massimo_cumulato
+    data_minimo = drawdown.idxmin()
+    data_picco = valore.loc[:data_minimo].idxmax()
+    return {'massimo_drawdown': _numero(drawdown.min(), 4), 'data_picco': data_picco.strftime('%Y-%m-%d'),
+            'data_minimo': data_minimo.strftime('%Y-%m-%d'), 'drawdown_corrente': _numero(drawdown.iloc[-1], 4),
+            'valore_massimo': _numero(massimo_cumulato.iloc[-1]), 'valore_attuale': _numero(valore.iloc[-1])}
+
+RISORSE = {'kpi': risorsa_kpi, 'allocazione': risorsa_allocazione, 'storico': risorsa_storico, 'drawdown': risorsa_drawdown}
+
+def etag_risorsa(impronta: str, username: str, risorsa: str, tipi: list) -> str:
+    giorno = date.today().isoformat() if risorsa in RISORSE_CON_PREZZI else ''
+    chiave = f"{username}|{impronta}|{risorsa}|{','.join(sorted(tipi))}|{giorno}"
+    return f'"{hashlib.sha1(chiave.encode()).hexdigest()[:20]}"'
+
+def corpo_risorsa(etag: str, calcola) -> bytes:
+    """JSON serializzato della risorsa, calcolato una volta sola per ETag."""
+    with _LOCK_RISPOSTE:
+        if etag in _RISPOSTE:
+            _RISPOSTE.move_to_end(etag)
+            return _RISPOSTE[etag]
+    corpo = json.dumps(calcola(), ensure_ascii=False).encode('utf-8')
+    with _LOCK_RISPOSTE:
+        _RISPOSTE[etag] = corpo
+        while len(_RISPOSTE) > MAX_RISPOSTE_IN_CACHE: _RISPOSTE.popitem(last=False)
+    return corpo
+
+# --- SERVER HTTP ---
+class GestoreApi(BaseHTTPRequestHandler):
+    server_version = 'PortafoglioAPI/1.0'
+
+    def _rispondi(self, stato: int, corpo: bytes = b'', intestazioni: dict = None):
+        self.send_response(stato)
+        for nome, valore in (intestazioni or {}).items(): self.send_header(nome, valore)
+        if corpo:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(corpo)))
+        self.end_headers()
+        if corpo and self.command != 'HEAD': self.wfile.write(corpo)
+
+    def _errore(self, stato: int, messaggio: str, intestazioni: dict = None):
+        self._rispondi(stato, json.dumps({'errore': messaggio}, ensure_ascii=False).encode('utf-8'), intestazioni)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/salute':
+            return self._rispondi(200, b'{"stato": "ok"}')
+        parti = url.path.strip('/').split('/')
+        if len(parti) != 2 or parti[0] != 'api' or parti[1] not in RISORSE:
+            return self._errore(404, f"Risorsa inesistente. Disponibili: {', '.join('/api/' + r for r in RISORSE)}")
+        risorsa = parti[1]
+
+        username = utente_da_token(self.headers.get('Authorization'))
+        if username is None:
+            return self._errore(401, "Token mancante o non valido.", {'WWW-Authenticate': 'Bearer'})
+
+        tipi = [t for valore in parse_qs(url.query).get('tipi', []) for t in valore.split(',') if t]
+        df, impronta = portafoglio_utente(username)
+        if df.empty:
+            return self._errore(503, "Impossibile caricare i dati del portafoglio. Controlla la configurazione del foglio Google.")
+        etag = etag_risorsa(impronta, username, risorsa, tipi)
+        intestazioni = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+        if etag in [e.strip() for e in self.headers.get('If-None-Match', '').split(',')]:
+            return self._rispondi(304, intestazioni=intestazioni)
+
+        df_filtrato = filtra_per_tipi(df, tipi)
+        if df_filtrato.empty:
+            return self._errore(404, f"Nessuna transazione per i tipi: {', '.join(tipi)}")
+        self._rispondi(200, corpo_risorsa(etag, lambda: RISORSE[risorsa](username, df_filtrato)), intestazioni)
+
+    do_HEAD = do_GET
+
+def main():
+    parser = argparse.ArgumentParser(description="API JSON locale, in sola lettura, con le metriche del portafoglio.")
+    parser.add_argument('--host', default='127.0.0.1', help="Indirizzo di ascolto (predefinito: solo questa macchina).")
+    parser.add_argument('--porta', type=int, default=8765)
+    parser.add_argument('--genera-token', action='store_true', help="Stampa un nuovo token e la riga da aggiungere ai secrets.")
+    args = parser.parse_args()
+
+    if args.genera_token:
+        token = secrets.token_urlsafe(32)
+        print(f"Token (da usare come 'Authorization: Bearer ...'): {token}")
+        print(f"Riga da aggiungere alla voce dell'utente in [database.users.<username>]:\napi_token_sha256 = \"{impronta_token(token)}\"")
+        return
+
+    os.chdir(CARTELLA_REPO)  # st.secrets legge .streamlit/secrets.toml dalla cartella corrente
+    server = ThreadingHTTPServer((args.host, args.porta), GestoreApi)
+    print(f"API in ascolto su http://{args.host}:{args.porta} (Ctrl+C per terminare)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# benchmark_avvio.py
+"""
+Benchmark dell'avvio a freddo delle pagine.
+
+Per ogni pagina avvia un processo Python nuovo (come dopo il riavvio del container) e misura:
+  - import di streamlit e di utils;
+  - tempo al primo render della pagina con AppTest (senza sessione: nessuna chiamata di rete);
+  - quali dipendenze pesanti risultano caricate dopo il primo render.
+
+Uso:
+    python benchmark_avvio.py                    # tutte le pagine, 3 ripetizioni (mediana)
+    python benchmark_avvio.py --budget-ms 2500   # esce con codice 1 se una pagina supera il budget
+    python benchmark_avvio.py --pagine pages/5_Dashboard_Cash_Flow.py
+"""
+import argparse
+import glob
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+CARTELLA_REPO = os.path.dirname(os.path.abspath(__file__))
+MODULI_PESANTI = ['yfinance', 'gspread', 'oauth2client', 'plotly.express', 'streamlit_authenticator']
+
+# Eseguito nel processo figlio: i tempi sono in millisecondi
+CODICE_MISURA = r'''
+import json, sys, time
+sys.path.insert(0, sys.argv[2])
+inizio = time.perf_counter()
+import streamlit
+t_streamlit = time.perf_counter()
+import utils
+t_utils = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file(sys.argv[1], default_timeout=120)
+at.secrets['database'] = {'users': {'benchmark': {'name': 'Benchmark', 'sheet_name': '-', 'password_hash': '-'}}}
+at.secrets['google_credentials'] = {'benchmark': {}}
+t_render = time.perf_counter()
+at.run()
+fine = time.perf_counter()
+print(json.dumps({
+    'import_streamlit_ms': (t_streamlit - inizio) * 1000,
+    'import_utils_ms': (t_utils - t_streamlit) * 1000,
+    'primo_render_ms': (fine - t_render) * 1000,
+    'eccezioni': [str(e.value)[:200] for e in at.exception],
+    'moduli_pesanti': [m for m in json.loads(sys.argv[3]) if m in sys.modules],
+}))
+'''
+
+def misura_pagina(pagina: str) -> dict:
+    risultato = subprocess.run([sys.executable, '-c', CODICE_MISURA, pagina, CARTELLA_REPO, json.dumps(MODULI_PESANTI)],
+                               cwd=CARTELLA_REPO, capture_output=True, text=True, check=True)
+    return json.loads(risultato.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description="Tempi di avvio a freddo delle pagine Streamlit.")
+    parser.add_argument('--pagine', nargs='*', help="Pagine da misurare (predefinito: dashboard e tutte le pagine in pages/).")
+    parser.add_argument('--ripetizioni', type=int, default=3)
+    parser.add_argument('--budget-ms', type=float, default=None, help="Budget sul tempo totale (import + primo render) per pagina.")
+    args = parser.parse_args()
+
+    pagine = args.pagine or ['1_Dashboard_Generale.py'] + sorted(glob.glob('pages/*.py', root_dir=CARTELLA_REPO))
+    oltre_budget = []
+    print(f"{'Pagina':<42}{'streamlit':>11}{'utils':>9}{'render':>9}{'totale':>9}  dipendenze pesanti caricate")
+    for pagina in pagine:
+        misure = [misura_pagina(pagina) for _ in range(args.ripetizioni)]
+        mediana = {k: statistics.median(m[k] for m in misure) for k in ('import_streamlit_ms', 'import_utils_ms', 'primo_render_ms')}
+        totale = sum(mediana.values())
+        print(f"{pagina:<42}{mediana['import_streamlit_ms']:>9.0f}ms{mediana['import_utils_ms']:>7.0f}ms"
+              f"{mediana['primo_render_ms']:>7.0f}ms{totale:>7.0f}ms  {', '.join(misure[-1]['moduli_pesanti']) or '-'}")
+        for eccezione in misure[-1]['eccezioni']:
+            print(f"    ! eccezione durante il render: {eccezione}")
+        if args.budget_ms is not None and totale > args.budget_ms:
+            oltre_budget.append(pagina)
+
+    if oltre_budget:
+        print(f"\nOltre il budget di {args.budget_ms:.0f} ms: {', '.join(oltre_budget)}")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -3,8 +3,6 @@
 import streamlit as st
 import pandas as pd
 import plotly.graph_objects as go
-import plotly.express as px
-import yfinance as yf
 from datetime import datetime
 import utils
 
@@ -16,37 +14,32 @@ df_original = st.session_state.df
 
 @st.cache_data
 def prepare_ticker_data(df_ticker):
-    # ... (funzione invariata)
-    df_sorted = df_ticker.sort_values('Data Acquisto').reset_index(drop=True)
-    df_sorted['Costo Cumulativo'] = df_sorted['Cost Base'].cumsum()
-    df_sorted['Quote Cumulative'] = df_sorted['n. share'].cumsum()
-    df_sorted['PMC Evoluzione'] = df_sorted.apply(
-        lambda row: row['Costo Cumulativo'] / row['Quote Cumulative'] if row['Quote Cumulative'] > 0 else 0,
-        axis=1
-    )
+    # Stesso ordine del motore dei lotti (a parità di data gli acquisti precedono le vendite): costo, quote e PMC
+    # dopo ogni operazione sono quelli calcolati da utils.calcola_lotti con il 'Metodo Carico' configurato
+    df_sorted = df_ticker.assign(_vendita=df_ticker['Tipo Transazione'] == 'Vendita')
+    df_sorted = df_sorted.sort_values(['Data Acquisto', '_vendita'], kind='stable').drop(columns='_vendita').reset_index(drop=True)
+    df_sorted['Costo Cumulativo'] = df_sorted['Costo Residuo']
+    df_sorted['Quote Cumulative'] = df_sorted['Quote Residue']
+    df_sorted['PMC Evoluzione'] = df_sorted['PMC'].fillna(0.0)
     current_price = df_sorted['Prezzo Attuale'].iloc[-1] if not df_sorted.empty else 0
     df_sorted['Valore Reale Cumulativo'] = df_sorted['Quote Cumulative'] * current_price
     return df_sorted
 
 @st.cache_data(ttl=3600)
 def get_comparison_data(tickers, start_date, end_date):
-    # ... (funzione invariata)
-    try:
-        data = yf.download(tickers, start=start_date, end=end_date, progress=False)['Close']
-        if data.empty: return pd.DataFrame()
-        if isinstance(data, pd.Series):
-             data = data.to_frame(name=tickers[0])
-        return (data / data.iloc[0] * 100).dropna(axis=0, how='all')
-    except Exception as e:
-        st.error(f"Errore durante il download dei dati di mercato: {e}")
-        return pd.DataFrame()
+    # Finestra scelta dall'utente (anche di un solo giorno): un simbolo senza dati non va nella cache negativa
+    data, mancanti = utils.scarica_prezzi_chiusura(tickers, start_date, end_date, registra_mancanti=False)
+    if mancanti:
+        st.error(f"Errore durante il download dei dati di mercato per: {', '.join(mancanti)}")
+    if data.empty: return pd.DataFrame()
+    return (data / data.iloc[0] * 100).dropna(axis=0, how='all')
 
 # --- INTERFACCIA E LOGICA PRINCIPALE ---
 
-trans_df = df_original[df_original['Tipo Transazione'].isin(['ETF', 'Azione', 'Bond'])].copy()
+trans_df = df_original[df_original['Tipo Transazione'].isin(['ETF', 'Azione', 'Bond', 'Vendita'])].copy()
 
 if trans_df.empty:
-    st.warning("Nessuna transazione di tipo 'ETF', 'Azione' o 'Bond' trovata nei dati.")
+    st.warning("Nessuna transazione di tipo 'ETF', 'Azione', 'Bond' o 'Vendita' trovata nei dati.")
     st.stop()
 
 # --- MODIFICA 1: Creazione della mappa Ticker -> Nome ---
@@ -100,10 +93,17 @@ fig_val_cost.add_trace(go.Scatter(x=df_display['Data Acquisto'], y=df_display['V
 fig_val_cost.update_layout(title="Andamento del Valore dell'Investimento vs. Costo Sostenuto", yaxis_title="Valore (€)", legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
 st.plotly_chart(fig_val_cost, use_container_width=True)
 
+realizzato = df_display['P/L Realizzato'].sum()
+if (df_display['Tipo Transazione'] == 'Vendita').any():
+    c1, c2, c3 = st.columns(3)
+    c1.metric("P/L Realizzato nel periodo", f"€ {realizzato:,.2f}")
+    c2.metric("Ricavo dalle vendite", f"€ {df_display['Ricavo Vendita'].sum():,.2f}")
+    c3.metric("Quote detenute", f"{df_display['Quote Residue'].iloc[-1]:,.4f}")
+
 st.header("Evoluzione del Prezzo Medio di Carico (PMC)")
 fig_pmc = go.Figure()
 fig_pmc.add_trace(go.Scatter(x=df_display['Data Acquisto'], y=df_display['PMC Evoluzione'], mode='lines', name='PMC nel Tempo', line=dict(shape='hv')))
-fig_pmc.update_layout(title="Andamento del PMC dopo ogni acquisto", xaxis_title="Data Acquisto", yaxis_title="Prezzo Medio di Carico (€)")
+fig_pmc.update_layout(title="Andamento del PMC dopo ogni operazione", xaxis_title="Data Acquisto", yaxis_title="Prezzo Medio di Carico (€)")
 st.plotly_chart(fig_pmc, use_container_width=True)
 
 # --- SEZIONE DI CONFRONTO CON BENCHMARK ---
@@ -126,15 +126,15 @@ with st.expander("Mostra suggerimenti per i ticker di benchmark"):
         table_rows += f"| {name} | `{ticker}` |\n"
     st.markdown(table_header + table_rows)
 
-yf_selected_ticker_series = pd.Series([selected_ticker])
-yf_selected_ticker = utils.clean_ticker_for_yf(yf_selected_ticker_series).iloc[0]
+yf_selected_ticker = df_ticker['yf_ticker'].iloc[0] if 'yf_ticker' in df_ticker.columns else utils.converti_simbolo_yf(selected_ticker)
 benchmark_ticker_input = st.text_input("Inserisci un Ticker di Benchmark", value="^GSPC")
 
 if benchmark_ticker_input:
-    yf_benchmark_ticker = utils.clean_ticker_for_yf(pd.Series([benchmark_ticker_input])).iloc[0]
+    yf_benchmark_ticker = utils.converti_simbolo_yf(benchmark_ticker_input)
     st.write(f"Richiesta dati per i ticker: **{yf_selected_ticker}** e **{yf_benchmark_ticker}**")
     comparison_df = get_comparison_data([yf_selected_ticker, yf_benchmark_ticker], start_date_ticker, end_date_ticker)
     if not comparison_df.empty:
+        import plotly.express as px  # import differito: serve solo a questo grafico
         fig_comp = px.line(comparison_df, title=f'Performance Normalizzata: {selected_ticker} vs {benchmark_ticker_input}')
         fig_comp.update_layout(yaxis_title="Performance (Base 100)", legend_title="Ticker")
         st.plotly_chart(fig_comp, use_container_width=True)
@@ -150,7 +150,7 @@ df_ticker_filtered_table = df_ticker[
     (df_ticker['Data Acquisto'].dt.date >= start_date_ticker) &
     (df_ticker['Data Acquisto'].dt.date <= end_date_ticker)
 ]
-cols_to_display = ['Data Acquisto', 'Tipo Transazione', 'n. share', 'Market Value ACQUISTO', 'Cost Base', 'Guadagno Oggi']
+cols_to_display = ['Data Acquisto', 'Tipo Transazione', 'n. share', 'Market Value ACQUISTO', 'Cost Base', 'Guadagno Oggi', 'P/L Realizzato']
 existing_cols = [col for col in cols_to_display if col in df_ticker_filtered_table.columns]
 st.data_editor(
     df_ticker_filtered_table[existing_cols].sort_values('Data Acquisto', ascending=False),
@@ -1,7 +1,6 @@
 # pages/3_Inserimento_Operazioni.py
 
 import streamlit as st
-import gspread
 from datetime import datetime
 import pandas as pd
 import utils 
@@ -26,29 +25,17 @@ def reset_sessione():
     st.session_state.ticker_corrente_index = 0
     st.session_state.operazioni_sessione = []
 
+def aggiorna_dati_holding(username: str):
+    """Dopo una scrittura in 'Holding': invalida le cache, rilegge il foglio e aggiorna lo snapshot."""
+    utils.invalida_cache_utente(username, ['Holding', 'valutazione'])
+    st.session_state.df = utils.load_and_clean_data(username)
+    utils.registra_snapshot(username, 'Holding', st.session_state.df)
+
 def salva_operazione(username: str, data_to_write: dict):
     with st.spinner("Salvataggio in corso..."):
         try:
-            user_config = st.secrets.database.users[username]
-            user_creds = st.secrets.google_credentials[username]
-            google_sheet_name = user_config.sheet_name
-            client = utils.get_gspread_client_for_user(user_creds)
-            if client is None: raise Exception("Impossibile connettersi a Google Sheets.")
-            sheet = client.open(google_sheet_name).worksheet("Holding")
-            header_row_index = 3
-            headers = sheet.row_values(header_row_index)
-            header_map = {header: i + 1 for i, header in enumerate(headers)}
-            reference_header = 'Data Acquisto'
-            reference_col_index = header_map.get(reference_header)
-            if not reference_col_index: raise ValueError(f"Colonna '{reference_header}' non trovata.")
-            reference_col_values = sheet.col_values(reference_col_index)
-            num_data_rows = len([val for val in reference_col_values[header_row_index:] if val])
-            next_empty_row = num_data_rows + header_row_index + 1
-            cells_to_update = [gspread.Cell(row=next_empty_row, col=header_map[h], value=v) for h, v in data_to_write.items() if h in header_map]
-            if cells_to_update:
-                sheet.update_cells(cells_to_update, value_input_option='USER_ENTERED')
-                st.cache_data.clear()
-                st.session_state.df = utils.load_and_clean_data(username)
+            if utils.scrivi_operazioni_holding(username, [data_to_write]):
+                aggiorna_dati_holding(username)
                 st.success("Operazione aggiunta!")
                 time.sleep(1)
                 return True
@@ -110,11 +97,13 @@ if st.session_state.modalita_inserimento == 'menu':
         st.markdown(f"<h3 style='text-align: center; color: #FFBF00;'>Ultima Operazione Registrata: {ultima_data.strftime('%d/%m/%Y')}</h3>", unsafe_allow_html=True)
     st.markdown("---") 
     st.header("Scegli la modalità di inserimento")
-    c1, c2 = st.columns(2)
+    c1, c2, c3 = st.columns(3)
     if c1.button("Avvia Sessione Guidata", use_container_width=True, type="primary", disabled=(not sequenza_guidata)):
         st.session_state.modalita_inserimento = 'guidata_setup'; st.rerun()
     if c2.button("Inserisci Operazione Singola", use_container_width=True):
         st.session_state.modalita_inserimento = 'singola'; st.rerun()
+    if c3.button("Importa da CSV del Broker", use_container_width=True):
+        st.session_state.modalita_inserimento = 'importa'; st.rerun()
     if not sequenza_guidata:
         st.warning("Modalità 'Sessione Guidata' disabilitata. Aggiungi ticker in 'Sequenza Guidata' nel foglio 'appconfig'.")
     st.markdown("---")
@@ -132,7 +121,8 @@ elif st.session_state.modalita_inserimento == 'singola':
             data_acquisto = st.date_input("Data Acquisto", datetime.now().date())
             ticker = st.selectbox("Ticker", ticker_list, format_func=lambda t: f"{t} - {ticker_to_name.get(t, '')}")
         with c2:
-            categoria = st.selectbox("Categoria", ['Stocks', 'Azione', 'Bond', 'Saveback', 'RoundUp', 'Altro'])
+            categoria = st.selectbox("Categoria", ['Stocks', 'Azione', 'Bond', 'Saveback', 'RoundUp', 'Vendita', 'Altro'],
+                                     help="'Vendita': quote vendute e prezzo di vendita; il costo venduto segue il 'Metodo Carico' di 'appconfig'.")
             n_share_str = st.text_input("Numero di Quote", "0,0")
         with c3:
             market_value_acquisto_str = st.text_input("Prezzo per Quota in €", "0,0")
@@ -146,12 +136,15 @@ elif st.session_state.modalita_inserimento == 'singola':
         n_share_val = utils.valida_e_converti_numero(n_share_str)
         price_val = utils.valida_e_converti_numero(market_value_acquisto_str)
         
-        if n_share_val and price_val and n_share_val > 0 and price_val > 0:
-            # 2. Creazione del dizionario dati
+        quote_detenute = df_original.groupby('Ticker')['n. share'].sum().get(ticker, 0.0)
+        if categoria == 'Vendita' and n_share_val and n_share_val > quote_detenute + utils.TOLLERANZA_QUOTE:
+            st.error(f"Non puoi vendere {n_share_val:g} quote di {ticker}: ne detieni {quote_detenute:g}.")
+        elif n_share_val and price_val and n_share_val > 0 and price_val > 0:
+            # 2. Creazione del dizionario dati (le vendite hanno quote negative in 'Holding')
             data_to_write = {
                 'Stock / ETF Ticker Symbol': ticker, 
                 'Investment Category': categoria,
-                'n. share': n_share_str.replace('.', ','), 
+                'n. share': ('-' if categoria == 'Vendita' else '') + n_share_str.strip().lstrip('-').replace('.', ','), 
                 'Market Value ACQUISTO': market_value_acquisto_str.replace('.', ','),
                 'Data Acquisto': data_acquisto.strftime('%d/%m/%Y'), 
                 'Trading Fees': commissioni_str.replace('.', ',')
@@ -170,6 +163,71 @@ elif st.session_state.modalita_inserimento == 'singola':
         reset_sessione()
         st.rerun()
         
+# ==============================================================================
+# VISTA IMPORTAZIONE DA CSV DEL BROKER
+# ==============================================================================
+elif st.session_state.modalita_inserimento == 'importa':
+    st.header("Importazione da Estratto Conto del Broker")
+    st.caption("CSV delle transazioni esportato dal broker (es. TradeRepublic): acquisti, vendite, Saveback e RoundUp vengono aggiunti a 'Holding' "
+               "con un'unica scrittura; le righe già presenti nel foglio vengono riconosciute e saltate.")
+    file_csv = st.file_uploader("File CSV", type=['csv'])
+
+    if file_csv is not None:
+        try:
+            df_csv = pd.read_csv(file_csv, sep=None, engine='python', dtype=str, encoding='utf-8-sig')
+        except Exception as e:
+            st.error(f"Impossibile leggere il file: {e}"); st.stop()
+
+        # 1. Corrispondenza delle colonne (rilevata dai nomi, modificabile)
+        rilevate = utils.rileva_colonne_csv(df_csv.columns)
+        incomplete = not all(rilevate[campo] for campo in ('Identificativo', 'Data', 'Quote'))
+        colonne = {}
+        with st.expander("Corrispondenza delle colonne", expanded=incomplete):
+            opzioni = [None] + df_csv.columns.tolist()
+            griglia = st.columns(4)
+            for i, (campo, rilevata) in enumerate(rilevate.items()):
+                colonne[campo] = griglia[i % 4].selectbox(campo, opzioni, index=opzioni.index(rilevata), format_func=lambda c: "—" if c is None else str(c), key=f"colonna_csv_{campo}")
+        categoria_acquisti = st.selectbox("Categoria per gli acquisti", ['Stocks', 'Azione', 'Bond', 'Altro'])
+
+        # 2. Normalizzazione e ticker non riconosciuti (associazione manuale)
+        operazioni = utils.normalizza_estratto_broker(df_csv, colonne, utils.mappa_identificativi_ticker(df_original))
+        da_associare = operazioni['Ticker'].isna() & operazioni['Classe'].isin(utils.CLASSI_IMPORTABILI_BROKER) & (operazioni['Identificativo'] != '')
+        if da_associare.any():
+            st.warning("Alcuni titoli del file non corrispondono a ticker del foglio: indica il ticker (es. BIT:ENI) per importarli.")
+            associazioni = st.data_editor(
+                pd.DataFrame({'Identificativo': sorted(operazioni.loc[da_associare, 'Identificativo'].unique()), 'Ticker': ''}),
+                column_config={'Ticker': st.column_config.TextColumn("Ticker")}, disabled=['Identificativo'], hide_index=True, key="associazioni_ticker_csv")
+            scelte = associazioni['Ticker'].fillna('').str.strip()
+            scelte = pd.Series(scelte.values, index=associazioni['Identificativo'].str.casefold())[lambda t: t != '']
+            operazioni['Ticker'] = operazioni['Ticker'].fillna(operazioni['Identificativo'].str.casefold().map(scelte))
+
+        # 3. Riepilogo e scrittura
+        operazioni['Stato'] = utils.stato_importazione(operazioni, df_original)
+        nuove = operazioni[operazioni['Stato'] == 'Nuova']
+        c1, c2, c3 = st.columns(3)
+        c1.metric("Da importare", len(nuove))
+        c2.metric("Già presenti nel foglio", int((operazioni['Stato'] == 'Duplicato').sum()))
+        c3.metric("Ignorate", int(operazioni['Stato'].str.startswith('Ignorata').sum()))
+        st.dataframe(operazioni.sort_values('Data Acquisto'), use_container_width=True, hide_index=True, column_config={
+            'Data Acquisto': st.column_config.DateColumn(format="DD/MM/YYYY"),
+            'Market Value ACQUISTO': st.column_config.NumberColumn("Prezzo", format="€ %.4f"),
+            'Trading Fees': st.column_config.NumberColumn("Commissioni", format="€ %.2f"),
+        })
+
+        if st.button(f"Importa {len(nuove)} operazioni", type="primary", use_container_width=True, disabled=nuove.empty):
+            with st.spinner("Scrittura in corso..."):
+                try:
+                    scritte = utils.scrivi_operazioni_holding(username, utils.righe_holding_da_operazioni(nuove, categoria_acquisti))
+                except Exception as e:
+                    st.error(f"Errore durante l'importazione: {e}"); st.stop()
+                aggiorna_dati_holding(username)
+            st.success(f"{scritte} operazioni importate!")
+
+    st.markdown("---")
+    if st.button("Torna al Menu", type="secondary"):
+        reset_sessione()
+        st.rerun()
+
 #==================================================================
 # VISTA SETUP SESSIONE GUIDATA
 # ==============================================================================
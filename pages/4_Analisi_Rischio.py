@@ -3,7 +3,6 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-import yfinance as yf
 import plotly.graph_objects as go
 import utils # Importa il file di utilità
 
@@ -19,12 +18,15 @@ df_original = st.session_state.df
 
 with st.spinner("Calcolo della serie storica del portafoglio..."):
     # --- MODIFICA CHIAVE: Chiamiamo la funzione centralizzata ---
-    portfolio_value = utils.calculate_historical_portfolio_value(df_original)
+    portfolio_value = utils.calculate_historical_portfolio_value(df_original[utils.COLONNE_VALUTAZIONE], st.session_state.get('current_user'))
 
 if portfolio_value is None or portfolio_value.empty:
     st.error("Impossibile calcolare l'analisi del rischio. Controlla i ticker nel tuo foglio o la connessione a yfinance.")
     st.stop()
 
+if portfolio_value.attrs.get('ticker_mancanti'):
+    st.warning(f"Prezzi non disponibili per: {', '.join(portfolio_value.attrs['ticker_mancanti'])}. L'analisi li esclude.")
+
 # Calcoliamo i ritorni giornalieri dalla serie storica del valore
 daily_returns = portfolio_value.pct_change().dropna()
 
@@ -72,4 +74,50 @@ if not drawdown.empty:
     fig_drawdown_area.update_layout(title="Periodi di Drawdown del Portafoglio", yaxis_title="Perdita dal Picco", yaxis_tickformat=".1%")
     st.plotly_chart(fig_drawdown_area, use_container_width=True)
 else:
-    st.warning("Non ci sono abbastanza dati per calcolare il drawdown.")
\ No newline at end of file
+    st.warning("Non ci sono abbastanza dati per calcolare il drawdown.")
+
+# --- SEZIONE 3: CORRELAZIONI E COVARIANZE ---
+st.header("Correlazioni tra Titoli")
+st.markdown("Quanto si muovono insieme i titoli in portafoglio. Correlazioni alte riducono il beneficio della diversificazione.")
+
+FINESTRE_CORRELAZIONE = {"3 mesi": 63, "6 mesi": 126, "1 anno": 252, "2 anni": 504}
+
+@utils.frammento
+def mostra_correlazioni(df_valutazione, username):
+    col_finestra, col_stimatore = st.columns(2)
+    etichetta_finestra = col_finestra.select_slider("Finestra di stima", options=list(FINESTRE_CORRELAZIONE), value="1 anno")
+    stimatore = col_stimatore.radio("Stimatore", ["shrinkage", "campionario"], horizontal=True,
+                                    help="Lo shrinkage (Ledoit-Wolf) stabilizza la matrice quando i titoli sono molti rispetto ai giorni osservati.")
+    finestra = FINESTRE_CORRELAZIONE[etichetta_finestra]
+
+    risultati = utils.calcola_correlazioni(df_valutazione, username, finestra, stimatore)
+    if not risultati:
+        st.info("Servono almeno due titoli con storico sufficiente nella finestra scelta.")
+        return
+    corr, cov = risultati['correlazione'], risultati['covarianza']
+
+    valori_fuori_diagonale = corr.to_numpy()[np.triu_indices(len(corr), k=1)]
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Correlazione Media", f"{valori_fuori_diagonale.mean():.2f}")
+    c2.metric("Giorni Osservati", risultati['osservazioni'])
+    c3.metric("Intensità Shrinkage", f"{risultati['intensita_shrinkage']:.1%}")
+
+    fig_corr = go.Figure(go.Heatmap(z=corr.to_numpy(), x=corr.columns, y=corr.index, zmin=-1, zmax=1, colorscale='RdBu', reversescale=True,
+                                    hovertemplate="%{y} / %{x}: %{z:.2f}<extra></extra>"))
+    fig_corr.update_layout(title="Matrice di Correlazione (ordinata per cluster)", height=max(450, 14 * len(corr)), yaxis_autorange='reversed')
+    st.plotly_chart(fig_corr, use_container_width=True)
+
+    media_mobile = risultati['correlazione_media_mobile'].dropna()
+    if not media_mobile.empty:
+        fig_mobile = go.Figure(go.Scatter(x=media_mobile.index, y=media_mobile, mode='lines', name='Correlazione media', line_color='teal'))
+        fig_mobile.update_layout(title=f"Correlazione Media Mobile ({etichetta_finestra})", yaxis_title="Correlazione media")
+        st.plotly_chart(fig_mobile, use_container_width=True)
+
+    with st.expander("Coppie più correlate e covarianze"):
+        righe, colonne = np.triu_indices(len(corr), k=1)
+        coppie = pd.DataFrame({'Titolo A': corr.index[righe], 'Titolo B': corr.columns[colonne], 'Correlazione': valori_fuori_diagonale})
+        st.dataframe(coppie.nlargest(15, 'Correlazione').round(3), hide_index=True, use_container_width=True)
+        st.write("**Covarianza annualizzata:**")
+        st.dataframe(cov.round(4), use_container_width=True)
+
+mostra_correlazioni(df_original[utils.COLONNE_VALUTAZIONE], st.session_state.get('current_user'))
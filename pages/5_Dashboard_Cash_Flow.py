@@ -6,7 +6,6 @@ from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import utils 
 import time
-import plotly.express as px
 
 st.set_page_config(page_title="Dashboard Cash Flow", layout="wide")
 st.title("Dashboard Cash Flow")
@@ -17,56 +16,38 @@ username = st.session_state.get('current_user')
 
 # Carica tutte le fonti di dati
 config, df_config = utils.carica_configurazione_da_foglio(username)
-cash_flow_data_raw, _ = utils.load_cash_flow_data(username, config)
-totals_entrate_storico_raw, totals_uscite_storico_raw = utils.load_historical_totals(username)
+cubo_dettaglio = utils.load_cash_flow_data(username, config)
+totals_entrate_storico_raw, totals_uscite_storico_raw, diagnostica_storico = utils.load_historical_totals(username)
 
-if not config or not cash_flow_data_raw:
+if diagnostica_storico['errore']:
+    st.warning(f"Storico non disponibile: {diagnostica_storico['errore']}")
+
+if not config or not cubo_dettaglio:
     st.warning("Errore nel caricamento dei dati o della configurazione."); st.stop()
 
 # --- LOGICA DI ALLINEAMENTO DATI ---
-# 1. Trova l'orizzonte temporale completo
-mesi_da_dettaglio = cash_flow_data_raw.get('total_entrate', pd.Series(dtype=float)).index
-mesi_da_storico = totals_entrate_storico_raw.index
-tutti_i_mesi_unici = sorted(list(set(mesi_da_dettaglio) | set(mesi_da_storico)))
-
-MAPPA_MESI_ITA_NUM = {'GEN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAG': 5, 'GIU': 6, 'LUG': 7, 'AGO': 8, 'SET': 9, 'OTT': 10, 'NOV': 11, 'DIC': 12}
-tutti_i_mesi_disponibili = sorted(
-    [m for m in tutti_i_mesi_unici if isinstance(m, str) and '/' in m],
-    key=lambda m: (int(m.split('/')[1]), MAPPA_MESI_ITA_NUM.get(m.split('/')[0].strip(), 0))
-)
-available_years = sorted(list({int(m.split('/')[1]) for m in tutti_i_mesi_disponibili}), reverse=True)
-
-# 2. Allinea tutti i dati a questo orizzonte temporale
-cash_flow_data = {
-    key: data.reindex(tutti_i_mesi_disponibili, fill_value=0)
-    for key, data in cash_flow_data_raw.items()
-}
-totals_entrate_storico = totals_entrate_storico_raw.reindex(tutti_i_mesi_disponibili, fill_value=0)
-totals_uscite_storico = totals_uscite_storico_raw.reindex(tutti_i_mesi_disponibili, fill_value=0)
+# Dettaglio e storico condividono un unico asse mensile (PeriodIndex) costruito in utils e messo in cache:
+# qui si affetta e si somma soltanto.
+cubo = utils.unisci_storico_al_cubo(cubo_dettaglio, totals_entrate_storico_raw, totals_uscite_storico_raw)
+cash_flow_mensile = cubo['mensile']
+tutti_i_mesi_disponibili = cash_flow_mensile.index
+available_years = cubo['anni']
 
 # ==============================================================================
 # SEZIONE FILTRI (SPOSTATA NELLA SIDEBAR)
 # ==============================================================================
 st.sidebar.header("Filtri di Visualizzazione")
-mesi_da_dettaglio = cash_flow_data.get('total_entrate', pd.Series(dtype=float)).index
-mesi_da_storico = totals_entrate_storico.index
-tutti_i_mesi_unici = sorted(list(set(mesi_da_dettaglio) | set(mesi_da_storico)))
-
-
-MAPPA_MESI_ITA_NUM = {'GEN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAG': 5, 'GIU': 6, 'LUG': 7, 'AGO': 8, 'SET': 9, 'OTT': 10, 'NOV': 11, 'DIC': 12}
-tutti_i_mesi_disponibili = sorted(
-    [m for m in tutti_i_mesi_unici if isinstance(m, str) and '/' in m],
-    key=lambda m: (int(m.split('/')[1]), MAPPA_MESI_ITA_NUM.get(m.split('/')[0].strip(), 0)))
-available_years = sorted(list({int(m.split('/')[1]) for m in tutti_i_mesi_disponibili}), reverse=True)
-
+mostra_debug = st.sidebar.checkbox("🔍 Mostra diagnostica", value=False, help="Mostra ancore, righe lette e tempi dei caricamenti.")
+if mostra_debug:
+    utils.mostra_diagnostica([cubo_dettaglio.get('diagnostica'), diagnostica_storico])
 
-if not tutti_i_mesi_disponibili:
+if tutti_i_mesi_disponibili.empty:
     st.info("Nessun dato mensile trovato per generare l'analisi.")
     st.stop()
 else:
-    # --- Logica di gestione dello stato per i filtri (invariata) ---
+    # --- Logica di gestione dello stato per i filtri (i mesi sono Period mensili) ---
     if 'mesi_selezionati' not in st.session_state:
-        st.session_state.mesi_selezionati = tutti_i_mesi_disponibili
+        st.session_state.mesi_selezionati = list(tutti_i_mesi_disponibili)
 
     # --- Widget Vista Rapida ---
     opzioni_vista_rapida = ["Selezione Personalizzata", "Seleziona Tutto", "Mese Corrente", "Ultimi 3 Mesi", "Ultimi 6 Mesi", "Ultimi 12 Mesi"]
@@ -74,53 +55,25 @@ else:
     # Usiamo st.sidebar.selectbox
     vista_selezionata = st.sidebar.selectbox("Vista Rapida", opzioni_vista_rapida, key="vista_selector")
 
-    # --- Logica di aggiornamento (invariata) ---
+    # --- Logica di aggiornamento: le viste rapide sono fette contigue dell'asse mensile ---
     if vista_selezionata != "Selezione Personalizzata":
         new_selection = []
-        today = datetime.now()
+        mese_corrente = pd.Period(datetime.now(), freq='M')
         if vista_selezionata == "Seleziona Tutto":
-            new_selection = tutti_i_mesi_disponibili
+            new_selection = list(tutti_i_mesi_disponibili)
         elif vista_selezionata == "Mese Corrente":
-            mese_corrente_nome = list(MAPPA_MESI_ITA_NUM.keys())[today.month - 1]
-            mese_corrente_str = f"{mese_corrente_nome}/{today.year}"
-            if mese_corrente_str in tutti_i_mesi_disponibili: new_selection = [mese_corrente_str]
+            if mese_corrente in tutti_i_mesi_disponibili: new_selection = [mese_corrente]
         elif "Ultimi" in vista_selezionata:
             num_mesi = int(vista_selezionata.split(' ')[1])
-            try:
-                mese_corrente_nome = list(MAPPA_MESI_ITA_NUM.keys())[today.month - 1]
-                mese_corrente_str = f"{mese_corrente_nome}/{today.year}"
-                end_index = tutti_i_mesi_disponibili.index(mese_corrente_str)
-            except ValueError:
+            if mese_corrente in tutti_i_mesi_disponibili:
+                end_index = tutti_i_mesi_disponibili.get_loc(mese_corrente)
+            else:
                 end_index = len(tutti_i_mesi_disponibili) - 1
             start_index = max(0, end_index - num_mesi + 1)
-            new_selection = tutti_i_mesi_disponibili[start_index : end_index + 1]
+            new_selection = list(tutti_i_mesi_disponibili[start_index : end_index + 1])
         
         st.session_state.mesi_selezionati = new_selection
 
-    # --- Griglia di selezione manuale nella sidebar ---
-    with st.sidebar.expander("Modifica selezione mesi manualmente"):
-        for year in sorted(available_years, reverse=True):
-            st.write(f"**{year}**")
-            mesi_dell_anno = [m for m in tutti_i_mesi_disponibili if str(year) in m]
-            tutti_selezionati_anno = all(m in st.session_state.mesi_selezionati for m in mesi_dell_anno)
-            
-            if st.checkbox(f"Seleziona tutto il {year}", value=tutti_selezionati_anno, key=f"select_all_{year}"):
-                for mese in mesi_dell_anno:
-                    if mese not in st.session_state.mesi_selezionati: st.session_state.mesi_selezionati.append(mese)
-            else:
-                if tutti_selezionati_anno:
-                    st.session_state.mesi_selezionati = [m for m in st.session_state.mesi_selezionati if str(year) not in m]
-
-            num_colonne = 2 # Meno colonne per adattarsi alla larghezza della sidebar
-            colonne_griglia = st.columns(num_colonne)
-            for j, mese in enumerate(mesi_dell_anno):
-                col = colonne_griglia[j % num_colonne]
-                is_selected = mese in st.session_state.mesi_selezionati
-                if col.toggle(mese, value=is_selected, key=f"toggle_{mese}") != is_selected:
-                    st.session_state.vista_selector = "Selezione Personalizzata"
-                    st.rerun()
-
-    colonne_da_usare = st.session_state.mesi_selezionati
 
 # ==============================================================================
 # SEZIONE 1: INTERFACCIA UTENTE
@@ -129,7 +82,7 @@ st.title("Dashboard Cash Flow")
 
 with st.expander("Inserisci una nuova operazione"):
     # ... (il codice dell'expander con i form rimane identico) ...
-    tab_uscita, tab_entrata = st.tabs(["Registra Uscita", "Registra Entrata"])
+    tab_uscita, tab_entrata, tab_importa = st.tabs(["Registra Uscita", "Registra Entrata", "Importa Estratto Conto"])
     with tab_uscita:
         with st.form("form_uscita", clear_on_submit=True):
             st.subheader("Nuova Uscita")
@@ -149,7 +102,7 @@ with st.expander("Inserisci una nuova operazione"):
                 importo = utils.valida_e_converti_numero(importo_uscita_str)
                 if importo and importo > 0:
                     dati = {"Conto": conto_uscita, "Tipo": tipo_uscita, "Voce": voce_uscita, "Importo": f"€ {importo_uscita_str}", "Data": data_uscita.strftime('%d/%m/%Y'), "Macro": macro_uscita, "Micro": micro_uscita}
-                    mese_str = data_uscita.strftime("%b").upper()
+                    mese_str = utils.nome_foglio_mese(data_uscita)
                     with st.spinner("Salvataggio..."):
                         success = utils.salva_operazione_cash_flow(username, mese_str, dati, "USCITE")
                     if success: st.success("Uscita salvata!"); time.sleep(1); st.rerun()
@@ -174,28 +127,120 @@ with st.expander("Inserisci una nuova operazione"):
                 importo = utils.valida_e_converti_numero(importo_entrata_str)
                 if importo and importo > 0:
                     dati = {"Conto": conto_entrata, "Tipo": "N/A", "Voce": voce_entrata, "Importo": f"€ {importo_entrata_str}", "Data": data_entrata.strftime('%d/%m/%Y'), "Macro": macro_entrata, "Micro": micro_entrata}
-                    mese_str = data_entrata.strftime("%b").upper()
+                    mese_str = utils.nome_foglio_mese(data_entrata)
                     with st.spinner("Salvataggio..."):
                         success = utils.salva_operazione_cash_flow(username, mese_str, dati, "ENTRATE")
                     if success: st.success("Entrata salvata!"); time.sleep(1); st.rerun()
                     else: st.error("Salvataggio fallito.")
                 else: st.error("Importo non valido.")
+    with tab_importa:
+        st.subheader("Importa Estratto Conto")
+        st.caption("CSV dei movimenti di banca o carta: Macro e Micro sono proposte dalle regole di 'appconfig' (colonne 'Parola Chiave' e "
+                   "'Categoria'), dai nomi delle categorie e dalle scelte fatte nelle importazioni precedenti, che vengono ricordate.")
+        file_banca = st.file_uploader("File CSV", type=['csv'], key="csv_banca")
+        df_banca = None
+        if file_banca is not None:
+            try:
+                df_banca = pd.read_csv(file_banca, sep=None, engine='python', dtype=str, encoding='utf-8-sig')
+            except Exception as e:
+                st.error(f"Impossibile leggere il file: {e}")
+        if df_banca is not None:
+            rilevate = utils.rileva_colonne_csv(df_banca.columns, utils.COLONNE_CSV_BANCA)
+            opzioni = [None] + df_banca.columns.tolist()
+            colonne = {campo: colonna.selectbox(campo, opzioni, index=opzioni.index(rilevata), format_func=lambda c: "—" if c is None else str(c), key=f"colonna_banca_{campo}")
+                       for colonna, (campo, rilevata) in zip(st.columns(len(rilevate)), rilevate.items())}
+            c1, c2 = st.columns(2)
+            conto_banca = c1.selectbox("Conto", config["Conto"], key="c_banca")
+            tipo_banca = c2.selectbox("Tipo (per le uscite)", config["Tipo"], index=config["Tipo"].index("Elettronici") if "Elettronici" in config["Tipo"] else 0, key="t_banca")
+
+            movimenti = utils.normalizza_estratto_banca(df_banca, colonne)
+            if movimenti.empty:
+                st.info("Nessun movimento con data e importo validi nel file.")
+            else:
+                proposte = utils.categorizza_movimenti(movimenti['Voce'], movimenti['Sezione'], utils.regole_categorie(config, df_config), utils.memoria_categorie(username))
+                movimenti = movimenti.join(proposte)
+                modificati = st.data_editor(movimenti, hide_index=True, use_container_width=True, key="editor_movimenti_banca",
+                                            disabled=['Data', 'Voce', 'Importo', 'Sezione', 'Origine'], column_config={
+                    'Data': st.column_config.DateColumn(format="DD/MM/YYYY"),
+                    'Importo': st.column_config.NumberColumn(format="€ %.2f"),
+                    'Macro': st.column_config.SelectboxColumn(options=[''] + sorted(set(config["Macro USCITE"]) | set(config["Macro ENTRATE"]))),
+                    'Micro': st.column_config.SelectboxColumn(options=[''] + sorted(set(config["Micro USCITE"]) | set(config["Micro ENTRATE"]))),
+                })
+                categorizzati = modificati[modificati['Micro'].fillna('') != '']
+                c1, c2, c3 = st.columns(3)
+                c1.metric("Movimenti", len(movimenti))
+                c2.metric("Categorizzati in automatico", int((movimenti['Origine'] != '').sum()))
+                c3.metric("Da categorizzare", len(modificati) - len(categorizzati))
+                if st.button(f"Salva {len(categorizzati)} movimenti categorizzati", type="primary", use_container_width=True, disabled=categorizzati.empty, key="salva_banca"):
+                    # Le correzioni rispetto alla proposta vengono ricordate per le prossime importazioni
+                    corretti = (modificati['Macro'] != movimenti['Macro']) | (modificati['Micro'] != movimenti['Micro'])
+                    utils.ricorda_categorie(username, modificati[corretti & (modificati['Micro'].fillna('') != '')])
+                    with st.spinner("Salvataggio..."):
+                        try:
+                            salvati = sum(utils.salva_operazioni_cash_flow(username, mese, righe)
+                                          for mese, righe in utils.righe_cash_flow_da_movimenti(categorizzati, conto_banca, tipo_banca).items())
+                        except Exception as e:
+                            utils.invalida_cache_utente(username, ['IN/OUT'])  # i mesi già scritti restano nel foglio
+                            st.error(f"Errore durante il salvataggio: {e}")
+                        else:
+                            utils.invalida_cache_utente(username, ['IN/OUT'])
+                            st.success(f"{salvati} movimenti salvati!"); time.sleep(1); st.rerun()
 
 # ==============================================================================
-# SEZIONE 2 E 3: KPI E GRAFICI (CON SINTASSI CORRETTA)
+# SEZIONE 2 E 3: KPI E GRAFICI (FRAMMENTO CON RIESECUZIONE INDIPENDENTE)
 # ==============================================================================
-st.markdown("---")
-st.header("Analisi Finanziaria")
+def _alterna_mese(mese):
+    """Callback dei toggle mensili: aggiorna la selezione e passa alla vista personalizzata."""
+    if mese in st.session_state.mesi_selezionati:
+        st.session_state.mesi_selezionati = [m for m in st.session_state.mesi_selezionati if m != mese]
+    else:
+        st.session_state.mesi_selezionati.append(mese)
+    st.session_state.vista_selector = "Selezione Personalizzata"
+
+def mostra_griglia_mesi():
+    """Griglia di selezione manuale dei mesi (dentro il frammento, così un toggle non riesegue tutta la pagina)."""
+    with st.expander("Modifica selezione mesi manualmente"):
+        for year in available_years:
+            st.write(f"**{year}**")
+            mesi_dell_anno = list(tutti_i_mesi_disponibili[tutti_i_mesi_disponibili.year == year])
+            tutti_selezionati_anno = all(m in st.session_state.mesi_selezionati for m in mesi_dell_anno)
+            
+            if st.checkbox(f"Seleziona tutto il {year}", value=tutti_selezionati_anno, key=f"select_all_{year}"):
+                for mese in mesi_dell_anno:
+                    if mese not in st.session_state.mesi_selezionati: st.session_state.mesi_selezionati.append(mese)
+            else:
+                if tutti_selezionati_anno:
+                    st.session_state.mesi_selezionati = [m for m in st.session_state.mesi_selezionati if m.year != year]
+
+            num_colonne = 6
+            colonne_griglia = st.columns(num_colonne)
+            for j, mese in enumerate(mesi_dell_anno):
+                col = colonne_griglia[j % num_colonne]
+                etichetta_mese = utils.formatta_mese_ita(mese)
+                col.toggle(etichetta_mese, value=mese in st.session_state.mesi_selezionati, key=f"toggle_{etichetta_mese}",
+                           on_change=_alterna_mese, args=(mese,))
+
+@utils.frammento
+def sezione_analisi():
+    """KPI e grafici del periodo: si riesegue da sola quando cambia la selezione dei mesi."""
+    st.markdown("---")
+    st.header("Analisi Finanziaria")
+    mostra_griglia_mesi()
+
+    colonne_da_usare = st.session_state.mesi_selezionati
+    if not colonne_da_usare:
+        st.warning("Seleziona almeno un mese per visualizzare i dati.")
+        return
 
-if not colonne_da_usare:
-    st.warning("Seleziona almeno un mese dalla sidebar per visualizzare i dati.")
-else:
     # --- LOGICA DI CONFRONTO E KPI (ORA ROBUSTA) ---
-    total_entrate_dettaglio = cash_flow_data['total_entrate'][colonne_da_usare].sum()
-    total_uscite_dettaglio = cash_flow_data['total_uscite'][colonne_da_usare].sum()
+    # Una sola somma vettoriale sulle righe selezionate del cubo, poi si leggono i totali per sezione
+    somme_periodo = utils.seleziona_mesi(cash_flow_mensile, colonne_da_usare).sum()
+
+    total_entrate_dettaglio = somme_periodo.get(('Totali', 'Entrate'), 0.0)
+    total_uscite_dettaglio = somme_periodo.get(('Totali', 'Uscite'), 0.0)
     
-    total_entrate_storico = totals_entrate_storico[colonne_da_usare].sum()
-    total_uscite_storico = totals_uscite_storico[colonne_da_usare].sum()
+    total_entrate_storico = somme_periodo.get(('Storico', 'Entrate'), 0.0)
+    total_uscite_storico = somme_periodo.get(('Storico', 'Uscite'), 0.0)
     
     total_entrate_finale = max(total_entrate_dettaglio, total_entrate_storico)
     total_uscite_finale = max(total_uscite_dettaglio, total_uscite_storico)
@@ -218,22 +263,19 @@ else:
     st.markdown("---")
     st.header("Dettaglio Categorie del Periodo")
     
-    df_macro_uscite = cash_flow_data.get('macro_uscite', pd.DataFrame())
-    df_micro_uscite = cash_flow_data.get('micro_uscite', pd.DataFrame())
-    df_micro_entrate = cash_flow_data.get('micro_entrate', pd.DataFrame())
-
-    # --- FINESTRA DI DEBUG ---
-    with st.expander("🔍 Debug: Dati allineati usati per i calcoli"):
-        st.write("**`colonne_da_usare` (mesi selezionati):**", colonne_da_usare)
-        st.write("**Dati `total_uscite_dettaglio` (allineati):**")
-        st.dataframe(cash_flow_data['total_uscite'])
-        st.write("**Dati `totals_uscite_storico` (allineati):**")
-        st.dataframe(totals_uscite_storico)
+    # --- FINESTRA DI DEBUG (solo su richiesta) ---
+    if mostra_debug:
+        with st.expander("🔍 Debug: Dati allineati usati per i calcoli"):
+            st.write("**`colonne_da_usare` (mesi selezionati):**", [utils.formatta_mese_ita(m) for m in colonne_da_usare])
+            st.write("**Totali dettaglio e storico (allineati):**")
+            colonne_totali = cash_flow_mensile.columns.get_level_values('Sezione').isin(['Totali', 'Storico'])
+            st.dataframe(cash_flow_mensile.loc[:, colonne_totali].rename(index=utils.formatta_mese_ita))
 
+    import plotly.express as px  # import differito: lo paga solo chi arriva ai grafici
     col1, col2 = st.columns(2)
     with col1:
         st.subheader("Analisi Uscite")
-        somma_macro_uscite = df_macro_uscite[colonne_da_usare].sum(axis=1)
+        somma_macro_uscite = somme_periodo.get('Macro USCITE', pd.Series(dtype=float))
         somma_macro_uscite = somma_macro_uscite[somma_macro_uscite > 0]
         if not somma_macro_uscite.empty:
             fig_pie_macro = px.pie(
@@ -246,7 +288,7 @@ else:
     
     with col2:
         st.subheader("Analisi Entrate")
-        somma_micro_entrate = df_micro_entrate[colonne_da_usare].sum(axis=1)
+        somma_micro_entrate = somme_periodo.get('Micro ENTRATE', pd.Series(dtype=float))
         somma_micro_entrate = somma_micro_entrate[somma_micro_entrate > 0]
         if not somma_micro_entrate.empty:
             fig_bar_entrate = px.bar(
@@ -256,4 +298,6 @@ else:
             )
             st.plotly_chart(fig_bar_entrate, use_container_width=True)
         else:
-            st.info("Nessuna entrata categorizzata nel periodo selezionato.")
\ No newline at end of file
+            st.info("Nessuna entrata categorizzata nel periodo selezionato.")
+
+sezione_analisi()
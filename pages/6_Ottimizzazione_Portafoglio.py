@@ -0,0 +1,87 @@
+# pages/6_Ottimizzazione_Portafoglio.py
+
+import streamlit as st
+import pandas as pd
+import plotly.graph_objects as go
+import utils
+
+st.set_page_config(page_title="Ottimizzazione Portafoglio", layout="wide")
+st.title("Ottimizzazione del Portafoglio")
+
+utils.check_data_loaded()
+username = st.session_state.get('current_user')
+df_original = st.session_state.df
+
+config, _ = utils.carica_configurazione_da_foglio(username)
+sequenza_guidata = config.get("Sequenza Guidata", []) if config else []
+
+st.sidebar.header("Parametri")
+tasso_privo_rischio = st.sidebar.number_input("Tasso privo di rischio annuo (%)", min_value=0.0, max_value=10.0, value=2.0, step=0.25) / 100
+
+with st.spinner("Calcolo della frontiera efficiente..."):
+    risultati = utils.calcola_ottimizzazione(df_original[utils.COLONNE_VALUTAZIONE], username, tasso_privo_rischio)
+
+if not risultati:
+    st.error("Servono almeno due titoli con uno storico di prezzi sufficiente per l'ottimizzazione.")
+    st.stop()
+
+st.caption("Rendimenti attesi e covarianze stimati sullo storico dei prezzi (in EUR) dei titoli posseduti. I risultati passati non garantiscono quelli futuri.")
+
+# --- PESI DI RIFERIMENTO ---
+valori_correnti = df_original.groupby('Ticker')['Valore Titoli Real'].sum()
+valori_correnti = valori_correnti[valori_correnti > 0]
+pesi_attuali = valori_correnti / valori_correnti.sum()
+pesi_sequenza = utils.pesi_da_sequenza(sequenza_guidata, valori_correnti.index.union(pd.Index(sequenza_guidata)))
+
+portafogli = {
+    'Minima Varianza': risultati['pesi']['Minima Varianza'],
+    'Massimo Sharpe': risultati['pesi']['Massimo Sharpe'],
+    'Attuale': pesi_attuali,
+}
+if sequenza_guidata:
+    portafogli['Sequenza Guidata'] = pesi_sequenza
+statistiche = {nome: utils.statistiche_portafoglio(pesi, risultati, tasso_privo_rischio) for nome, pesi in portafogli.items()}
+
+# --- SEZIONE 1: FRONTIERA EFFICIENTE ---
+st.header("Frontiera Efficiente")
+colonne_kpi = st.columns(len(statistiche))
+for colonna, (nome, (rendimento, volatilita, sharpe)) in zip(colonne_kpi, statistiche.items()):
+    colonna.metric(nome, f"{rendimento:.2%}")
+    colonna.caption(f"Volatilità {volatilita:.2%} · Sharpe {sharpe:.2f}")
+
+campioni, frontiera = risultati['campioni'], risultati['frontiera']
+fig = go.Figure()
+fig.add_trace(go.Scattergl(x=campioni['Volatilità'], y=campioni['Rendimento'], mode='markers', name='Portafogli casuali',
+                           marker=dict(size=3, color=campioni['Sharpe'], colorscale='Viridis', showscale=True, colorbar=dict(title='Sharpe'), opacity=0.5)))
+fig.add_trace(go.Scatter(x=frontiera['Volatilità'], y=frontiera['Rendimento'], mode='lines', name='Frontiera efficiente', line=dict(color='black', width=3)))
+simboli = {'Minima Varianza': 'diamond', 'Massimo Sharpe': 'star', 'Attuale': 'circle', 'Sequenza Guidata': 'square'}
+for nome, (rendimento, volatilita, _) in statistiche.items():
+    fig.add_trace(go.Scatter(x=[volatilita], y=[rendimento], mode='markers', name=nome, marker=dict(size=16, symbol=simboli[nome], line=dict(width=1, color='white'))))
+fig.update_layout(xaxis_title="Volatilità Annualizzata", yaxis_title="Rendimento Annualizzato", xaxis_tickformat=".0%", yaxis_tickformat=".0%", height=550)
+st.plotly_chart(fig, use_container_width=True)
+
+# --- SEZIONE 2: PESI ---
+st.header("Composizione dei Portafogli")
+tabella_pesi = pd.DataFrame(portafogli).fillna(0.0)
+tabella_pesi = tabella_pesi[(tabella_pesi > 0.001).any(axis=1)].sort_values('Massimo Sharpe', ascending=False)
+st.dataframe((tabella_pesi * 100).round(2), use_container_width=True, column_config={c: st.column_config.NumberColumn(c, format="%.2f%%") for c in tabella_pesi.columns})
+
+# --- SEZIONE 3: RIBILANCIAMENTO ---
+st.header("Ribilanciamento Suggerito")
+opzioni_obiettivo = [nome for nome in portafogli if nome != 'Attuale']
+obiettivo = st.radio("Portafoglio obiettivo", opzioni_obiettivo, index=len(opzioni_obiettivo) - 1, horizontal=True,
+                     help="'Sequenza Guidata' usa i pesi impliciti nella lista del foglio 'appconfig': ogni comparsa di un ticker vale una quota uguale.")
+if not sequenza_guidata:
+    st.info("Aggiungi ticker in 'Sequenza Guidata' nel foglio 'appconfig' per ribilanciare verso i pesi della sessione guidata.")
+
+ribilanciamento = utils.suggerisci_ribilanciamento(valori_correnti, portafogli[obiettivo])
+ribilanciamento = ribilanciamento[ribilanciamento['Importo (€)'].abs() >= 1]
+c1, c2 = st.columns(2)
+c1.metric("Da acquistare", f"€ {ribilanciamento['Importo (€)'].clip(lower=0).sum():,.2f}")
+c2.metric("Da ridurre", f"€ {-ribilanciamento['Importo (€)'].clip(upper=0).sum():,.2f}")
+st.dataframe(ribilanciamento, use_container_width=True, column_config={
+    'Peso Attuale': st.column_config.NumberColumn(format="%.2f"),
+    'Peso Obiettivo': st.column_config.NumberColumn(format="%.2f"),
+    'Differenza': st.column_config.NumberColumn(format="%.3f"),
+    'Importo (€)': st.column_config.NumberColumn(format="€ %.2f"),
+})
@@ -0,0 +1,73 @@
+# pages/7_Attribuzione_Performance.py
+
+import streamlit as st
+import pandas as pd
+import plotly.graph_objects as go
+import utils
+
+st.set_page_config(page_title="Attribuzione Performance", layout="wide")
+st.title("Attribuzione della Performance per Titolo")
+
+utils.check_data_loaded()
+username = st.session_state.get('current_user')
+df_original = st.session_state.df
+
+with st.spinner("Calcolo dei valori per posizione..."):
+    posizioni = utils.calcola_valori_posizioni(df_original[utils.COLONNE_VALUTAZIONE], username)
+
+if not len(posizioni['date']):
+    st.error("Impossibile calcolare l'attribuzione: nessun prezzo storico disponibile per i titoli in portafoglio.")
+    st.stop()
+if posizioni['ticker_mancanti']:
+    st.warning(f"Prezzi non disponibili per: {', '.join(posizioni['ticker_mancanti'])}. L'attribuzione li esclude.")
+
+FREQUENZE = {"Settimana": 'W', "Mese": 'M', "Trimestre": 'Q'}
+
+@utils.frammento
+def mostra_attribuzione(posizioni):
+    """Scomposizione della variazione di valore in acquisti e contributi di mercato per ticker nell'intervallo scelto."""
+    prima_data, ultima_data = posizioni['date'][0].date(), posizioni['date'][-1].date()
+    col_date, col_n, col_freq = st.columns([3, 1, 1])
+    inizio, fine = col_date.slider("Intervallo", min_value=prima_data, max_value=ultima_data, value=(prima_data, ultima_data), format="DD/MM/YYYY")
+    top_n = col_n.number_input("Titoli da mostrare", min_value=3, max_value=50, value=10)
+    frequenza = col_freq.selectbox("Raggruppa per", list(FREQUENZE), index=1)
+
+    attribuzione = utils.attribuzione_periodo(posizioni, inizio, fine)
+    if attribuzione.empty:
+        st.info("Nessun giorno di borsa nell'intervallo selezionato.")
+        return
+    totali = attribuzione.sum()
+
+    c1, c2, c3, c4, c5 = st.columns(5)
+    c1.metric("Valore Iniziale", f"€ {totali['Valore Iniziale']:,.2f}")
+    c2.metric("Acquisti", f"€ {totali['Acquisti']:,.2f}")
+    c3.metric("Contributo di Mercato", f"€ {totali['Contributo']:,.2f}")
+    c4.metric("Valore Finale", f"€ {totali['Valore Finale']:,.2f}")
+    c5.metric("Dividendi Incassati", f"€ {totali['Dividendi']:,.2f}", help="Liquidità incassata negli stacchi dell'intervallo: non è inclusa nel valore.")
+
+    # --- CASCATA: valore iniziale + acquisti + contributi dei titoli principali = valore finale ---
+    migliori, peggiori = utils.top_contributori(attribuzione, top_n)
+    principali = pd.concat([migliori, peggiori[~peggiori.index.isin(migliori.index)]]).sort_values('Contributo', ascending=False)
+    altri = totali['Contributo'] - principali['Contributo'].sum()
+    etichette = ["Valore Iniziale", "Acquisti"] + principali.index.tolist() + ["Altri", "Valore Finale"]
+    valori = [totali['Valore Iniziale'], totali['Acquisti']] + principali['Contributo'].tolist() + [altri, totali['Valore Finale']]
+    misure = ["absolute", "relative"] + ["relative"] * (len(principali) + 1) + ["total"]
+    fig_cascata = go.Figure(go.Waterfall(x=etichette, y=valori, measure=misure, connector={"line": {"color": "rgb(150,150,150)"}}))
+    fig_cascata.update_layout(title=f"Dal {inizio.strftime('%d/%m/%Y')} al {fine.strftime('%d/%m/%Y')}", yaxis_title="Valore (€)", showlegend=False)
+    st.plotly_chart(fig_cascata, use_container_width=True)
+
+    # --- CONTRIBUTI PER PERIODO DEI TITOLI PRINCIPALI ---
+    per_periodo = utils.contributi_per_periodo(posizioni, inizio, fine, FREQUENZE[frequenza])
+    colonne_principali = [t for t in principali.index if t in per_periodo.columns]
+    per_periodo_grafico = per_periodo[colonne_principali].copy()
+    per_periodo_grafico['Altri'] = per_periodo.drop(columns=colonne_principali).sum(axis=1)
+    etichette_periodo = per_periodo_grafico.index.strftime('%d/%m/%Y' if FREQUENZE[frequenza] == 'W' else '%m/%Y')
+    fig_periodi = go.Figure([go.Bar(x=etichette_periodo, y=per_periodo_grafico[c], name=c) for c in per_periodo_grafico.columns])
+    fig_periodi.update_layout(barmode='relative', title=f"Contributo per {frequenza.lower()}", yaxis_title="Contributo (€)")
+    st.plotly_chart(fig_periodi, use_container_width=True)
+
+    st.subheader("Dettaglio per titolo")
+    tabella = attribuzione[(attribuzione.abs() > 0.005).any(axis=1)].sort_values('Contributo', ascending=False)
+    st.dataframe(tabella.round(2), use_container_width=True, column_config={c: st.column_config.NumberColumn(c, format="€ %.2f") for c in tabella.columns})
+
+mostra_attribuzione(posizioni)
@@ -0,0 +1,116 @@
+# pages/8_Vista_Nucleo_Familiare.py
+
+import streamlit as st
+import plotly.graph_objects as go
+import utils
+
+st.set_page_config(page_title="Vista Nucleo Familiare", layout="wide")
+st.title("Vista Aggregata del Nucleo Familiare")
+
+utils.check_data_loaded()
+username = st.session_state.get('current_user')
+
+utenti = utils.utenti_collegati(username)
+if len(utenti) < 2:
+    st.info("Nessun utente collegato al tuo profilo. Per abilitare la vista aggregata aggiungi "
+            "`utenti_collegati = [\"...\"]` alla tua voce in `database.users` dei secrets.")
+    st.stop()
+
+st.sidebar.header("Nucleo Familiare")
+selezionati = st.sidebar.multiselect("Utenti inclusi", utenti, default=utenti)
+if not selezionati:
+    st.warning("Seleziona almeno un utente."); st.stop()
+
+with st.spinner("Caricamento dei dati degli utenti collegati..."):
+    nucleo = utils.carica_nucleo(selezionati)
+for utente, errore in nucleo['errori'].items():
+    st.warning(f"Dati di '{utente}' non disponibili: {errore}")
+df_nucleo = nucleo['portafoglio']
+if df_nucleo.empty:
+    st.error("Nessun portafoglio caricato per gli utenti selezionati."); st.stop()
+
+# --- SEZIONE 1: PORTAFOGLIO COMBINATO ---
+st.header("Portafoglio Combinato")
+costo_totale = df_nucleo['Cost Base'].sum()
+valore_totale = df_nucleo['Valore Titoli Real'].sum()
+guadagno = valore_totale - costo_totale
+c1, c2, c3 = st.columns(3)
+c1.metric("Valore Attuale", f"€ {valore_totale:,.2f}")
+c2.metric("Costo Totale", f"€ {costo_totale:,.2f}")
+c3.metric("Guadagno/Perdita", f"€ {guadagno:,.2f}", f"{guadagno / costo_totale * 100:.2f}%" if costo_totale > 0 else None)
+
+per_utente = df_nucleo.groupby('Utente')[['Cost Base', 'Valore Titoli Real']].sum()
+per_utente['Guadagno/Perdita'] = per_utente['Valore Titoli Real'] - per_utente['Cost Base']
+per_utente['Peso'] = per_utente['Valore Titoli Real'] / valore_totale if valore_totale > 0 else 0.0
+st.dataframe(per_utente, use_container_width=True, column_config={
+    'Cost Base': st.column_config.NumberColumn(format="€ %.2f"),
+    'Valore Titoli Real': st.column_config.NumberColumn("Valore Attuale", format="€ %.2f"),
+    'Guadagno/Perdita': st.column_config.NumberColumn(format="€ %.2f"),
+    'Peso': st.column_config.ProgressColumn(format="%.2f", min_value=0, max_value=1),
+})
+
+@utils.frammento
+def mostra_allocazione_nucleo(df_nucleo):
+    """Treemap per ticker con la quota di ciascun utente."""
+    import plotly.express as px  # import differito, come nelle altre pagine
+    alloc_df = df_nucleo.groupby(['Ticker', 'Utente'])['Valore Titoli Real'].sum().reset_index()
+    alloc_df = alloc_df[alloc_df['Valore Titoli Real'] > 0]
+    fig = px.treemap(alloc_df, path=['Ticker', 'Utente'], values='Valore Titoli Real', title='Allocazione Combinata per Ticker e Utente',
+                     color_discrete_sequence=px.colors.qualitative.Pastel)
+    fig.update_traces(textinfo='label+percent root')
+    st.plotly_chart(fig, use_container_width=True)
+
+@utils.frammento
+def mostra_andamento_nucleo(df_nucleo):
+    """Costo cumulativo e valore storico del portafoglio combinato (un solo download per i ticker in comune)."""
+    df_costo = df_nucleo.sort_values('Data Acquisto')
+    with st.spinner("Calcolo del valore storico combinato..."):
+        andamento = utils.calcola_valore_e_dividendi(df_nucleo[utils.COLONNE_VALUTAZIONE])
+    if andamento.attrs.get('ticker_mancanti'):
+        st.caption(f"Prezzi non disponibili (esclusi dal valore): {', '.join(andamento.attrs['ticker_mancanti'])}")
+    fig = go.Figure()
+    fig.add_trace(go.Scatter(x=df_costo['Data Acquisto'], y=df_costo['Cost Base'].cumsum(), mode='lines', name='Costo Cumulativo',
+                             line=dict(color='royalblue', shape='hv')))
+    if not andamento.empty:
+        fig.add_trace(go.Scatter(x=andamento.index, y=andamento['Valore'], mode='lines', name='Valore Reale Combinato',
+                                 line=dict(color='green', shape='spline'), fill='tozeroy', fillcolor='rgba(0,255,0,0.1)'))
+    fig.update_layout(title="Andamento del Costo vs. Valore Reale Combinato", yaxis_title="Valore (€)",
+                      legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01))
+    st.plotly_chart(fig, use_container_width=True)
+
+mostra_allocazione_nucleo(df_nucleo)
+mostra_andamento_nucleo(df_nucleo)
+
+# --- SEZIONE 2: CASH FLOW COMBINATO ---
+st.header("Cash Flow Combinato")
+cubo = nucleo['cubo']
+if not cubo or cubo['mensile'].empty:
+    st.info("Nessun dato di cash flow per gli utenti selezionati.")
+else:
+    mensile = cubo['mensile']
+    anno = st.selectbox("Anno", cubo['anni'])
+    dell_anno = mensile[mensile.index.year == anno]
+    entrate, uscite = dell_anno[('Complessivo', 'Entrate')], dell_anno[('Complessivo', 'Uscite')]
+    risparmio = entrate.sum() - uscite.sum()
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric("Entrate Totali", f"€ {entrate.sum():,.2f}")
+    k2.metric("Uscite Totali", f"€ {uscite.sum():,.2f}")
+    k3.metric("Risparmio Netto", f"€ {risparmio:,.2f}")
+    k4.metric("Tasso di Risparmio", f"{risparmio / entrate.sum() * 100:.1f}%" if entrate.sum() > 0 else "0.0%")
+
+    etichette = [utils.formatta_mese_ita(m) for m in dell_anno.index]
+    fig_cf = go.Figure([
+        go.Bar(x=etichette, y=entrate, name='Entrate', marker_color='seagreen'),
+        go.Bar(x=etichette, y=uscite, name='Uscite', marker_color='indianred'),
+    ])
+    fig_cf.add_trace(go.Scatter(x=etichette, y=entrate - uscite, mode='lines+markers', name='Risparmio', line=dict(color='black')))
+    fig_cf.update_layout(barmode='group', title=f"Entrate e Uscite Mensili del Nucleo ({anno})", yaxis_title="Importo (€)")
+    st.plotly_chart(fig_cf, use_container_width=True)
+
+    if 'Macro USCITE' in mensile.columns.get_level_values(0):
+        uscite_macro = dell_anno['Macro USCITE'].sum()
+        uscite_macro = uscite_macro[uscite_macro > 0].sort_values(ascending=True)
+        if not uscite_macro.empty:
+            fig_macro = go.Figure(go.Bar(x=uscite_macro.values, y=uscite_macro.index, orientation='h', marker_color='indianred'))
+            fig_macro.update_layout(title=f"Uscite per Macro Categoria ({anno})", xaxis_title="Importo (€)")
+            st.plotly_chart(fig_macro, use_container_width=True)
@@ -0,0 +1,129 @@
+# pages/9_Scenari_Patrimonio.py
+
+import streamlit as st
+import pandas as pd
+import numpy as np
+import plotly.graph_objects as go
+import utils
+
+st.set_page_config(page_title="Scenari Patrimonio", layout="wide")
+st.title("Proiezione del Patrimonio per Scenari")
+
+utils.check_data_loaded()
+username = st.session_state.get('current_user')
+df_original = st.session_state.df
+
+# --- DATI DI PARTENZA: cash flow mensile, portafoglio attuale e covarianze storiche ---
+config, _ = utils.carica_configurazione_da_foglio(username)
+cubo_dettaglio = utils.load_cash_flow_data(username, config) if config else {}
+entrate_storico, uscite_storico, _ = utils.load_historical_totals(username)
+cubo = utils.unisci_storico_al_cubo(cubo_dettaglio, entrate_storico, uscite_storico)
+base = utils.base_scenari(utils.entrate_uscite_complessive(cubo['mensile']))
+if not base['mesi']:
+    st.warning("Nessuna entrata trovata in 'IN/OUT' o 'Storico': inserisci a mano le entrate mensili nei parametri.")
+
+valori_correnti = df_original.groupby('Ticker')['Valore Titoli Real'].sum()
+valori_correnti = valori_correnti[valori_correnti > 0]
+valore_portafoglio = float(valori_correnti.sum())
+sequenza_guidata = config.get("Sequenza Guidata", []) if config else []
+
+with st.spinner("Stima delle covarianze storiche..."):
+    correlazioni = utils.calcola_correlazioni(df_original[utils.COLONNE_VALUTAZIONE], username)
+covarianza = correlazioni.get('covarianza') if correlazioni else None
+
+st.caption(f"Base: entrate medie di € {base['entrate_mensili']:,.0f} e uscite di € {base['uscite_mensili']:,.0f} al mese "
+           f"(ultimi {base['mesi']} mesi con entrate), portafoglio attuale di € {valore_portafoglio:,.0f}. "
+           "Ogni scenario estrae tasso di risparmio, rendimento atteso e inflazione dagli intervalli scelti e un percorso "
+           "di mercato casuale con le covarianze storiche dei titoli. I risultati passati non garantiscono quelli futuri.")
+
+# --- RIPARTIZIONE DEI CONTRIBUTI ---
+with st.expander("Ripartizione dei nuovi contributi", expanded=False):
+    tickers = valori_correnti.index.union(pd.Index(sequenza_guidata))
+    pesi_default = utils.pesi_da_sequenza(sequenza_guidata, tickers) if sequenza_guidata else valori_correnti / valore_portafoglio
+    st.caption("Predefinita: i pesi impliciti nella 'Sequenza Guidata' di 'appconfig' (altrimenti i pesi attuali). "
+               "I contributi sono investiti ogni mese con questa ripartizione e il comparto viene ribilanciato.")
+    ripartizione = st.data_editor(pd.DataFrame({'Peso (%)': (pesi_default.reindex(tickers).fillna(0.0) * 100).round(2)}),
+                                  use_container_width=True, key="ripartizione_contributi",
+                                  column_config={'Peso (%)': st.column_config.NumberColumn(min_value=0.0, max_value=100.0, format="%.2f")})
+pesi_contributi = ripartizione['Peso (%)'].clip(lower=0).fillna(0.0)
+if pesi_contributi.sum() <= 0:
+    st.error("La ripartizione dei contributi deve avere almeno un peso positivo."); st.stop()
+pesi = pd.DataFrame({'Attuale': valori_correnti / valore_portafoglio if valore_portafoglio > 0 else 0.0,
+                     'Contributi': pesi_contributi / pesi_contributi.sum()}).fillna(0.0)
+
+def covarianza_dei_comparti(volatilita_manuale):
+    """Covarianza 2 × 2 (portafoglio attuale, contributi); senza storico per un comparto si usa la volatilità manuale."""
+    if covarianza is None:
+        return np.full((2, 2), volatilita_manuale ** 2)
+    coperti = pesi.reindex(covarianza.index).sum()
+    cov = utils.covarianza_comparti(pesi, covarianza)
+    for i, comparto in enumerate(pesi.columns):
+        if coperti[comparto] <= 0:
+            cov[i, :] = cov[:, i] = 0.0
+            cov[i, i] = volatilita_manuale ** 2
+    return cov
+
+@utils.frammento
+def mostra_proiezione():
+    """Parametri e fan chart: i cursori rieseguono solo questo frammento e la simulazione (in cache) su tutti gli scenari."""
+    c1, c2, c3, c4 = st.columns(4)
+    anni = c1.slider("Orizzonte (anni)", 1, 40, 20)
+    n_scenari = c2.select_slider("Scenari", options=[1000, 2000, 5000, 10000], value=5000)
+    entrate_mensili = c3.number_input("Entrate mensili (€)", min_value=0.0, value=round(base['entrate_mensili'], 2), step=100.0)
+    liquidita = c4.number_input("Liquidità attuale (€)", min_value=0.0, value=0.0, step=1000.0, help="Conti e risparmi fuori dal portafoglio titoli.")
+
+    tasso_storico = int(round(np.clip(base['tasso_risparmio'], -0.45, 0.85) * 100))
+    c1, c2, c3, c4 = st.columns(4)
+    risparmio = c1.slider("Tasso di risparmio (%)", -50, 90, (tasso_storico - 5, tasso_storico + 5), help=f"Storico recente: {base['tasso_risparmio']:.1%} delle entrate.")
+    quota_investita = c2.slider("Quota del risparmio investita (%)", 0, 100, 80, help="Il resto resta liquidità a rendimento nullo.")
+    rendimento = c3.slider("Rendimento annuo atteso (%)", -5.0, 15.0, (3.0, 8.0), step=0.5)
+    inflazione = c4.slider("Inflazione annua (%)", 0.0, 10.0, (1.5, 3.5), step=0.25)
+
+    c1, c2, c3 = st.columns(3)
+    in_euro_di_oggi = c1.toggle("Valori in euro di oggi", value=True, help="Deflaziona con l'inflazione di ciascuno scenario.")
+    obiettivo = c2.number_input("Obiettivo di patrimonio (€ di oggi)", min_value=0.0, value=round(max(valore_portafoglio, 1.0) * 2, -3), step=10000.0)
+    volatilita_manuale = 0.15
+    if covarianza is None or (pesi.reindex(covarianza.index).sum() <= 0).any():
+        volatilita_manuale = c3.number_input("Volatilità annua dei titoli senza storico (%)", 1.0, 60.0, 15.0) / 100
+
+    intervalli = (('Tasso Risparmio', risparmio[0] / 100, risparmio[1] / 100), ('Rendimento', rendimento[0] / 100, rendimento[1] / 100),
+                  ('Inflazione', inflazione[0] / 100, inflazione[1] / 100))
+    cov = covarianza_dei_comparti(volatilita_manuale)
+    risultato = utils.proietta_patrimonio(valore_portafoglio, liquidita, entrate_mensili, tuple(map(tuple, cov.tolist())),
+                                          intervalli, quota_investita / 100, anni * 12, n_scenari)
+
+    # --- FAN CHART DEI PERCENTILI ---
+    percentili = dict(zip(risultato['percentili'], risultato['reale' if in_euro_di_oggi else 'nominale']))
+    mesi = pd.period_range(pd.Timestamp.today(), periods=anni * 12 + 1, freq='M').to_timestamp()
+    fig = go.Figure()
+    for basso, alto, opacita in ((5, 95, 0.15), (25, 75, 0.3)):
+        fig.add_trace(go.Scatter(x=mesi, y=percentili[alto], mode='lines', line=dict(width=0), showlegend=False, hoverinfo='skip'))
+        fig.add_trace(go.Scatter(x=mesi, y=percentili[basso], mode='lines', line=dict(width=0), fill='tonexty',
+                                 fillcolor=f'rgba(46,139,87,{opacita})', name=f"{basso}°–{alto}° percentile"))
+    fig.add_trace(go.Scatter(x=mesi, y=percentili[50], mode='lines', name='Mediana', line=dict(color='seagreen', width=3)))
+    if in_euro_di_oggi and obiettivo > 0:
+        fig.add_hline(y=obiettivo, line_dash='dash', line_color='gray', annotation_text='Obiettivo')
+    fig.update_layout(title=f"Patrimonio netto su {n_scenari:,} scenari ({'euro di oggi' if in_euro_di_oggi else 'nominale'})",
+                      yaxis_title="Patrimonio (€)", hovermode='x unified', height=520)
+    st.plotly_chart(fig, use_container_width=True)
+
+    finale = risultato['finale_reale']
+    k1, k2, k3, k4 = st.columns(4)
+    k1.metric("Mediana finale (€ di oggi)", f"€ {np.median(finale):,.0f}")
+    k2.metric("Scenario sfavorevole (5°)", f"€ {np.percentile(finale, 5):,.0f}")
+    k3.metric("Scenario favorevole (95°)", f"€ {np.percentile(finale, 95):,.0f}")
+    k4.metric("Probabilità obiettivo", f"{(finale >= obiettivo).mean():.0%}" if obiettivo > 0 else "—")
+
+    # --- SENSIBILITÀ: patrimonio finale per fascia di ciascun parametro ---
+    with st.expander("Sensibilità ai parametri"):
+        campioni = risultato['campioni']
+        colonne = st.columns(len(campioni))
+        for colonna, (nome, valori) in zip(colonne, campioni.items()):
+            fasce = pd.qcut(valori, 5, duplicates='drop')
+            mediane = pd.Series(finale).groupby(fasce, observed=True).median()
+            etichette = [f"{i.left:.1%}–{i.right:.1%}" for i in mediane.index]
+            fig_s = go.Figure(go.Bar(x=etichette, y=mediane.values, marker_color='seagreen'))
+            fig_s.update_layout(title=f"Mediana finale per {nome}", yaxis_title="€ di oggi", height=320, margin=dict(t=40, b=0))
+            colonna.plotly_chart(fig_s, use_container_width=True)
+
+mostra_proiezione()
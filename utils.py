@@ -1,11 +1,26 @@
 # utils.py
 import streamlit as st
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 import pandas as pd
 import numpy as np
 import json
-import yfinance as yf
+import hashlib
+import heapq
+import itertools
+import os
+import re
+import threading
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+# yfinance, gspread e oauth2client costano centinaia di millisecondi all'import: sono importati al primo uso,
+# così le pagine che non scaricano prezzi o non leggono fogli non ne pagano il costo all'avvio.
+def _yfinance():
+    import yfinance
+    return yfinance
+
+# Decoratore per i frammenti con riesecuzione indipendente (st.fragment dalle versioni più recenti di Streamlit)
+frammento = getattr(st, 'fragment', None) or st.experimental_fragment
 
 # --- FUNZIONI DI CONNESSIONE E DI UTILITÀ GENERICA ---
 def get_gspread_client_for_user(user_creds):
@@ -17,6 +32,8 @@ def get_gspread_client_for_user(user_creds):
     try:
         if not isinstance(user_creds, dict): 
             user_creds = dict(user_creds)
+        import gspread
+        from oauth2client.service_account import ServiceAccountCredentials
         creds = ServiceAccountCredentials.from_json_keyfile_dict(user_creds, scope)
         client = gspread.authorize(creds)
         return client
@@ -30,16 +47,281 @@ def check_data_loaded():
         st.warning("Dati non caricati. Effettua il login dalla Dashboard Generale.")
         st.stop()
 
-def clean_ticker_for_yf(ticker_series: pd.Series) -> pd.Series:
-    """Converte i ticker dal formato 'BIT:...' a quello di yfinance '....MI'."""
-    exchange_map = {'BIT': '.MI', 'ETR': '.DE', 'LSE': '.L', 'AMS': '.AS'}
-    def convert_ticker(ticker):
-        if ':' in ticker:
-            prefix, symbol = ticker.split(':', 1)
-            suffix = exchange_map.get(prefix.upper())
-            if suffix: return f"{symbol}{suffix}"
-        return ticker
-    return ticker_series.apply(convert_ticker)
+# --- CACHE PER UTENTE E PER DATASET (invalidazione mirata e metriche) ---
+DATASET_UTENTE = ('Holding', 'appconfig', 'IN/OUT', 'Storico', 'valutazione')
+
+@st.cache_resource
+def _stato_cache_dataset() -> dict:
+    """Versione corrente per (utente, dataset) e contatori per dataset, condivisi tra tutte le sessioni."""
+    return {
+        'lock': threading.Lock(),
+        'versioni': {},
+        'metriche': {dataset: {'richieste': 0, 'miss': 0, 'invalidazioni': 0} for dataset in DATASET_UTENTE},
+    }
+
+def versione_dataset(username: str, dataset: str) -> int:
+    """Versione della cache di un dataset per un utente: entra nella chiave delle funzioni in cache."""
+    return _stato_cache_dataset()['versioni'].get((username, dataset), 0)
+
+def _richiedi_dataset(dataset: str, username: str) -> int:
+    """Conta una richiesta al dataset e restituisce la versione da passare alla funzione in cache."""
+    stato = _stato_cache_dataset()
+    with stato['lock']:
+        stato['metriche'][dataset]['richieste'] += 1
+        return stato['versioni'].get((username, dataset), 0)
+
+def _registra_miss(dataset: str):
+    """Chiamata dal corpo delle funzioni in cache: viene eseguita solo quando il dato non è in cache."""
+    stato = _stato_cache_dataset()
+    with stato['lock']:
+        stato['metriche'][dataset]['miss'] += 1
+
+def invalida_cache_utente(username: str, datasets=None):
+    """
+    Invalida solo le voci in cache di un utente per i dataset indicati (tutti se None).
+    Le altre sessioni e i prezzi condivisi restano in cache; le voci superate scadono con il loro TTL.
+    """
+    stato = _stato_cache_dataset()
+    with stato['lock']:
+        for dataset in datasets or DATASET_UTENTE:
+            stato['versioni'][(username, dataset)] = stato['versioni'].get((username, dataset), 0) + 1
+            stato['metriche'][dataset]['invalidazioni'] += 1
+
+def metriche_cache() -> pd.DataFrame:
+    """Richieste, hit, miss e invalidazioni per dataset dall'avvio del server."""
+    stato = _stato_cache_dataset()
+    with stato['lock']:
+        metriche = pd.DataFrame.from_dict(stato['metriche'], orient='index')
+    metriche['hit'] = (metriche['richieste'] - metriche['miss']).clip(lower=0)
+    metriche['hit rate'] = (metriche['hit'] / metriche['richieste'].where(metriche['richieste'] > 0)).fillna(0)
+    return metriche[['richieste', 'hit', 'miss', 'hit rate', 'invalidazioni']]
+
+# --- SCHEDULER DELLE CHIAMATE A GOOGLE SHEETS (quota per credenziale) ---
+LIMITE_RICHIESTE_SHEETS_AL_MINUTO = 60   # quota Google per utente/service account
+PRIORITA_SCRITTURA, PRIORITA_LETTURA = 0, 1
+TENTATIVI_SHEETS = 5
+CODICI_HTTP_RIPROVABILI = (429, 500, 502, 503)
+
+@st.cache_resource
+def _scheduler_sheets() -> dict:
+    """Token bucket e coda con priorità per credenziale, più le metriche di attesa, condivisi tra le sessioni."""
+    return {
+        'condizione': threading.Condition(),
+        'bucket': {},
+        'code': {},
+        'contatore': itertools.count(),
+        'metriche': {'chiamate': 0, 'ritentativi': 0, 'attesa_totale_s': 0.0, 'attesa_max_s': 0.0},
+    }
+
+def _acquisisci_token_sheets(credenziale: str, priorita: int):
+    """Blocca finché la credenziale ha un token libero e la richiesta è la prima in coda (le scritture passano avanti)."""
+    stato = _scheduler_sheets()
+    capacita = float(LIMITE_RICHIESTE_SHEETS_AL_MINUTO)
+    biglietto = (priorita, next(stato['contatore']))
+    inizio = time.monotonic()
+    with stato['condizione']:
+        coda = stato['code'].setdefault(credenziale, [])
+        heapq.heappush(coda, biglietto)
+        while True:
+            bucket = stato['bucket'].setdefault(credenziale, {'token': capacita, 'aggiornato': inizio})
+            adesso = time.monotonic()
+            bucket['token'] = min(capacita, bucket['token'] + (adesso - bucket['aggiornato']) * capacita / 60)
+            bucket['aggiornato'] = adesso
+            if coda[0] == biglietto and bucket['token'] >= 1:
+                heapq.heappop(coda)
+                bucket['token'] -= 1
+                stato['condizione'].notify_all()
+                break
+            # Il primo in coda aspetta il prossimo token; gli altri aspettano di diventare primi
+            attesa = (1 - bucket['token']) * 60 / capacita if coda[0] == biglietto else 0.5
+            stato['condizione'].wait(timeout=attesa)
+        attesa_s = time.monotonic() - inizio
+        stato['metriche']['chiamate'] += 1
+        stato['metriche']['attesa_totale_s'] += attesa_s
+        stato['metriche']['attesa_max_s'] = max(stato['metriche']['attesa_max_s'], attesa_s)
+
+def _credenziale_utente(username: str) -> str:
+    return st.secrets.google_credentials[username].get('client_email', username)
+
+def esegui_chiamata_sheets(username: str, chiamata, scrittura: bool = False):
+    """
+    Esegue una singola chiamata all'API di Google Sheets rispettando la quota della credenziale dell'utente.
+    Le scritture hanno priorità sulle letture; errori 429/5xx vengono ritentati con backoff esponenziale e jitter.
+    """
+    from gspread.exceptions import APIError  # già caricato da get_gspread_client_for_user: import immediato
+    credenziale = _credenziale_utente(username)
+    for tentativo in range(TENTATIVI_SHEETS):
+        _acquisisci_token_sheets(credenziale, PRIORITA_SCRITTURA if scrittura else PRIORITA_LETTURA)
+        try:
+            return chiamata()
+        except APIError as e:
+            codice = getattr(getattr(e, 'response', None), 'status_code', None)
+            if codice not in CODICI_HTTP_RIPROVABILI or tentativo == TENTATIVI_SHEETS - 1: raise
+            with _scheduler_sheets()['condizione']:
+                _scheduler_sheets()['metriche']['ritentativi'] += 1
+            time.sleep(min(32, 2 ** tentativo) + random.uniform(0, 1))
+
+def metriche_scheduler_sheets() -> dict:
+    """Profondità attuale delle code, chiamate eseguite, ritentativi e tempi di attesa per il token."""
+    stato = _scheduler_sheets()
+    with stato['condizione']:
+        metriche = dict(stato['metriche'])
+        metriche['in_coda'] = sum(len(coda) for coda in stato['code'].values())
+    metriche['attesa_media_s'] = metriche['attesa_totale_s'] / metriche['chiamate'] if metriche['chiamate'] else 0.0
+    return metriche
+
+# --- LETTURA DEI FOGLI CON COALESCENZA DELLE RICHIESTE CONCORRENTI ---
+@st.cache_resource
+def _letture_fogli_in_corso() -> dict:
+    """Letture dei fogli in corso per (utente, worksheet), condivise tra i thread delle sessioni."""
+    return {'lock': threading.Lock(), 'in_corso': {}}
+
+def apri_worksheet(username: str, worksheet: str):
+    """Worksheet dell'utente (None se la connessione fallisce), senza leggerne i valori."""
+    user_config = st.secrets.database.users[username]
+    user_creds = st.secrets.google_credentials[username]
+    client = get_gspread_client_for_user(user_creds)
+    if client is None: return None
+    foglio = esegui_chiamata_sheets(username, lambda: client.open(user_config.sheet_name))
+    return esegui_chiamata_sheets(username, lambda: foglio.worksheet(worksheet))
+
+def _leggi_valori_foglio(username: str, worksheet: str):
+    sheet = apri_worksheet(username, worksheet)
+    if sheet is None: return None
+    return esegui_chiamata_sheets(username, sheet.get_all_values)
+
+def leggi_valori_foglio(username: str, worksheet: str):
+    """
+    Restituisce tutti i valori di un worksheet dell'utente (None se la connessione fallisce).
+    Le richieste concorrenti per la stessa coppia (utente, worksheet) attendono un'unica lettura in corso
+    e ne condividono il risultato (o l'eccezione), così più schede o pagine non moltiplicano le chiamate a Google.
+    """
+    return condividi_lettura((username, worksheet), lambda: _leggi_valori_foglio(username, worksheet))
+
+def condividi_lettura(chiave: tuple, leggi):
+    """Esegue `leggi()` una volta sola per le richieste concorrenti con la stessa chiave e ne condivide il risultato."""
+    stato = _letture_fogli_in_corso()
+    with stato['lock']:
+        lettura = stato['in_corso'].get(chiave)
+        capofila = lettura is None
+        if capofila:
+            lettura = {'evento': threading.Event(), 'valori': None, 'errore': None}
+            stato['in_corso'][chiave] = lettura
+
+    if not capofila:
+        lettura['evento'].wait()
+        if lettura['errore'] is not None: raise lettura['errore']
+        return lettura['valori']
+
+    try:
+        lettura['valori'] = leggi()
+        return lettura['valori']
+    except Exception as e:
+        lettura['errore'] = e
+        raise
+    finally:
+        with stato['lock']:
+            stato['in_corso'].pop(chiave, None)
+        lettura['evento'].set()
+
+# --- LETTURA A BLOCCHI: SOLO LE RIGHE E LE COLONNE NECESSARIE ---
+RIGHE_PER_BLOCCO = 2000   # righe per chiamata batch_get: limita la memoria di picco delle stringhe non ancora convertite
+
+def _tratti_contigui(indici) -> list:
+    """Tratti (primo, ultimo) di indici consecutivi di una sequenza ordinata: [1, 2, 3, 7, 8] -> [(1, 3), (7, 8)]."""
+    indici = np.asarray(indici, dtype=int)
+    if len(indici) == 0: return []
+    tagli = np.flatnonzero(np.diff(indici) != 1) + 1
+    return [(int(t[0]), int(t[-1])) for t in np.split(indici, tagli)]
+
+def leggi_blocchi_foglio(username: str, sheet, righe, colonne, righe_per_blocco: int = RIGHE_PER_BLOCCO):
+    """
+    Legge solo le celle all'incrocio di `righe` e `colonne` (indici 1-based, ordinati e senza duplicati), a blocchi di al
+    più `righe_per_blocco` righe: una chiamata batch_get per blocco, con un intervallo A1 per ogni tratto contiguo di righe
+    e di colonne. Genera (righe del blocco, matrice di stringhe righe × colonne) man mano che i blocchi arrivano, così chi
+    chiama converte ogni blocco in array tipizzati e la memoria di picco non dipende dalla dimensione del foglio.
+    """
+    from gspread.utils import rowcol_to_a1  # gspread è già caricato da apri_worksheet
+    righe, tratti_colonne = np.asarray(righe, dtype=int), _tratti_contigui(colonne)
+    for inizio in range(0, len(righe), righe_per_blocco):
+        righe_blocco = righe[inizio:inizio + righe_per_blocco]
+        tratti_righe = _tratti_contigui(righe_blocco)
+        intervalli = [f"{rowcol_to_a1(r0, c0)}:{rowcol_to_a1(r1, c1)}" for r0, r1 in tratti_righe for c0, c1 in tratti_colonne]
+        risposte = iter(esegui_chiamata_sheets(username, lambda: sheet.batch_get(intervalli)))
+        # Google omette le celle vuote in coda a ogni riga e le righe vuote in coda all'intervallo: si riempie con ''
+        blocco = np.full((len(righe_blocco), len(colonne)), '', dtype=object)
+        riga_0 = 0
+        for r0, r1 in tratti_righe:
+            colonna_0 = 0
+            for c0, c1 in tratti_colonne:
+                for i, valori in enumerate(next(risposte)):
+                    blocco[riga_0 + i, colonna_0:colonna_0 + len(valori)] = valori
+                colonna_0 += c1 - c0 + 1
+            riga_0 += r1 - r0 + 1
+        yield righe_blocco, blocco
+
+# --- REGISTRO PERSISTENTE DEI SIMBOLI YAHOO ---
+# Suffissi Yahoo per i prefissi di borsa usati nel foglio (stile Google Finance 'BORSA:SIMBOLO').
+SUFFISSI_BORSA_YF = {
+    'BIT': '.MI', 'MIL': '.MI', 'ETR': '.DE', 'XETRA': '.DE', 'XETR': '.DE', 'FRA': '.F',
+    'LSE': '.L', 'LON': '.L', 'AMS': '.AS', 'EPA': '.PA', 'EBR': '.BR', 'ELI': '.LS',
+    'BME': '.MC', 'SWX': '.SW', 'VIE': '.VI', 'STO': '.ST', 'HEL': '.HE', 'CPH': '.CO', 'OSL': '.OL',
+    'TSE': '.TO', 'NYSE': '', 'NASDAQ': '', 'NYSEARCA': '', 'NYSEAMERICAN': '', 'AMEX': '', 'BATS': '',
+}
+PERCORSO_REGISTRO_SIMBOLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'registro_simboli.json')
+_LOCK_REGISTRO_SIMBOLI = threading.Lock()
+
+@st.cache_resource
+def _registro_simboli() -> dict:
+    """
+    Registro condiviso tra sessioni e salvato su disco:
+    'valute' (simbolo -> valuta di quotazione) e 'non_disponibili' (simbolo -> timestamp fino al quale non va richiesto).
+    """
+    registro = {'valute': {}, 'non_disponibili': {}}
+    try:
+        with open(PERCORSO_REGISTRO_SIMBOLI, encoding='utf-8') as f:
+            salvato = json.load(f)
+        for chiave in registro:
+            registro[chiave].update(salvato.get(chiave, {}))
+    except (OSError, ValueError):
+        pass
+    return registro
+
+def salva_registro_simboli():
+    """
+    Scrive il registro dei simboli su disco (scrittura atomica, un thread alla volta).
+    Si serializza una copia presa sotto il lock: le modifiche al registro avvengono solo con _LOCK_REGISTRO_SIMBOLI.
+    """
+    with _LOCK_REGISTRO_SIMBOLI:
+        dati = {chiave: dict(valori) for chiave, valori in _registro_simboli().items()}
+        try:
+            os.makedirs(os.path.dirname(PERCORSO_REGISTRO_SIMBOLI), exist_ok=True)
+            percorso_tmp = f"{PERCORSO_REGISTRO_SIMBOLI}.tmp"
+            with open(percorso_tmp, 'w', encoding='utf-8') as f:
+                json.dump(dati, f)
+            os.replace(percorso_tmp, PERCORSO_REGISTRO_SIMBOLI)
+        except OSError:
+            pass  # il registro è solo una cache: se il disco non è scrivibile si lavora in memoria
+
+def converti_simbolo_yf(ticker: str, sostituzioni: dict = None) -> str:
+    """Converte un ticker del foglio ('BIT:ENI', 'NYSE:BRK.B') nel simbolo Yahoo ('ENI.MI', 'BRK-B')."""
+    ticker = str(ticker).strip()
+    if sostituzioni and ticker in sostituzioni: return sostituzioni[ticker]
+    if ':' in ticker:
+        prefix, symbol = ticker.split(':', 1)
+        suffix = SUFFISSI_BORSA_YF.get(prefix.strip().upper())
+        if suffix == '': return symbol.replace('.', '-')  # borse USA: Yahoo usa '-' per le classi di azioni
+        if suffix: return f"{symbol}{suffix}"
+    return ticker
+
+def clean_ticker_for_yf(ticker_series: pd.Series, sostituzioni: dict = None) -> pd.Series:
+    """
+    Converte i ticker dal formato 'BIT:...' a quello di yfinance '....MI'.
+    La conversione avviene una volta per ticker unico e viene applicata con un unico `map`;
+    `sostituzioni` (da 'appconfig') ha la precedenza sulle regole di borsa.
+    """
+    mappa = {ticker: converti_simbolo_yf(ticker, sostituzioni) for ticker in pd.unique(ticker_series)}
+    return ticker_series.map(mappa)
 
 def valida_e_converti_numero(testo_numero):
     """Converte in sicurezza una stringa (con virgola o punto) in un numero float."""
@@ -49,25 +331,102 @@ def valida_e_converti_numero(testo_numero):
     except (ValueError, TypeError):
         return None
 
+MAPPA_MESI_ITA_NUM = {'GEN': 1, 'FEB': 2, 'MAR': 3, 'APR': 4, 'MAG': 5, 'GIU': 6, 'LUG': 7, 'AGO': 8, 'SET': 9, 'OTT': 10, 'NOV': 11, 'DIC': 12}
+MESI_ITA = list(MAPPA_MESI_ITA_NUM.keys())
+
+def parse_mesi_ita(etichette) -> pd.PeriodIndex:
+    """Converte etichette 'MMM/YYYY' con mesi in italiano (es. 'GEN/2024') in un PeriodIndex mensile (NaT se non valide)."""
+    parti = pd.Series(list(etichette), dtype=object).astype(str).str.strip().str.upper().str.split('/', n=1, expand=True)
+    if parti.shape[1] < 2: return pd.PeriodIndex([pd.NaT] * len(parti), freq='M')
+    mese = parti[0].str.strip().map(MAPPA_MESI_ITA_NUM)
+    anno = pd.to_numeric(parti[1].str.strip(), errors='coerce')
+    date = pd.to_datetime({'year': anno, 'month': mese, 'day': 1}, errors='coerce')
+    return pd.PeriodIndex(date.dt.to_period('M'))
+
+def indicizza_per_mese(serie: pd.Series) -> pd.Series:
+    """Reindicizza una serie con etichette 'MMM/YYYY' su un PeriodIndex mensile ordinato."""
+    serie = pd.Series(serie.to_numpy(), index=parse_mesi_ita(serie.index), dtype=float)
+    return serie[serie.index.notna()].groupby(level=0).sum()
+
+def formatta_mese_ita(periodo: pd.Period) -> str:
+    """Etichetta 'MMM/YYYY' in italiano per un Period mensile (inverso di parse_mesi_ita)."""
+    return f"{MESI_ITA[periodo.month - 1]}/{periodo.year}"
+
+def converti_importi(dati):
+    """Converte in numeri gli importi testuali del foglio ('€ 1.234,56') con un'unica passata vettoriale."""
+    valori = pd.Series(np.asarray(dati, dtype=object).ravel()).astype(str)
+    valori = valori.str.replace('€', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False).str.strip()
+    numeri = pd.to_numeric(valori, errors='coerce').fillna(0).to_numpy()
+    if isinstance(dati, pd.Series): return pd.Series(numeri, index=dati.index, name=dati.name)
+    return pd.DataFrame(numeri.reshape(dati.shape), index=dati.index, columns=dati.columns)
+
 # --- FUNZIONI PER IL CARICAMENTO DATI DEL PORTAFOGLIO ('Holding') ---
-@st.cache_data(ttl=600)
+RIGA_INTESTAZIONE_HOLDING = 3
+COLONNE_ESSENZIALI_HOLDING = ['Stock / ETF Ticker Symbol', 'Data Acquisto', 'Investment Category']
+COLONNE_NUMERICHE_HOLDING = ['n. share', 'Market Value ACQUISTO', 'Actual Market Value (google)', 'Valore Titoli Real', 'Guadagno Oggi', '% variazione', 'Cost Base', 'Trading Fees']
+COLONNE_HOLDING = COLONNE_ESSENZIALI_HOLDING + ['Nome titolo', 'ISIN'] + COLONNE_NUMERICHE_HOLDING  # le sole colonne lette
+
+def _converti_blocco_holding(blocco: np.ndarray, nomi: list) -> pd.DataFrame:
+    """Converte un blocco di righe di 'Holding' (stringhe) in colonne tipizzate, scartando righe senza ticker o data."""
+    df = pd.DataFrame(blocco, columns=nomi)
+    df = df[df['Stock / ETF Ticker Symbol'] != '']
+    for col in COLONNE_NUMERICHE_HOLDING:
+        if col in df.columns:
+            valori = df[col].str.replace('€', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False).str.replace('%', '', regex=False).str.strip()
+            df[col] = pd.to_numeric(valori, errors='coerce').fillna(0)
+    df['Data Acquisto'] = pd.to_datetime(df['Data Acquisto'], format='%d/%m/%Y', errors='coerce')
+    return df.dropna(subset=['Data Acquisto'])
+
+def leggi_holding_a_blocchi(username: str):
+    """
+    Legge da 'Holding' solo le colonne di COLONNE_HOLDING, a blocchi di righe convertiti man mano in colonne tipizzate
+    (None se la connessione fallisce). Se manca una colonna essenziale restituisce un DataFrame vuoto con le colonne
+    trovate, senza leggere le righe.
+    """
+    sheet = apri_worksheet(username, "Holding")
+    if sheet is None: return None
+    intestazione = esegui_chiamata_sheets(username, lambda: sheet.row_values(RIGA_INTESTAZIONE_HOLDING))
+    posizioni = {}
+    for i, nome in enumerate(intestazione):
+        if nome in COLONNE_HOLDING: posizioni.setdefault(nome, i + 1)  # con intestazioni duplicate vale la prima
+    if not all(col in posizioni for col in COLONNE_ESSENZIALI_HOLDING): return pd.DataFrame(columns=list(posizioni))
+    colonne = sorted(posizioni.values())
+    nomi = [intestazione[c - 1] for c in colonne]
+    righe = np.arange(RIGA_INTESTAZIONE_HOLDING + 1, sheet.row_count + 1)
+    blocchi = [_converti_blocco_holding(blocco, nomi) for _, blocco in leggi_blocchi_foglio(username, sheet, righe, colonne)]
+    return pd.concat(blocchi, ignore_index=True) if blocchi else pd.DataFrame(columns=nomi)
+
 def load_and_clean_data(username: str):
-    """Carica e pulisce i dati del portafoglio dal foglio 'Holding'."""
+    """Carica e pulisce i dati del portafoglio dal foglio 'Holding', completati con la configurazione attuale di 'appconfig'."""
+    config, _ = carica_configurazione_da_foglio(username)
+    return completa_holding(carica_holding_foglio(username), config)
+
+def carica_holding_foglio(username: str):
+    """Dati di 'Holding' come nel foglio, in cache per versione del dataset: è questo che va negli snapshot su disco."""
+    return _load_and_clean_data(username, versione=_richiedi_dataset('Holding', username))
+
+def completa_holding(df: pd.DataFrame, config: dict) -> pd.DataFrame:
+    """
+    Aggiunge le colonne che dipendono da 'appconfig' (simbolo Yahoo con le 'Simboli Yahoo', lotti con il 'Metodo Carico').
+    Sono calcolate fuori dalla cache e dagli snapshot di 'Holding', così una modifica ad 'appconfig' vale senza rileggere il foglio.
+    """
+    if df.empty: return df
+    config = config or {}
+    # Costo delle quote vendute, PMC e P/L realizzato dal motore dei lotti; il 'Cost Base' di una vendita diventa
+    # il costo (negativo) dei lotti chiusi, quindi la somma di 'Cost Base' è il costo di carico delle quote ancora possedute
+    vendite = df['Tipo Transazione'] == 'Vendita'
+    df = df.join(calcola_lotti(df, config.get('Metodo Carico', 'FIFO')))
+    df['Importo Operazione'] = df['Cost Base'].where(~vendite, -df['Ricavo Vendita'])
+    df.loc[vendite, 'Cost Base'] = -df.loc[vendite, 'Costo Venduto']
+    df['yf_ticker'] = clean_ticker_for_yf(df['Ticker'], config.get('Simboli Yahoo'))
+    return df
+
+@st.cache_data(ttl=600)
+def _load_and_clean_data(username: str, versione: int = 0):
+    _registra_miss('Holding')
     try:
-        user_config = st.secrets.database.users[username]
-        user_creds = st.secrets.google_credentials[username]
-        google_sheet_name = user_config.sheet_name
-        client = get_gspread_client_for_user(user_creds)
-        if client is None: return pd.DataFrame()
-
-        sheet = client.open(google_sheet_name).worksheet("Holding")
-        all_values = sheet.get_all_values()
-        if len(all_values) < 4: return pd.DataFrame()
-        headers = all_values[2]
-        data_rows = all_values[3:]
-        df = pd.DataFrame(data_rows, columns=headers)
-        df = df.loc[:, df.columns.notna() & (df.columns != '')]
-        df = df.loc[:, ~df.columns.duplicated(keep='first')]
+        df = condividi_lettura((username, "Holding", "blocchi"), lambda: leggi_holding_a_blocchi(username))
+        if df is None: return pd.DataFrame()
 
     except KeyError:
         st.error(f"Configurazione non trovata per l'utente '{username}' in st.secrets.")
@@ -76,77 +435,1421 @@ def load_and_clean_data(username: str):
         st.error(f"Errore durante il caricamento dei dati da Google Fogli: {e}")
         return pd.DataFrame()
 
-    essential_cols = ['Stock / ETF Ticker Symbol', 'Data Acquisto', 'Investment Category']
-    for col in essential_cols:
+    for col in COLONNE_ESSENZIALI_HOLDING:
         if col not in df.columns:
             st.error(f"Errore: colonna essenziale '{col}' non trovata nel foglio 'Holding'.")
             return pd.DataFrame()
+    if df.empty: return pd.DataFrame()
 
-    df = df[df['Stock / ETF Ticker Symbol'].notna() & (df['Stock / ETF Ticker Symbol'] != '')]
-    cols_to_numeric = ['n. share', 'Market Value ACQUISTO', 'Actual Market Value (google)', 'Valore Titoli Real', 'Guadagno Oggi', '% variazione', 'Cost Base', 'Trading Fees']
-    for col in cols_to_numeric:
-        if col in df.columns:
-            df[col] = df[col].astype(str).str.replace('€', '', regex=False).str.replace('.', '', regex=False).str.replace(',', '.', regex=False).str.replace('%', '', regex=False).str.strip()
-            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0)
-    
-    df['Data Acquisto'] = pd.to_datetime(df['Data Acquisto'], format='%d/%m/%Y', errors='coerce')
-    df.dropna(subset=['Data Acquisto'], inplace=True)
-    df.rename(columns={'Stock / ETF Ticker Symbol': 'Ticker', 'Actual Market Value (google)': 'Prezzo Attuale', 'Investment Category': 'Categoria', 'Nome titolo': 'Nome Titolo'}, inplace=True)
+    # Ticker, numeri e date sono già convertiti blocco per blocco da leggi_holding_a_blocchi
+    df = df.rename(columns={'Stock / ETF Ticker Symbol': 'Ticker', 'Actual Market Value (google)': 'Prezzo Attuale', 'Investment Category': 'Categoria', 'Nome titolo': 'Nome Titolo'})
     
     if 'Categoria' in df.columns:
         conditions = [
+            df['Categoria'].str.contains('Vendita|Sell', case=False, na=False),
             df['Categoria'].str.contains('Saveback', case=False, na=False),
-            df['Categoria'].str.contains('Round-up', case=False, na=False),
+            df['Categoria'].str.contains('Round-?up', case=False, na=False),
             df['Categoria'].str.contains('Azione', case=False, na=False),
             df['Categoria'].str.contains('Bond', case=False, na=False),
             df['Categoria'].str.contains('Stocks', case=False, na=False)
         ]
-        choices = ['Saveback', 'RoundUp', 'Azione', 'Bond', 'ETF']
+        choices = ['Vendita', 'Saveback', 'RoundUp', 'Azione', 'Bond', 'ETF']
         df['Tipo Transazione'] = np.select(conditions, choices, default='Altro')
     else:
         df['Tipo Transazione'] = 'N/A'
 
     df['Cost Base Originale'] = df['Cost Base']
     df.loc[df['Tipo Transazione'].isin(['Saveback', 'RoundUp']), 'Cost Base'] = df['n. share'] * df['Market Value ACQUISTO']
+
+    # Vendite: quote negative (anche se nel foglio sono state scritte positive), così somme e cumsum delle quote restano valide
+    vendite = df['Tipo Transazione'] == 'Vendita'
+    segno_invertito = vendite & (df['n. share'] > 0)
+    for col in ('n. share', 'Valore Titoli Real', 'Guadagno Oggi'):
+        if col in df.columns: df.loc[segno_invertito, col] = -df.loc[segno_invertito, col]
+
+    return df
+
+# --- MOTORE DEI LOTTI (vendite, PMC e P/L realizzato) ---
+METODI_CARICO = ('FIFO', 'Medio')
+COLONNE_LOTTI = ['Quote Residue', 'Costo Residuo', 'PMC', 'Costo Venduto', 'Ricavo Vendita', 'P/L Realizzato', 'Quote Scoperte']
+TOLLERANZA_QUOTE = 1e-9   # sotto questa soglia (relativa) una posizione è chiusa
+
+def calcola_lotti(transazioni: pd.DataFrame, metodo: str = 'FIFO') -> pd.DataFrame:
+    """
+    Posizione dopo ogni operazione ('Quote Residue', 'Costo Residuo', 'PMC') e, per le vendite ('n. share' < 0),
+    'Costo Venduto', 'Ricavo Vendita' (quote × prezzo - commissioni) e 'P/L Realizzato', con metodo 'FIFO' o 'Medio'.
+    Le quote vendute oltre quelle possedute finiscono in 'Quote Scoperte' e non entrano nel P/L.
+
+    Un solo passaggio vettoriale su tutte le operazioni, ordinate per (ticker, data; a parità di giorno prima gli acquisti):
+      - FIFO: la coda dei lotti di un ticker è l'array delle quote e dei costi cumulati degli acquisti; le vendite
+        cumulate sono il puntatore nella coda e il costo dei lotti chiusi si ottiene con un np.interp su tutti i ticker;
+      - Medio: il costo residuo segue C_k = a_k · C_(k-1) + b_k (a_k = quota non venduta, b_k = costo acquistato),
+        risolta con cumprod/cumsum per tratto di posizione aperta.
+    Restituisce un DataFrame con lo stesso indice di `transazioni`.
+    """
+    n = len(transazioni)
+    if n == 0: return pd.DataFrame(columns=COLONNE_LOTTI, index=transazioni.index, dtype=float)
+    codici = pd.factorize(transazioni['Ticker'])[0]
+    quote = transazioni['n. share'].to_numpy(dtype=float)
+    ordine = np.lexsort((np.arange(n), quote < 0, transazioni['Data Acquisto'].to_numpy(), codici))
+    codici, quote = codici[ordine], quote[ordine]
+    vendita = quote < 0
+    costo_acquisti = np.where(vendita, 0.0, transazioni['Cost Base'].to_numpy(dtype=float)[ordine])
+    acquistate, vendute = np.where(vendita, 0.0, quote), np.where(vendita, -quote, 0.0)
+    prima_riga = np.r_[True, codici[1:] != codici[:-1]]
+    inizio_ticker = np.maximum.accumulate(np.where(prima_riga, np.arange(n), 0))
+
+    # Cumulate globali (le righe sono raggruppate per ticker) e, sottraendo il valore prima del ticker, per ticker
+    per_ticker = lambda globale: globale - np.r_[0.0, globale][inizio_ticker]
+    acquistate_glob, costo_glob = np.cumsum(acquistate), np.cumsum(costo_acquisti)
+    acquistate_cum, costo_cum = per_ticker(acquistate_glob), per_ticker(costo_glob)
+    vendute_cum = per_ticker(np.cumsum(vendute))
+    # Le quote vendute senza copertura restano scoperte anche se il ticker viene riacquistato dopo: eccedenza = massimo
+    # corrente di (vendute - acquistate) nel ticker, così le coperte non superano mai le quote possedute a quella data
+    eccedenza = pd.Series(np.maximum(vendute_cum - acquistate_cum, 0.0)).groupby(codici).cummax().to_numpy()
+    coperte_cum = vendute_cum - eccedenza
+    coperte = np.diff(np.r_[0.0, coperte_cum]); coperte[prima_riga] = coperte_cum[prima_riga]
+    quote_residue = acquistate_cum - coperte_cum
+    soglia = TOLLERANZA_QUOTE * np.maximum(acquistate_cum, 1.0)
+
+    if metodo == 'Medio':
+        quote_prima = quote_residue + coperte - acquistate
+        chiusura = vendita & (quote_residue <= soglia)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = np.where(vendita & ~chiusura & (quote_prima > 0), 1.0 - coperte / quote_prima, 1.0)
+        # Tratti di posizione aperta: un nuovo tratto inizia a ogni ticker e dopo ogni chiusura completa
+        tratto = np.cumsum(prima_riga | np.r_[False, chiusura[:-1]])
+        prodotti = pd.Series(a).groupby(tratto).cumprod().to_numpy()
+        costo_residuo = prodotti * pd.Series(costo_acquisti / prodotti).groupby(tratto).cumsum().to_numpy()
+        costo_residuo[chiusura] = 0.0
+        costo_precedente = np.r_[0.0, costo_residuo[:-1]]; costo_precedente[prima_riga] = 0.0
+        costo_venduto = np.where(vendita, costo_precedente - costo_residuo, 0.0)
+    else:
+        # Punti della coda: quote e costi cumulati dopo ogni acquisto (con l'origine), in coordinate globali
+        acquisti = acquistate > 0
+        xp, fp = np.r_[0.0, acquistate_glob[acquisti]], np.r_[0.0, costo_glob[acquisti]]
+        base = np.r_[0.0, acquistate_glob][inizio_ticker]
+        costo_chiuso_cum = np.interp(base + coperte_cum, xp, fp) - np.interp(base, xp, fp)
+        costo_venduto = np.diff(np.r_[0.0, costo_chiuso_cum]); costo_venduto[prima_riga] = costo_chiuso_cum[prima_riga]
+        costo_venduto = np.where(vendita, costo_venduto, 0.0)
+        costo_residuo = costo_cum - costo_chiuso_cum
+
+    quote_residue = np.where(quote_residue > soglia, quote_residue, 0.0)
+    costo_residuo = np.where(quote_residue > 0, costo_residuo, 0.0)
+    prezzo = transazioni['Market Value ACQUISTO'].to_numpy(dtype=float)[ordine]
+    commissioni = transazioni['Trading Fees'].to_numpy(dtype=float)[ordine] if 'Trading Fees' in transazioni.columns else np.zeros(n)
+    ricavo = np.where(vendita, vendute * prezzo - np.abs(commissioni), 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pmc = np.where(quote_residue > 0, costo_residuo / quote_residue, 0.0)
+        ricavo_coperto = np.where(vendute > 0, ricavo * coperte / vendute, 0.0)
+    risultati = np.column_stack([quote_residue, costo_residuo, pmc, costo_venduto, ricavo,
+                                 np.where(vendita, ricavo_coperto - costo_venduto, 0.0), np.where(vendita, vendute - coperte, 0.0)])
+    in_ordine_originale = np.empty_like(risultati)
+    in_ordine_originale[ordine] = risultati
+    return pd.DataFrame(in_ordine_originale, index=transazioni.index, columns=COLONNE_LOTTI)
+
+# --- IMPORTAZIONE MASSIVA IN 'Holding' (estratti conto del broker) ---
+# Nomi di colonna riconosciuti nei CSV dei broker (TradeRepublic e simili, in IT/EN/DE), confrontati senza maiuscole
+COLONNE_CSV_BROKER = {
+    'Identificativo': ['ticker', 'symbol', 'simbolo', 'isin', 'instrument', 'strumento'],
+    'Nome': ['name', 'nome', 'titolo', 'nome titolo', 'security', 'wertpapier'],
+    'Data': ['date', 'data', 'datum', 'data operazione', 'trade date', 'booking date', 'timestamp'],
+    'Quote': ['shares', 'quantity', 'quantità', 'quantita', 'quote', 'n. share', 'stück', 'stueck', 'anzahl'],
+    'Prezzo': ['price', 'prezzo', 'price per share', 'prezzo unitario', 'kurs'],
+    'Importo': ['amount', 'importo', 'total', 'totale', 'value', 'betrag'],
+    'Commissioni': ['fee', 'fees', 'commissioni', 'commissione', 'gebühr', 'gebuehr'],
+    'Tipo': ['type', 'tipo', 'transaction type', 'tipo operazione', 'typ'],
+    'Descrizione': ['description', 'descrizione', 'note', 'beschreibung'],
+}
+# Classificazione delle righe per parole chiave su 'Tipo' + 'Descrizione' (la prima regola che corrisponde vince)
+REGOLE_CLASSE_BROKER = [
+    ('Saveback', r'save\s*back'),
+    ('RoundUp', r'round\s*-?\s*up|arrotondament'),
+    ('Vendita', r'\bsell\b|\bvendita\b|verkauf'),
+    ('Acquisto', r'\bbuy\b|acquisto|kauf|savings plan|piano di accumulo|sparplan|trade'),
+]
+CLASSI_IMPORTABILI_BROKER = ['Acquisto', 'Saveback', 'RoundUp', 'Vendita']
+DECIMALI_CHIAVE_QUOTE = 3    # tolleranza sull'arrotondamento del foglio nel confronto dei duplicati
+DECIMALI_CHIAVE_PREZZO = 2
+
+def rileva_colonne_csv(colonne, nomi_noti: dict = None) -> dict:
+    """Per ogni campo dell'importazione, la prima colonna del CSV che corrisponde a uno dei nomi noti (o None)."""
+    per_nome = {str(c).strip().casefold(): c for c in colonne}
+    nomi_noti = COLONNE_CSV_BROKER if nomi_noti is None else nomi_noti
+    return {campo: next((per_nome[alias] for alias in alias_campo if alias in per_nome), None) for campo, alias_campo in nomi_noti.items()}
+
+def converti_numeri_testo(serie: pd.Series) -> pd.Series:
+    """
+    Numeri testuali in formato italiano ('1.234,56') o inglese ('1,234.56') in float, riga per riga:
+    il separatore decimale è l'ultimo tra ',' e '.'. Simboli di valuta e spazi vengono ignorati.
+    """
+    testo = serie.astype(str).str.replace(r'[^\d,.\-]', '', regex=True)
+    virgola_decimale = testo.str.rfind(',') > testo.str.rfind('.')
+    testo = testo.where(virgola_decimale, testo.str.replace(',', '', regex=False))
+    testo = testo.where(~virgola_decimale, testo.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    return pd.to_numeric(testo, errors='coerce')
+
+def classifica_operazioni_broker(tipo: pd.Series, descrizione: pd.Series) -> pd.Series:
+    """'Acquisto', 'Saveback', 'RoundUp', 'Vendita' o 'Altro' (dividendi, bonifici, interessi...) per ogni riga."""
+    testo = (tipo.fillna('').astype(str) + ' ' + descrizione.fillna('').astype(str)).str.casefold()
+    condizioni = [testo.str.contains(regola, regex=True) for _, regola in REGOLE_CLASSE_BROKER]
+    return pd.Series(np.select(condizioni, [classe for classe, _ in REGOLE_CLASSE_BROKER], default='Altro'), index=tipo.index)
+
+def mappa_identificativi_ticker(df: pd.DataFrame) -> dict:
+    """Ticker del foglio per ogni identificativo noto (ticker, simbolo Yahoo, nome, ISIN se presente), con chiavi minuscole."""
+    mappa = {}
+    for colonna in ('Nome Titolo', 'ISIN', 'yf_ticker', 'Ticker'):
+        if colonna in df.columns:
+            presenti = df[colonna].notna()
+            mappa.update(zip(df.loc[presenti, colonna].astype(str).str.strip().str.casefold(), df.loc[presenti, 'Ticker']))
+    mappa.pop('', None)
+    return mappa
+
+def normalizza_estratto_broker(df_csv: pd.DataFrame, colonne: dict, ticker_per_identificativo: dict) -> pd.DataFrame:
+    """
+    Righe del CSV del broker nelle colonne di 'Holding': 'Ticker', 'Data Acquisto', 'n. share', 'Market Value ACQUISTO',
+    'Trading Fees', più 'Classe' e 'Identificativo' (per risolvere a mano i ticker non riconosciuti).
+    Il ticker è cercato per identificativo (ticker, simbolo, ISIN) e, se non trovato, per nome del titolo.
+    Il prezzo, se manca, è ricavato da |importo| - commissioni (+ commissioni per le vendite) diviso per le quote;
+    le quote delle vendite sono negative, come in 'Holding'.
+    """
+    vuota = pd.Series(np.nan, index=df_csv.index)
+    colonna = lambda campo: df_csv[colonne[campo]] if colonne.get(campo) else vuota
+    identificativo = colonna('Identificativo').fillna('').astype(str).str.strip()
+    nome = colonna('Nome').fillna('').astype(str).str.strip()
+    quote = converti_numeri_testo(colonna('Quote')).abs()
+    commissioni = converti_numeri_testo(colonna('Commissioni')).abs().fillna(0.0)
+    prezzo = converti_numeri_testo(colonna('Prezzo')).abs()
+    classe = classifica_operazioni_broker(colonna('Tipo'), colonna('Descrizione'))
+    vendita = classe == 'Vendita'
+    prezzo_da_importo = (converti_numeri_testo(colonna('Importo')).abs() + commissioni.where(vendita, -commissioni)) / quote.replace(0, np.nan)
+    date = pd.to_datetime(colonna('Data').astype(str).str.strip().str[:10], dayfirst=True, errors='coerce', format='mixed')
+    return pd.DataFrame({
+        'Ticker': identificativo.str.casefold().map(ticker_per_identificativo).fillna(nome.str.casefold().map(ticker_per_identificativo)),
+        'Identificativo': identificativo.where(identificativo != '', nome),
+        'Data Acquisto': date.dt.normalize(),
+        'n. share': quote.where(~vendita, -quote),
+        'Market Value ACQUISTO': prezzo.fillna(prezzo_da_importo),
+        'Trading Fees': commissioni,
+        'Classe': classe,
+    })
+
+def chiavi_operazioni(df: pd.DataFrame) -> np.ndarray:
+    """
+    Hash (uint64) di ticker, giorno, quote e prezzo arrotondati, più il numero di occorrenza della stessa combinazione:
+    due acquisti identici nello stesso giorno restano due chiavi distinte e il confronto funziona come un multiinsieme.
+    """
+    if df.empty: return np.empty(0, dtype=np.uint64)
+    base = pd.DataFrame({
+        'Ticker': df['Ticker'].astype(str),
+        'Giorno': pd.to_datetime(df['Data Acquisto']).dt.normalize(),
+        'Quote': df['n. share'].astype(float).round(DECIMALI_CHIAVE_QUOTE),
+        'Prezzo': df['Market Value ACQUISTO'].astype(float).round(DECIMALI_CHIAVE_PREZZO),
+    }).reset_index(drop=True)
+    base['Occorrenza'] = base.groupby(['Ticker', 'Giorno', 'Quote', 'Prezzo']).cumcount()
+    return pd.util.hash_pandas_object(base, index=False).to_numpy()
+
+def stato_importazione(operazioni: pd.DataFrame, df_esistente: pd.DataFrame) -> pd.Series:
+    """'Nuova', 'Duplicato' (già nel foglio, per indice di hash) o 'Ignorata: <motivo>' per ogni riga normalizzata."""
+    stato = pd.Series('Nuova', index=operazioni.index)
+    valide = operazioni['Data Acquisto'].notna() & (operazioni['n. share'] != 0) & (operazioni['Market Value ACQUISTO'] > 0)
+    stato[~operazioni['Classe'].isin(CLASSI_IMPORTABILI_BROKER)] = 'Ignorata: ' + operazioni['Classe']
+    stato[(stato == 'Nuova') & ~valide] = 'Ignorata: dati incompleti'
+    stato[(stato == 'Nuova') & operazioni['Ticker'].isna()] = 'Ignorata: ticker non riconosciuto'
+    candidate = stato == 'Nuova'
+    if candidate.any() and not df_esistente.empty:
+        indice_esistenti = pd.Index(chiavi_operazioni(df_esistente))
+        duplicati = pd.Index(chiavi_operazioni(operazioni[candidate])).isin(indice_esistenti)
+        stato[candidate[candidate].index[duplicati]] = 'Duplicato'
+    return stato
+
+def _numero_per_foglio(valore: float, decimali: int) -> str:
+    """Numero con la virgola decimale, senza zeri finali superflui (come si digita nei form)."""
+    testo = f"{valore:.{decimali}f}".rstrip('0').rstrip('.')
+    return (testo or '0').replace('.', ',')
+
+def righe_holding_da_operazioni(operazioni: pd.DataFrame, categoria_acquisti: str = 'Stocks') -> list:
+    """Dizionari intestazione -> valore per 'Holding', come quelli dei form di inserimento."""
+    categorie = operazioni['Classe'].map({'Saveback': 'Saveback', 'RoundUp': 'RoundUp', 'Vendita': 'Vendita'}).fillna(categoria_acquisti)
+    return [{
+        'Stock / ETF Ticker Symbol': ticker,
+        'Investment Category': categoria,
+        'n. share': _numero_per_foglio(quote, 6),
+        'Market Value ACQUISTO': _numero_per_foglio(prezzo, 4),
+        'Data Acquisto': data.strftime('%d/%m/%Y'),
+        'Trading Fees': _numero_per_foglio(commissioni, 2),
+    } for ticker, categoria, quote, prezzo, data, commissioni in zip(
+        operazioni['Ticker'], categorie, operazioni['n. share'], operazioni['Market Value ACQUISTO'],
+        operazioni['Data Acquisto'], operazioni['Trading Fees'])]
+
+def scrivi_operazioni_holding(username: str, righe: list) -> int:
+    """
+    Scrive le righe (dizionari intestazione -> valore) in 'Holding' a partire dalla prima riga libera della colonna
+    'Data Acquisto', con un'unica update_cells per tutte le righe. Restituisce il numero di righe scritte.
+    """
+    if not righe: return 0
+    user_config = st.secrets.database.users[username]
+    client = get_gspread_client_for_user(st.secrets.google_credentials[username])
+    if client is None: raise Exception("Impossibile connettersi a Google Sheets.")
+    from gspread import Cell  # già caricato dal client
+    # Tutte le chiamate passano dallo scheduler con priorità di scrittura
+    def chiama(funzione): return esegui_chiamata_sheets(username, funzione, scrittura=True)
+    foglio = chiama(lambda: client.open(user_config.sheet_name))
+    sheet = chiama(lambda: foglio.worksheet("Holding"))
+    header_row_index = 3
+    headers = chiama(lambda: sheet.row_values(header_row_index))
+    header_map = {header: i + 1 for i, header in enumerate(headers)}
+    reference_col_index = header_map.get('Data Acquisto')
+    if not reference_col_index: raise ValueError("Colonna 'Data Acquisto' non trovata.")
+    reference_col_values = chiama(lambda: sheet.col_values(reference_col_index))
+    prima_riga = len([val for val in reference_col_values[header_row_index:] if val]) + header_row_index + 1
+    righe_mancanti = prima_riga + len(righe) - 1 - sheet.row_count
+    if righe_mancanti > 0:
+        chiama(lambda: sheet.add_rows(righe_mancanti))
+    celle = [Cell(row=prima_riga + i, col=header_map[h], value=v) for i, riga in enumerate(righe) for h, v in riga.items() if h in header_map]
+    if not celle: return 0
+    chiama(lambda: sheet.update_cells(celle, value_input_option='USER_ENTERED'))
+    return len(righe)
+
+# --- SNAPSHOT SU DISCO (stale-while-revalidate) ---
+CARTELLA_SNAPSHOT = os.path.join(os.path.dirname(PERCORSO_REGISTRO_SIMBOLI), 'snapshot')
+VERSIONE_FORMATO_SNAPSHOT = 3     # da incrementare quando cambiano le colonne salvate (3: 'Holding' senza le colonne da 'appconfig')
+ETA_MASSIMA_SNAPSHOT_S = 600       # come il TTL dei loader dei fogli
+PAUSA_TRA_RIVALIDAZIONI_S = 60     # dopo un tentativo fallito non si riprova subito
+MAX_SNAPSHOT_PER_UTENTE = 20
+
+def impronta_dati(df: pd.DataFrame, extra: str = '') -> str:
+    """Impronta breve del contenuto di un DataFrame (per nomi di snapshot e chiavi di cache su disco)."""
+    impronta = hashlib.sha1(pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes())
+    impronta.update(extra.encode())
+    return impronta.hexdigest()[:20]
+
+def _cartella_snapshot_utente(username: str) -> str:
+    return os.path.join(CARTELLA_SNAPSHOT, hashlib.sha1(str(username).encode()).hexdigest()[:12])
+
+def _percorsi_snapshot(username: str, nome: str):
+    base = os.path.join(_cartella_snapshot_utente(username), hashlib.sha1(nome.encode()).hexdigest()[:16])
+    return f"{base}.parquet", f"{base}.json"
+
+def salva_snapshot(username: str, nome: str, dati) -> float:
+    """
+    Salva un DataFrame o una Serie come snapshot Parquet dell'utente (con i metadati in un file .json accanto).
+    Restituisce l'istante di salvataggio; dati vuoti non sovrascrivono uno snapshot valido.
+    """
+    salvato_il = time.time()
+    if dati is None or dati.empty: return salvato_il
+    percorso_dati, percorso_meta = _percorsi_snapshot(username, nome)
+    serie = isinstance(dati, pd.Series)
+    try:
+        os.makedirs(os.path.dirname(percorso_dati), exist_ok=True)
+        tabella = dati.to_frame(name=dati.name if dati.name is not None else 'valore') if serie else dati
+        tabella.to_parquet(f"{percorso_dati}.tmp", index=True)
+        meta = {'formato': VERSIONE_FORMATO_SNAPSHOT, 'nome': nome, 'salvato_il': salvato_il, 'serie': serie, 'attrs': dati.attrs}
+        with open(f"{percorso_meta}.tmp", 'w', encoding='utf-8') as f:
+            json.dump(meta, f, default=str)
+        os.replace(f"{percorso_dati}.tmp", percorso_dati)
+        os.replace(f"{percorso_meta}.tmp", percorso_meta)
+        _pulisci_snapshot_utente(username)
+    except (OSError, ValueError, TypeError, ImportError):
+        pass  # lo snapshot è solo un'accelerazione: senza disco (o con colonne non serializzabili) si legge dal foglio
+    return salvato_il
+
+def _pulisci_snapshot_utente(username: str):
+    cartella = _cartella_snapshot_utente(username)
+    meta = sorted((os.path.join(cartella, f) for f in os.listdir(cartella) if f.endswith('.json')), key=os.path.getmtime)
+    for vecchio in meta[:-MAX_SNAPSHOT_PER_UTENTE]:
+        for percorso in (vecchio, vecchio[:-len('.json')] + '.parquet'):
+            if os.path.exists(percorso): os.remove(percorso)
+
+def _leggi_meta_snapshot(username: str, nome: str):
+    try:
+        with open(_percorsi_snapshot(username, nome)[1], encoding='utf-8') as f:
+            meta = json.load(f)
+        return meta if meta.get('formato') == VERSIONE_FORMATO_SNAPSHOT else None
+    except (OSError, ValueError):
+        return None
+
+def leggi_snapshot(username: str, nome: str):
+    """(dati, salvato_il) dell'ultimo snapshot, oppure (None, None) se manca o è di un formato precedente."""
+    meta = _leggi_meta_snapshot(username, nome)
+    if meta is None: return None, None
+    try:
+        dati = pd.read_parquet(_percorsi_snapshot(username, nome)[0])
+    except (OSError, ValueError, ImportError):
+        return None, None
+    if meta['serie']: dati = dati.iloc[:, 0]
+    dati.attrs.update(meta.get('attrs') or {})
+    return dati, meta['salvato_il']
+
+def elimina_snapshot(username: str):
+    """Rimuove tutti gli snapshot dell'utente: il prossimo caricamento torna a leggere il foglio."""
+    cartella = _cartella_snapshot_utente(username)
+    if not os.path.isdir(cartella): return
+    for nome_file in os.listdir(cartella):
+        try: os.remove(os.path.join(cartella, nome_file))
+        except OSError: pass
+
+@st.cache_resource
+def _rivalidazioni_snapshot():
+    """Rivalidazioni in background condivise tra le sessioni: al più una per (utente, snapshot)."""
+    return {'lock': threading.Lock(), 'in_corso': {}, 'ultimo_tentativo': {}, 'executor': ThreadPoolExecutor(max_workers=2)}
+
+def _rivalida_in_background(username: str, nome: str, carica):
+    stato = _rivalidazioni_snapshot()
+    chiave = (username, nome)
+    with stato['lock']:
+        futuro = stato['in_corso'].get(chiave)
+        if futuro is not None and not futuro.done(): return True
+        if time.time() - stato['ultimo_tentativo'].get(chiave, 0.0) < PAUSA_TRA_RIVALIDAZIONI_S: return False
+        stato['ultimo_tentativo'][chiave] = time.time()
+        def rivalida():
+            salva_snapshot(username, nome, carica())
+        stato['in_corso'][chiave] = stato['executor'].submit(rivalida)
+        return True
+
+def rivalidazione_in_corso(username: str, nome: str) -> bool:
+    futuro = _rivalidazioni_snapshot()['in_corso'].get((username, nome))
+    return futuro is not None and not futuro.done()
+
+def carica_con_snapshot(username: str, nome: str, carica, eta_massima_s: float = ETA_MASSIMA_SNAPSHOT_S, memoria: dict = None):
+    """
+    Stale-while-revalidate: restituisce subito i dati della sessione o l'ultimo snapshot su disco e, se più vecchi
+    di `eta_massima_s`, li rinfresca con `carica()` in un thread; il nuovo snapshot sostituisce quello in sessione
+    alla prima riesecuzione successiva. Solo senza alcuno snapshot `carica()` è bloccante.
+    Fuori da una sessione Streamlit (es. api_locale.py) i dati correnti si tengono nel dizionario `memoria`.
+    Restituisce (dati, salvato_il, rivalidazione_in_corso).
+    """
+    in_sessione = st.session_state.setdefault('snapshot_caricati', {}) if memoria is None else memoria
+    chiave = (username, nome)
+    corrente = in_sessione.get(chiave)
+    meta = _leggi_meta_snapshot(username, nome)
+    if meta and (corrente is None or meta['salvato_il'] > corrente[1]):
+        dati, salvato_il = leggi_snapshot(username, nome)
+        if dati is not None: corrente = in_sessione[chiave] = (dati, salvato_il)
+    if corrente is None:
+        dati = carica()
+        corrente = in_sessione[chiave] = (dati, salva_snapshot(username, nome, dati))
+        return dati, corrente[1], False
+    if time.time() - corrente[1] > eta_massima_s:
+        return corrente[0], corrente[1], _rivalida_in_background(username, nome, carica)
+    return corrente[0], corrente[1], rivalidazione_in_corso(username, nome)
+
+def registra_snapshot(username: str, nome: str, dati):
+    """Salva dati appena letti in modo sincrono (es. dopo una scrittura sul foglio) e li rende quelli correnti della sessione."""
+    st.session_state.setdefault('snapshot_caricati', {})[(username, nome)] = (dati, salva_snapshot(username, nome, dati))
+
+def formatta_eta(secondi: float) -> str:
+    if secondi < 60: return "pochi secondi"
+    if secondi < 3600: return f"{int(secondi // 60)} min"
+    if secondi < 86400: return f"{int(secondi // 3600)} h"
+    return f"{int(secondi // 86400)} giorni"
+
+# --- FUNZIONI PER IL DOWNLOAD DEI PREZZI (Yahoo Finance) ---
+DIMENSIONE_BLOCCO_PREZZI = 20       # simboli per singola richiesta a yfinance
+MAX_DOWNLOAD_PARALLELI = 4          # richieste contemporanee massime
+TENTATIVI_DOWNLOAD = 3
+TTL_SIMBOLI_NON_DISPONIBILI = 6 * 3600  # secondi prima di riprovare un simbolo senza dati
+
+CAMPI_EVENTI_SOCIETARI = ('Dividends', 'Stock Splits')
+
+def _scarica_blocco_prezzi(simboli: list, start_date, end_date=None, con_eventi: bool = False):
+    """
+    Scarica le chiusure di un blocco di simboli con retry e backoff esponenziale. Restituisce ({campo: date × simbolo}, riuscito).
+    Le chiusure sono rettificate solo per i frazionamenti (auto_adjust=False): i dividendi, se richiesti, arrivano nella stessa richiesta.
+    """
+    campi = ('Close',) + (CAMPI_EVENTI_SOCIETARI if con_eventi else ())
+    for tentativo in range(TENTATIVI_DOWNLOAD):
+        try:
+            dati = _yfinance().download(simboli, start=start_date, end=end_date, progress=False, threads=False, auto_adjust=False, actions=con_eventi)
+            if dati.empty: return {}, True
+            risultato = {}
+            for campo in campi:
+                if campo not in dati.columns.get_level_values(0): continue
+                valori = dati[campo]
+                if isinstance(valori, pd.Series):
+                    valori = valori.to_frame(name=simboli[0])
+                risultato[campo] = valori
+            return risultato, True
+        except Exception:
+            if tentativo < TENTATIVI_DOWNLOAD - 1:
+                time.sleep(2 ** tentativo + random.random())
+    return {}, False
+
+def scarica_prezzi_ed_eventi(simboli, start_date, end_date=None, registra_mancanti=True, con_eventi=True):
+    """
+    Scarica le chiusure giornaliere dividendo i simboli in blocchi scaricati in parallelo (con limite).
+    Un blocco fallito o un simbolo delistato non annullano il resto.
+    Restituisce (prezzi date × simbolo, simboli mancanti, {'Dividends': ..., 'Stock Splits': ...} allineati ai prezzi, 0 senza evento).
+    Con `registra_mancanti=False` (finestre brevi) un simbolo senza dati non finisce nella cache negativa.
+    """
+    registro = _registro_simboli()['non_disponibili']
+    adesso = time.time()
+    simboli = list(dict.fromkeys(simboli))
+    da_scaricare = [s for s in simboli if registro.get(s, 0) <= adesso]
+    blocchi = [da_scaricare[i:i + DIMENSIONE_BLOCCO_PREZZI] for i in range(0, len(da_scaricare), DIMENSIONE_BLOCCO_PREZZI)]
+
+    risultati = []
+    if blocchi:
+        with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_PARALLELI, len(blocchi))) as pool:
+            risultati = list(pool.map(lambda blocco: _scarica_blocco_prezzi(blocco, start_date, end_date, con_eventi), blocchi))
+
+    frames, frames_eventi = [], {campo: [] for campo in CAMPI_EVENTI_SOCIETARI}
+    non_disponibili, disponibili = {}, []
+    for blocco, (campi, riuscito) in zip(blocchi, risultati):
+        if not riuscito: continue  # errore di rete: si riprova al prossimo giro, senza cache negativa
+        chiusure = campi.get('Close', pd.DataFrame()).dropna(axis=1, how='all')
+        for simbolo in blocco:
+            if simbolo not in chiusure.columns:
+                if registra_mancanti: non_disponibili[simbolo] = adesso + TTL_SIMBOLI_NON_DISPONIBILI
+            else:
+                disponibili.append(simbolo)
+        frames.append(chiusure)
+        for campo in frames_eventi:
+            if campo in campi: frames_eventi[campo].append(campi[campo][chiusure.columns])
+    if blocchi:
+        # Il registro è condiviso tra sessioni e thread: tutte le modifiche insieme, sotto il lock
+        with _LOCK_REGISTRO_SIMBOLI:
+            registro.update(non_disponibili)
+            for simbolo in disponibili: registro.pop(simbolo, None)
+        salva_registro_simboli()
+
+    prezzi = pd.concat(frames, axis=1).sort_index() if frames else pd.DataFrame()
+    prezzi = prezzi.loc[:, ~prezzi.columns.duplicated()]
+    mancanti = [s for s in simboli if s not in prezzi.columns]
+    eventi = {}
+    if con_eventi:
+        for campo, parti in frames_eventi.items():
+            tabella = pd.concat(parti, axis=1) if parti else pd.DataFrame(index=prezzi.index)
+            tabella = tabella.loc[:, ~tabella.columns.duplicated()]
+            eventi[campo] = tabella.reindex(index=prezzi.index, columns=prezzi.columns).fillna(0.0)
+    return prezzi, mancanti, eventi
+
+def scarica_prezzi_chiusura(simboli, start_date, end_date=None, registra_mancanti=True):
+    """Solo le chiusure: restituisce (prezzi date × simbolo, simboli mancanti)."""
+    prezzi, mancanti, _ = scarica_prezzi_ed_eventi(simboli, start_date, end_date, registra_mancanti, con_eventi=False)
+    return prezzi, mancanti
+
+# --- VALUTAZIONE IN EURO (valuta di quotazione e tassi di cambio) ---
+VALUTA_BASE = 'EUR'
+VALUTE_PER_SUFFISSO = {'.MI': 'EUR', '.DE': 'EUR', '.AS': 'EUR', '.PA': 'EUR', '.L': 'GBp'}
+SOTTOUNITA_VALUTA = {'GBp': ('GBP', 0.01), 'GBX': ('GBP', 0.01), 'ZAc': ('ZAR', 0.01), 'ILA': ('ILS', 0.01)}
+
+def _valuta_da_suffisso(simbolo: str) -> str:
+    """Stima della valuta dal suffisso di borsa, usata solo se Yahoo non risponde."""
+    for suffisso, valuta in VALUTE_PER_SUFFISSO.items():
+        if simbolo.upper().endswith(suffisso): return valuta
+    return 'USD'
+
+def _rileva_valuta(simbolo: str):
+    try:
+        return _yfinance().Ticker(simbolo).fast_info['currency'] or None
+    except Exception:
+        return None
+
+def rileva_valute(simboli) -> dict:
+    """Restituisce {simbolo: valuta di quotazione}, interrogando Yahoo solo per i simboli mai visti."""
+    registro = _registro_simboli()['valute']
+    simboli = list(dict.fromkeys(simboli))
+    nuovi = [s for s in simboli if s not in registro]
+    if nuovi:
+        with ThreadPoolExecutor(max_workers=min(MAX_DOWNLOAD_PARALLELI, len(nuovi))) as pool:
+            trovate = {simbolo: valuta for simbolo, valuta in zip(nuovi, pool.map(_rileva_valuta, nuovi)) if valuta}
+        with _LOCK_REGISTRO_SIMBOLI:
+            registro.update(trovate)
+        salva_registro_simboli()
+    return {s: registro.get(s) or _valuta_da_suffisso(s) for s in simboli}
+
+def fattori_conversione_euro(simboli, indice: pd.DatetimeIndex, valute: dict, start_date, end_date=None):
+    """
+    Matrice date × simbolo degli EUR per unità di quotazione (sottounità come GBp incluse).
+    I tassi 'EURxxx=X' necessari vengono scaricati in una sola richiesta. Restituisce (fattori, simboli senza cambio).
+    """
+    codici = {t: SOTTOUNITA_VALUTA.get(valute.get(t), ((valute.get(t) or VALUTA_BASE).upper(), 1.0)) for t in simboli}
+    valute_estere = sorted({codice for codice, _ in codici.values() if codice != VALUTA_BASE})
+    coppie = [f"{VALUTA_BASE}{codice}=X" for codice in valute_estere]
+    tassi, _ = scarica_prezzi_chiusura(coppie, start_date, end_date, registra_mancanti=False) if coppie else (pd.DataFrame(), [])
+
+    # EUR per unità di valuta estera, allineati al calendario dei prezzi
+    tassi = tassi.reindex(tassi.index.union(indice)).sort_index().ffill().bfill().reindex(indice)
+    euro_per_unita = 1.0 / tassi.rename(columns=lambda coppia: coppia[len(VALUTA_BASE):len(VALUTA_BASE) + 3])
+    euro_per_unita[VALUTA_BASE] = 1.0
+
+    fattori = euro_per_unita.reindex(columns=[codici[t][0] for t in simboli]).to_numpy() * np.array([codici[t][1] for t in simboli])
+    senza_cambio = [t for t, (codice, _) in codici.items() if codice not in euro_per_unita.columns or euro_per_unita[codice].isna().all()]
+    return pd.DataFrame(fattori, index=indice, columns=list(simboli)), senza_cambio
+
+def converti_prezzi_in_euro(prezzi: pd.DataFrame, valute: dict, start_date, end_date=None):
+    """
+    Converte in EUR la matrice date × simbolo con un'unica moltiplicazione vettoriale per la matrice dei cambi.
+    Restituisce (prezzi in EUR, simboli senza cambio).
+    """
+    fattori, senza_cambio = fattori_conversione_euro(prezzi.columns, prezzi.index, valute, start_date, end_date)
+    prezzi_eur = prezzi.ffill() * fattori
+    return prezzi_eur.drop(columns=senza_cambio), senza_cambio
+
+@st.cache_data(ttl=3600)
+def scarica_prezzi_in_euro(simboli: tuple, start_date, end_date=None):
+    """
+    Prezzi di chiusura convertiti in EUR con gli eventi societari scaricati nella stessa richiesta;
+    cambi ed eventi sono messi in cache insieme ai prezzi.
+    Restituisce (prezzi in EUR date × simbolo, simboli mancanti, {simbolo: valuta}, eventi) dove eventi ha
+    'dividendi' (EUR per azione, date × simbolo) e 'frazionamenti' (tabella yf_ticker / Data / Rapporto).
+    """
+    prezzi, mancanti, eventi = scarica_prezzi_ed_eventi(list(simboli), start_date, end_date)
+    if prezzi.empty: return prezzi, mancanti, {}, {'dividendi': pd.DataFrame(), 'frazionamenti': tabella_frazionamenti(pd.DataFrame())}
+    valute = rileva_valute(prezzi.columns.tolist())
+    fattori, senza_cambio = fattori_conversione_euro(prezzi.columns, prezzi.index, valute, start_date, end_date)
+    prezzi_eur = (prezzi.ffill() * fattori).drop(columns=senza_cambio)
+    dividendi_eur = (eventi['Dividends'] * fattori).drop(columns=senza_cambio).fillna(0.0)
+    frazionamenti = tabella_frazionamenti(eventi['Stock Splits'].drop(columns=senza_cambio))
+    return prezzi_eur, mancanti + senza_cambio, valute, {'dividendi': dividendi_eur, 'frazionamenti': frazionamenti}
+
+# --- EVENTI SOCIETARI (frazionamenti e dividendi) ---
+def tabella_frazionamenti(frazionamenti: pd.DataFrame) -> pd.DataFrame:
+    """Da matrice date × simbolo (0 = nessun evento) a tabella compatta yf_ticker / Data / Rapporto, ordinata."""
+    if frazionamenti.empty: return pd.DataFrame({'yf_ticker': pd.Series(dtype=object), 'Data': pd.Series(dtype='datetime64[ns]'), 'Rapporto': pd.Series(dtype=float)})
+    lunga = frazionamenti.rename_axis(index='Data', columns='yf_ticker').stack().rename('Rapporto').reset_index()
+    lunga = lunga[(lunga['Rapporto'] > 0) & (lunga['Rapporto'] != 1.0)]
+    return lunga[['yf_ticker', 'Data', 'Rapporto']].sort_values(['yf_ticker', 'Data']).reset_index(drop=True)
+
+SCALA_CHIAVE_GIORNO = 1_000_000  # più giorni di qualunque data reale: codice * scala + giorno ordina per codice, poi per data
+
+def _giorni(date) -> np.ndarray:
+    """Date come numero intero di giorni dall'epoca (int64), per chiavi composte e ricerche binarie."""
+    return pd.to_datetime(date).to_numpy().astype('datetime64[D]').astype(np.int64)
+
+@st.cache_data(ttl=24 * 3600)
+def fattori_frazionamento(transazioni: pd.DataFrame, frazionamenti: pd.DataFrame) -> np.ndarray:
+    """
+    Per ogni transazione, prodotto dei rapporti dei frazionamenti successivi alla 'Data Acquisto' dello stesso simbolo:
+    le quote del foglio × fattore sono espresse nelle unità dei prezzi Yahoo (già rettificati).
+    In cache sul contenuto di transazioni e frazionamenti: solo un evento nuovo (o una transazione nuova) lo ricalcola.
+    Un'unica ricerca binaria su chiavi composte (simbolo, giorno) invece di un ciclo per titolo.
+    """
+    fattori = np.ones(len(transazioni))
+    if frazionamenti.empty or transazioni.empty: return fattori
+    simboli = pd.Index(frazionamenti['yf_ticker'].unique())
+    codici_eventi = simboli.get_indexer(frazionamenti['yf_ticker'])
+    codici_transazioni = simboli.get_indexer(transazioni['yf_ticker'])
+    chiavi_eventi = codici_eventi * SCALA_CHIAVE_GIORNO + _giorni(frazionamenti['Data'])
+    # Prodotto dei rapporti dall'evento i alla fine del suo simbolo (prodotto cumulato all'indietro per gruppo)
+    rapporti = frazionamenti['Rapporto'].to_numpy(dtype=float)
+    prodotti_coda = pd.Series(rapporti[::-1]).groupby(codici_eventi[::-1]).cumprod().to_numpy()[::-1]
+    con_eventi = codici_transazioni >= 0
+    chiavi = codici_transazioni[con_eventi] * SCALA_CHIAVE_GIORNO + _giorni(transazioni['Data Acquisto'])[con_eventi]
+    # Primo frazionamento strettamente successivo all'acquisto (side='right'), purché dello stesso simbolo
+    posizione = np.searchsorted(chiavi_eventi, chiavi, side='right')
+    stesso_simbolo = (posizione < len(chiavi_eventi)) & (codici_eventi[np.minimum(posizione, len(chiavi_eventi) - 1)] == codici_transazioni[con_eventi])
+    fattori[np.flatnonzero(con_eventi)[stesso_simbolo]] = prodotti_coda[posizione[stesso_simbolo]]
+    return fattori
+
+# --- VALUTAZIONE LIVE (solo prezzi correnti, senza rileggere il foglio) ---
+@st.cache_data(ttl=60)
+def scarica_quotazioni_live(simboli: tuple) -> pd.DataFrame:
+    """
+    Ultimo prezzo e chiusura precedente in EUR per i simboli posseduti, con una richiesta batch sugli ultimi giorni.
+    Restituisce un DataFrame indicizzato per simbolo con 'Prezzo Attuale', 'Chiusura Precedente' e 'Aggiornato Alle'.
+    """
+    if not simboli: return pd.DataFrame()
+    start_date = pd.Timestamp.now().normalize() - pd.Timedelta(days=7)
+    prezzi, _ = scarica_prezzi_chiusura(list(simboli), start_date, registra_mancanti=False)
+    if prezzi.empty: return pd.DataFrame()
+    prezzi, _ = converti_prezzi_in_euro(prezzi, rileva_valute(prezzi.columns.tolist()), start_date)
+    prezzi = prezzi.ffill()
+    quotazioni = pd.DataFrame({
+        'Prezzo Attuale': prezzi.iloc[-1],
+        'Chiusura Precedente': prezzi.iloc[-2] if len(prezzi) > 1 else prezzi.iloc[-1],
+    }).dropna(subset=['Prezzo Attuale'])
+    quotazioni['Aggiornato Alle'] = pd.Timestamp.now()
+    return quotazioni
+
+def applica_quotazioni_live(df: pd.DataFrame, quotazioni: pd.DataFrame) -> pd.DataFrame:
+    """Ricalcola localmente 'Prezzo Attuale', 'Valore Titoli Real' e 'Guadagno Oggi'; le righe senza quotazione restano quelle del foglio."""
+    if quotazioni.empty or 'yf_ticker' not in df.columns: return df
+    df = df.copy()
+    prezzo = df['yf_ticker'].map(quotazioni['Prezzo Attuale'])
+    precedente = df['yf_ticker'].map(quotazioni['Chiusura Precedente'])
+    con_quotazione = prezzo.notna()
+    df.loc[con_quotazione, 'Prezzo Attuale'] = prezzo[con_quotazione]
+    df.loc[con_quotazione, 'Valore Titoli Real'] = df['n. share'] * prezzo[con_quotazione]
+    df.loc[con_quotazione, 'Guadagno Oggi'] = df['n. share'] * (prezzo - precedente)[con_quotazione]
     return df
 
+COLONNE_VALUTAZIONE = ['Ticker', 'yf_ticker', 'Data Acquisto', 'n. share']
+
+def calculate_historical_portfolio_value(transactions_df: pd.DataFrame, username: str = None):
+    """
+    Calcola il valore storico giornaliero (in EUR) di un portafoglio di transazioni.
+    I ticker senza prezzi vengono esclusi e riportati in `serie.attrs['ticker_mancanti']`.
+    Con `username` la voce in cache segue l'invalidazione del dataset 'valutazione' di quell'utente.
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _calculate_historical_portfolio_value(transactions_df, versione=versione)
+
 @st.cache_data(ttl=3600)
-def calculate_historical_portfolio_value(transactions_df: pd.DataFrame):
-    """Calcola il valore storico giornaliero di un portafoglio di transazioni."""
-    if transactions_df.empty: return pd.Series()
+def _calculate_historical_portfolio_value(transactions_df: pd.DataFrame, versione: int = 0):
+    _registra_miss('valutazione')
+    if transactions_df.empty: return pd.Series(dtype=float)
+    posizioni = _calcola_valori_posizioni(transactions_df, versione=versione)
+    ticker_mancanti = posizioni['ticker_mancanti']
+    if not len(posizioni['date']):
+        portfolio_daily_value = pd.Series(dtype=float)
+        portfolio_daily_value.attrs['ticker_mancanti'] = ticker_mancanti
+        return portfolio_daily_value
+    portfolio_daily_value = pd.Series(posizioni['valori'].sum(axis=1, dtype=np.float64), index=posizioni['date'])
+    portfolio_daily_value = portfolio_daily_value[portfolio_daily_value > 0]
+    portfolio_daily_value.attrs['ticker_mancanti'] = ticker_mancanti
+    return portfolio_daily_value
+
+def calcola_valore_e_dividendi(transactions_df: pd.DataFrame, username: str = None) -> pd.DataFrame:
+    """
+    'Valore' storico giornaliero del portafoglio e 'Dividendi Cumulati' incassati (EUR) sulle stesse date,
+    per il grafico dell'andamento. I ticker senza prezzi sono in `attrs['ticker_mancanti']`.
+    """
+    valore = calculate_historical_portfolio_value(transactions_df, username)
+    andamento = pd.DataFrame({'Valore': valore, 'Dividendi Cumulati': 0.0}, index=valore.index)
+    if not valore.empty:
+        posizioni = calcola_valori_posizioni(transactions_df, username)
+        dividendi = pd.Series(posizioni['dividendi'].sum(axis=1, dtype=np.float64), index=posizioni['date']).cumsum()
+        andamento['Dividendi Cumulati'] = dividendi.reindex(valore.index).fillna(0.0)
+    andamento.attrs['ticker_mancanti'] = valore.attrs.get('ticker_mancanti', [])
+    return andamento
+
+def quote_cumulate(transactions_df: pd.DataFrame, date: pd.DatetimeIndex, simboli: pd.Index) -> pd.DataFrame:
+    """
+    Matrice date × simbolo delle quote possedute: ogni acquisto conta dal primo giorno di borsa ≥ 'Data Acquisto'.
+    Un solo np.add.at sulle variazioni seguito da un cumsum, senza cicli sulle transazioni.
+    """
+    colonne = simboli.get_indexer(transactions_df['yf_ticker'])
+    righe = date.searchsorted(transactions_df['Data Acquisto'].to_numpy())
+    validi = (colonne >= 0) & (righe < len(date))
+    variazioni = np.zeros((len(date), len(simboli)))
+    np.add.at(variazioni, (righe[validi], colonne[validi]), transactions_df['n. share'].to_numpy(dtype=float)[validi])
+    return pd.DataFrame(variazioni.cumsum(axis=0), index=date, columns=simboli)
+
+@st.cache_data(ttl=3600)
+def _matrici_posizioni(transactions_df: pd.DataFrame, versione: int = 0):
+    """
+    (quote, prezzi in EUR con forward-fill, dividendi in EUR per azione, ticker mancanti) sulle stesse date:
+    la base di valutazione, rendimenti e attribuzione. Le quote sono rettificate per i frazionamenti successivi all'acquisto.
+    """
     df_copy = transactions_df.copy()
-    df_copy['yf_ticker'] = clean_ticker_for_yf(df_copy['Ticker'])
+    if 'yf_ticker' not in df_copy.columns:
+        df_copy['yf_ticker'] = clean_ticker_for_yf(df_copy['Ticker'])
     yf_tickers = df_copy['yf_ticker'].unique().tolist()
-    start_date = df_copy['Data Acquisto'].min()
+    prices_df, yf_mancanti, _, eventi = scarica_prezzi_in_euro(tuple(yf_tickers), df_copy['Data Acquisto'].min())
+    ticker_mancanti = sorted(df_copy.loc[df_copy['yf_ticker'].isin(yf_mancanti), 'Ticker'].unique().tolist())
+    if prices_df.empty: return pd.DataFrame(), pd.DataFrame(), pd.DataFrame(), ticker_mancanti
+    prices_df = prices_df.ffill()
+    df_copy['n. share'] = df_copy['n. share'] * fattori_frazionamento(df_copy[['yf_ticker', 'Data Acquisto']], eventi['frazionamenti'])
+    dividendi = eventi['dividendi'].reindex(index=prices_df.index, columns=prices_df.columns).fillna(0.0)
+    return quote_cumulate(df_copy, prices_df.index, prices_df.columns), prices_df, dividendi, ticker_mancanti
+
+def _nomi_ticker(transactions_df: pd.DataFrame, simboli: pd.Index) -> pd.Index:
+    """Nome del 'Ticker' del foglio per ogni simbolo Yahoo (il simbolo stesso se non c'è corrispondenza)."""
+    df_copy = transactions_df if 'yf_ticker' in transactions_df.columns else transactions_df.assign(yf_ticker=clean_ticker_for_yf(transactions_df['Ticker']))
+    nomi = df_copy.drop_duplicates('yf_ticker').set_index('yf_ticker')['Ticker'].reindex(simboli)
+    return pd.Index(nomi.fillna(pd.Series(simboli, index=simboli)), name='Ticker')
+
+# --- MATRICE DEI VALORI PER POSIZIONE E ATTRIBUZIONE ---
+CARTELLA_CACHE_POSIZIONI = os.path.join(os.path.dirname(PERCORSO_REGISTRO_SIMBOLI), 'posizioni')
+MAX_FILE_CACHE_POSIZIONI = 20
+
+def _chiave_posizioni(transactions_df: pd.DataFrame) -> str:
+    """Impronta delle transazioni + ora corrente: stessa validità del TTL di un'ora dei prezzi."""
+    return impronta_dati(transactions_df, pd.Timestamp.now().strftime('%Y-%m-%d %H'))
+
+def _leggi_posizioni_da_disco(chiave: str):
+    percorso = os.path.join(CARTELLA_CACHE_POSIZIONI, f"{chiave}.npz")
     try:
-        prices_df = yf.download(yf_tickers, start=start_date, progress=False)['Close']
-        if prices_df.empty: return pd.Series()
-        if isinstance(prices_df, pd.Series):
-            prices_df = prices_df.to_frame(name=yf_tickers[0])
-    except Exception:
-        return pd.Series()
-    prices_df.ffill(inplace=True)
-    holdings_df = pd.DataFrame(0.0, index=prices_df.index, columns=prices_df.columns)
-    for _, row in df_copy.iterrows():
-        if row['yf_ticker'] in holdings_df.columns:
-            holdings_df.loc[row['Data Acquisto']:, row['yf_ticker']] += row['n. share']
-    portfolio_daily_value = (holdings_df * prices_df).sum(axis=1)
-    return portfolio_daily_value[portfolio_daily_value > 0]
+        with np.load(percorso, allow_pickle=False) as dati:
+            return {
+                'date': pd.to_datetime(dati['date']), 'tickers': pd.Index(dati['tickers'].tolist(), name='Ticker'),
+                'valori': dati['valori'], 'flussi': dati['flussi'], 'dividendi': dati['dividendi'], 'contributi_cumulati': dati['contributi_cumulati'],
+                'ticker_mancanti': dati['ticker_mancanti'].tolist(),
+            }
+    except (OSError, KeyError, ValueError):
+        return None
+
+def _scrivi_posizioni_su_disco(chiave: str, posizioni: dict):
+    """Salva la matrice in .npz (scrittura atomica) e tiene solo i MAX_FILE_CACHE_POSIZIONI file più recenti."""
+    try:
+        os.makedirs(CARTELLA_CACHE_POSIZIONI, exist_ok=True)
+        percorso = os.path.join(CARTELLA_CACHE_POSIZIONI, f"{chiave}.npz")
+        percorso_tmp = f"{percorso}.tmp.npz"
+        np.savez(percorso_tmp, date=np.asarray(posizioni['date'].asi8, dtype=np.int64), tickers=np.array([str(t) for t in posizioni['tickers']]),
+                 valori=posizioni['valori'], flussi=posizioni['flussi'], dividendi=posizioni['dividendi'], contributi_cumulati=posizioni['contributi_cumulati'],
+                 ticker_mancanti=np.array([str(t) for t in posizioni['ticker_mancanti']]))
+        os.replace(percorso_tmp, percorso)
+        file_cache = sorted((os.path.join(CARTELLA_CACHE_POSIZIONI, f) for f in os.listdir(CARTELLA_CACHE_POSIZIONI) if f.endswith('.npz')), key=os.path.getmtime)
+        for vecchio in file_cache[:-MAX_FILE_CACHE_POSIZIONI]:
+            os.remove(vecchio)
+    except OSError:
+        pass  # come il registro dei simboli: senza disco scrivibile si lavora solo in memoria
+
+def calcola_valori_posizioni(transactions_df: pd.DataFrame, username: str = None) -> dict:
+    """
+    Matrice date × ticker del valore di ogni posizione (float32) con gli acquisti valorizzati ai prezzi del giorno
+    e le somme prefisse dei contributi di mercato (float64), per interrogare qualunque intervallo in O(ticker).
+    In cache in memoria per versione del portafoglio e su disco (.cache/posizioni) per sopravvivere ai riavvii.
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _calcola_valori_posizioni(transactions_df, versione=versione)
+
+@st.cache_data(ttl=3600, max_entries=8)
+def _calcola_valori_posizioni(transactions_df: pd.DataFrame, versione: int = 0):
+    chiave = _chiave_posizioni(transactions_df)
+    posizioni = _leggi_posizioni_da_disco(chiave)
+    if posizioni is not None: return posizioni
+    holdings_df, prices_df, dividendi_df, ticker_mancanti = _matrici_posizioni(transactions_df, versione=versione)
+    if prices_df.empty:
+        return {'date': pd.DatetimeIndex([]), 'tickers': pd.Index([], name='Ticker'), 'valori': np.empty((0, 0), np.float32),
+                'flussi': np.empty((0, 0), np.float32), 'dividendi': np.empty((0, 0), np.float32),
+                'contributi_cumulati': np.empty((0, 0)), 'ticker_mancanti': ticker_mancanti}
+    H, P = holdings_df.to_numpy(), np.nan_to_num(prices_df.to_numpy())
+    valori = H * P
+    # Acquisti del giorno valorizzati al prezzo del giorno: il contributo resta la sola variazione di prezzo delle quote possedute
+    flussi = np.diff(H, axis=0, prepend=0.0) * P
+    # Dividendi maturati in un'unica operazione: quote possedute alla vigilia dello stacco × dividendo per azione
+    dividendi = np.vstack([np.zeros((1, H.shape[1])), H[:-1]]) * dividendi_df.to_numpy()
+    contributi = np.diff(valori, axis=0, prepend=0.0) - flussi
+    posizioni = {
+        'date': prices_df.index, 'tickers': _nomi_ticker(transactions_df, prices_df.columns),
+        'valori': valori.astype(np.float32), 'flussi': flussi.astype(np.float32), 'dividendi': dividendi.astype(np.float32),
+        'contributi_cumulati': np.cumsum(contributi, axis=0), 'ticker_mancanti': ticker_mancanti,
+    }
+    _scrivi_posizioni_su_disco(chiave, posizioni)
+    return posizioni
+
+def _indici_intervallo(date: pd.DatetimeIndex, inizio, fine):
+    """Primo e ultimo indice di borsa dentro [inizio, fine] (con ricerca binaria)."""
+    i = date.searchsorted(pd.Timestamp(inizio), side='left')
+    j = date.searchsorted(pd.Timestamp(fine), side='right') - 1
+    return i, j
+
+def attribuzione_periodo(posizioni: dict, inizio, fine) -> pd.DataFrame:
+    """
+    Scompone la variazione di valore di ogni ticker in [inizio, fine]:
+    Valore Finale = Valore Iniziale + Acquisti + Contributo (variazione di prezzo delle quote possedute);
+    i 'Dividendi' incassati nell'intervallo sono liquidità e restano fuori dal valore.
+    """
+    i, j = _indici_intervallo(posizioni['date'], inizio, fine)
+    tickers = posizioni['tickers']
+    if j < i: return pd.DataFrame(columns=['Valore Iniziale', 'Acquisti', 'Contributo', 'Dividendi', 'Valore Finale'], index=tickers[:0])
+    cumulati = posizioni['contributi_cumulati']
+    base = cumulati[i - 1] if i > 0 else 0.0
+    return pd.DataFrame({
+        'Valore Iniziale': posizioni['valori'][i - 1].astype(np.float64) if i > 0 else np.zeros(len(tickers)),
+        'Acquisti': posizioni['flussi'][i:j + 1].sum(axis=0, dtype=np.float64),
+        'Contributo': cumulati[j] - base,
+        'Dividendi': posizioni['dividendi'][i:j + 1].sum(axis=0, dtype=np.float64),
+        'Valore Finale': posizioni['valori'][j].astype(np.float64),
+    }, index=tickers)
+
+def top_contributori(attribuzione: pd.DataFrame, n: int = 10):
+    """(migliori, peggiori) n ticker per contributo, con argpartition invece di un ordinamento completo."""
+    contributi = attribuzione['Contributo'].to_numpy()
+    n = min(n, len(contributi))
+    if n == 0: return attribuzione.iloc[:0], attribuzione.iloc[:0]
+    migliori = np.argpartition(-contributi, n - 1)[:n]
+    peggiori = np.argpartition(contributi, n - 1)[:n]
+    return (attribuzione.iloc[migliori].sort_values('Contributo', ascending=False),
+            attribuzione.iloc[peggiori].sort_values('Contributo'))
+
+def contributi_per_periodo(posizioni: dict, inizio, fine, frequenza: str = 'M') -> pd.DataFrame:
+    """Contributi per ticker aggregati per periodo ('D', 'W', 'M', 'Q'): differenze delle somme prefisse a fine periodo."""
+    i, j = _indici_intervallo(posizioni['date'], inizio, fine)
+    if j < i: return pd.DataFrame(columns=posizioni['tickers'])
+    date = posizioni['date'][i:j + 1]
+    periodi = date.to_period(frequenza)
+    fine_periodo = np.flatnonzero(np.append(periodi[1:] != periodi[:-1], True)) + i
+    cumulati = posizioni['contributi_cumulati']
+    livelli = np.vstack([cumulati[i - 1] if i > 0 else np.zeros(cumulati.shape[1]), cumulati[fine_periodo]])
+    return pd.DataFrame(np.diff(livelli, axis=0), index=periodi[fine_periodo - i], columns=posizioni['tickers'])
+
+# --- FOTOGRAFIA DEL PORTAFOGLIO A UNA DATA (interrogazioni as-of) ---
+COLONNE_FOTOGRAFIA = COLONNE_VALUTAZIONE + ['Cost Base']
+
+def indice_storico_portafoglio(transactions_df: pd.DataFrame, username: str = None) -> dict:
+    """
+    Indice per interrogare il portafoglio a qualunque data: transazioni ordinate per (ticker, 'Data Acquisto') con le
+    somme prefisse di quote e costo di ogni ticker, più le chiusure in EUR già in cache. Si costruisce una volta per
+    versione del portafoglio; ogni `fotografia_portafoglio` costa poi una ricerca binaria per ticker.
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _indice_storico_portafoglio(transactions_df, versione=versione)
+
+@st.cache_data(ttl=3600, max_entries=8)
+def _indice_storico_portafoglio(transactions_df: pd.DataFrame, versione: int = 0):
+    df = transactions_df.dropna(subset=['Data Acquisto'])
+    if 'yf_ticker' not in df.columns:
+        df = df.assign(yf_ticker=clean_ticker_for_yf(df['Ticker']))
+    # Stessi argomenti di _matrici_posizioni: i prezzi arrivano dalla cache dei download
+    prezzi, yf_mancanti, _, eventi = scarica_prezzi_in_euro(tuple(df['yf_ticker'].unique().tolist()), df['Data Acquisto'].min())
+    df = df.sort_values(['Ticker', 'Data Acquisto'], kind='stable')
+    tickers = pd.Index(df['Ticker'].unique(), name='Ticker')
+    codici = tickers.get_indexer(df['Ticker'])
+    quote = df['n. share'].to_numpy(dtype=float)
+    fattori = fattori_frazionamento(df[['yf_ticker', 'Data Acquisto']], eventi['frazionamenti']) if not prezzi.empty else np.ones(len(df))
+    somma_prefissa = lambda valori: pd.Series(valori).groupby(codici).cumsum().to_numpy()
+    simboli = df.drop_duplicates('Ticker').set_index('Ticker')['yf_ticker'].reindex(tickers)
+    return {
+        'tickers': tickers,
+        'chiavi': codici.astype(np.int64) * SCALA_CHIAVE_GIORNO + _giorni(df['Data Acquisto']),
+        'inizio_ticker': np.searchsorted(codici, np.arange(len(tickers))),
+        'quote_cumulate': somma_prefissa(quote),
+        'quote_rettificate_cumulate': somma_prefissa(quote * fattori),  # nelle unità dei prezzi Yahoo
+        'costo_cumulato': somma_prefissa(df['Cost Base'].to_numpy(dtype=float)),
+        'date_prezzi': prezzi.index,
+        'prezzi': prezzi.ffill().reindex(columns=simboli.to_numpy()).to_numpy(),
+        'ticker_mancanti': sorted(df.loc[df['yf_ticker'].isin(yf_mancanti), 'Ticker'].unique().tolist()),
+    }
+
+def fotografia_portafoglio(indice: dict, data) -> pd.DataFrame:
+    """
+    Posizioni aperte a fine giornata di `data`: 'Quote', 'Cost Base', 'PMC' (costo medio per quota), 'Prezzo' (ultima
+    chiusura in EUR non successiva a `data`), 'Valore' e 'Peso'. Nessuna scansione delle transazioni: una ricerca binaria
+    vettoriale per tutti i ticker sulle chiavi (ticker, giorno) e una sulle date dei prezzi.
+    """
+    colonne = ['Quote', 'Cost Base', 'PMC', 'Prezzo', 'Valore', 'Peso']
+    tickers = indice['tickers']
+    if not len(tickers): return pd.DataFrame(columns=colonne, index=pd.Index([], name='Ticker'))
+    data = pd.Timestamp(data).normalize()
+    codici = np.arange(len(tickers), dtype=np.int64)
+    ultima = np.searchsorted(indice['chiavi'], codici * SCALA_CHIAVE_GIORNO + _giorni([data])[0], side='right') - 1
+    aperte = ultima >= indice['inizio_ticker']
+    posizione = np.where(aperte, ultima, 0)
+    prendi = lambda somme: np.where(aperte, somme[posizione], 0.0)
+    quote, costo = prendi(indice['quote_cumulate']), prendi(indice['costo_cumulato'])
+    riga_prezzo = indice['date_prezzi'].searchsorted(data, side='right') - 1
+    prezzi = indice['prezzi'][riga_prezzo] if riga_prezzo >= 0 else np.full(len(tickers), np.nan)
+    valore = prendi(indice['quote_rettificate_cumulate']) * prezzi
+    fotografia = pd.DataFrame({
+        'Quote': quote, 'Cost Base': costo, 'PMC': np.divide(costo, quote, out=np.full(len(quote), np.nan), where=quote > 0),
+        'Prezzo': np.divide(valore, quote, out=np.full(len(quote), np.nan), where=quote > 0),  # per quota del foglio
+        'Valore': valore,
+    }, index=tickers)
+    fotografia = fotografia[fotografia['Quote'] > 1e-9]
+    fotografia['Peso'] = fotografia['Valore'] / fotografia['Valore'].sum()
+    return fotografia
+
+# --- RENDIMENTI MONEY-WEIGHTED (XIRR) E TIME-WEIGHTED (TWR) ---
+def xirr_vettoriale(importi: np.ndarray, anni: np.ndarray, gruppi: np.ndarray, iterazioni: int = 100, tolleranza: float = 1e-10):
+    """
+    XIRR di più serie di flussi risolte insieme. I flussi sono vettori piatti; `gruppi` (interi 0..k-1) indica la serie,
+    `anni` è la distanza (≤ 0) dalla data di valutazione. Ibrido Newton/bisezione: ogni serie mantiene un intervallo
+    che contiene la radice e si usa il passo di Newton solo se resta al suo interno. Ogni iterazione costa O(n. flussi).
+    """
+    k = int(gruppi.max()) + 1 if len(gruppi) else 0
+    def vna(tassi, con_derivata=False):
+        base = 1.0 + tassi[gruppi]
+        with np.errstate(over='ignore', invalid='ignore'):
+            fattori = base ** (-anni)
+            valore = np.bincount(gruppi, importi * fattori, minlength=k)
+            if not con_derivata: return valore
+            return valore, np.bincount(gruppi, -anni * importi * fattori / base, minlength=k)
+
+    basso, alto = np.full(k, -0.9999), np.full(k, 1.0)
+    f_basso, f_alto = vna(basso), vna(alto)
+    # Allarga l'estremo superiore finché la VNA non cambia segno (o il tasso diventa assurdo)
+    for _ in range(20):
+        da_allargare = np.sign(f_alto) == np.sign(f_basso)
+        if not da_allargare.any(): break
+        alto = np.where(da_allargare, alto * 4 + 1, alto)
+        f_alto = np.where(da_allargare, vna(alto), f_alto)
+    valido = (np.sign(f_alto) != np.sign(f_basso)) & np.isfinite(f_alto)
+
+    tassi = np.where(valido, 0.1, np.nan).clip(basso, alto)
+    for _ in range(iterazioni):
+        valore, derivata = vna(np.nan_to_num(tassi), con_derivata=True)
+        lato_basso = np.sign(valore) == np.sign(f_basso)
+        basso = np.where(lato_basso, tassi, basso)
+        alto = np.where(lato_basso, alto, tassi)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = tassi - valore / derivata
+        fuori = ~np.isfinite(newton) | (newton <= basso) | (newton >= alto)
+        nuovi = np.where(fuori, (basso + alto) / 2, newton)
+        convergenza = np.abs(nuovi - tassi) < tolleranza
+        tassi = nuovi
+        if np.all(convergenza | ~valido): break
+    return np.where(valido, tassi, np.nan)
+
+def calcola_xirr(transactions_df: pd.DataFrame, valori_finali: pd.Series, data_valutazione=None) -> pd.Series:
+    """
+    XIRR per ticker e per l'intero portafoglio ('Portafoglio'): uscite = 'Importo Operazione' (o 'Cost Base' se assente)
+    alla 'Data Acquisto', con le vendite come entrate; entrata finale = valore attuale di ogni ticker alla data di
+    valutazione (oggi se non indicata).
+    """
+    data_valutazione = pd.Timestamp(data_valutazione) if data_valutazione is not None else pd.Timestamp.now().normalize()
+    importi = transactions_df['Importo Operazione' if 'Importo Operazione' in transactions_df.columns else 'Cost Base']
+    flussi = pd.concat([
+        pd.DataFrame({'Ticker': transactions_df['Ticker'].to_numpy(), 'Importo': -importi.to_numpy(dtype=float),
+                      'Anni': ((transactions_df['Data Acquisto'] - data_valutazione).dt.days / 365.0).to_numpy()}),
+        pd.DataFrame({'Ticker': valori_finali.index, 'Importo': valori_finali.to_numpy(dtype=float), 'Anni': 0.0}),
+    ], ignore_index=True)
+    flussi = pd.concat([flussi, flussi.assign(Ticker='Portafoglio')], ignore_index=True)
+    codici, tickers = pd.factorize(flussi['Ticker'])
+    tassi = xirr_vettoriale(flussi['Importo'].to_numpy(), np.minimum(flussi['Anni'].to_numpy(), 0.0), codici)
+    return pd.Series(tassi, index=tickers, name='XIRR')
+
+def calcola_twr(transactions_df: pd.DataFrame, username: str = None) -> pd.DataFrame:
+    """
+    Rendimento time-weighted per ticker e per il portafoglio, neutrale rispetto a tempi e importi dei versamenti:
+    ogni giorno conta solo la variazione di prezzo delle quote già possedute il giorno prima.
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _calcola_twr(transactions_df, versione=versione)
+
+@st.cache_data(ttl=3600)
+def _calcola_twr(transactions_df: pd.DataFrame, versione: int = 0):
+    holdings_df, prices_df, dividendi_df, _ = _matrici_posizioni(transactions_df, versione=versione)
+    if prices_df.empty: return pd.DataFrame(columns=['TWR', 'TWR Annualizzato', 'Giorni'])
+    H_prec, P, P_prec = holdings_df.shift(1).to_numpy(), prices_df.to_numpy(), prices_df.shift(1).to_numpy()
+    # Rendimento totale: al prezzo del giorno si aggiunge l'eventuale dividendo staccato
+    P_totale = P + dividendi_df.to_numpy()
+    attivi = (H_prec > 0) & np.isfinite(P) & np.isfinite(P_prec)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fattori_ticker = np.where(attivi, P_totale / P_prec, 1.0)
+        numeratore = np.where(attivi, H_prec * P_totale, 0.0).sum(axis=1)
+        denominatore = np.where(attivi, H_prec * P_prec, 0.0).sum(axis=1)
+        fattori_portafoglio = np.where(denominatore > 0, numeratore / denominatore, 1.0)
+    twr = np.append(fattori_ticker.prod(axis=0), fattori_portafoglio.prod()) - 1.0
+
+    date = prices_df.index
+    posseduti = holdings_df.to_numpy() > 0
+    primo_giorno = np.where(posseduti.any(axis=0), posseduti.argmax(axis=0), len(date) - 1)
+    giorni = np.append((date[-1] - date[primo_giorno]).days, (date[-1] - date[primo_giorno.min()]).days)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        annualizzato = np.where(giorni > 0, (1 + twr) ** (365.0 / np.maximum(giorni, 1)) - 1, np.nan)
+
+    nomi = _nomi_ticker(transactions_df, prices_df.columns)
+    risultato = pd.DataFrame({'TWR': twr, 'TWR Annualizzato': annualizzato, 'Giorni': giorni}, index=list(nomi) + ['Portafoglio'])
+    return risultato[(risultato['Giorni'] > 0) | (risultato.index == 'Portafoglio')]
+
+# --- CORRELAZIONI E COVARIANZE TRA TICKER ---
+GIORNI_BORSA_ANNO = 252
+
+def calcola_rendimenti_per_ticker(transactions_df: pd.DataFrame, username: str = None):
+    """
+    Matrice date × ticker dei rendimenti giornalieri (prezzi in EUR), con NaN prima del primo acquisto di ogni ticker.
+    Le colonne usano il nome del 'Ticker' del foglio; stessa versione del dataset 'valutazione'.
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _calcola_rendimenti_per_ticker(transactions_df, versione=versione)
+
+@st.cache_data(ttl=3600)
+def _calcola_rendimenti_per_ticker(transactions_df: pd.DataFrame, versione: int = 0):
+    if transactions_df.empty: return pd.DataFrame()
+    df_copy = transactions_df.copy()
+    if 'yf_ticker' not in df_copy.columns:
+        df_copy['yf_ticker'] = clean_ticker_for_yf(df_copy['Ticker'])
+    prices_df, _, _, _ = scarica_prezzi_in_euro(tuple(df_copy['yf_ticker'].unique().tolist()), df_copy['Data Acquisto'].min())
+    if prices_df.empty: return pd.DataFrame()
+    rendimenti = prices_df.ffill().pct_change(fill_method=None).iloc[1:]
+    # Mascheriamo i giorni precedenti al primo acquisto: il titolo non era in portafoglio
+    primo_acquisto = df_copy.groupby('yf_ticker')['Data Acquisto'].min().reindex(rendimenti.columns)
+    rendimenti = rendimenti.where(rendimenti.index.to_numpy()[:, None] >= primo_acquisto.to_numpy()[None, :])
+    nomi = df_copy.drop_duplicates('yf_ticker').set_index('yf_ticker')['Ticker']
+    return rendimenti.rename(columns=nomi).dropna(axis=1, how='all').astype('float64')
+
+def _standardizza_colonne(X: np.ndarray):
+    """Centra le colonne sulla media (ignorando i NaN) e sostituisce i mancanti con 0, cioè con la media stessa."""
+    centrata = X - np.nanmean(X, axis=0)
+    return np.nan_to_num(centrata, nan=0.0)
+
+def covarianza_ledoit_wolf(X: np.ndarray):
+    """
+    Stimatore di Ledoit-Wolf con target identità scalata: Σ = δ·μI + (1-δ)·S.
+    Restituisce (covarianza, intensità δ). Tutto in forma chiusa, senza cicli sulle osservazioni.
+    """
+    Xc = _standardizza_colonne(X)
+    n, p = Xc.shape
+    S = Xc.T @ Xc / n
+    mu = np.trace(S) / p
+    target = mu * np.eye(p)
+    d2 = np.sum((S - target) ** 2)
+    # Σ_k ||x_k x_k' - S||² = Σ_k ||x_k||⁴ - n·||S||²
+    b2 = (np.sum(np.sum(Xc ** 2, axis=1) ** 2) - n * np.sum(S ** 2)) / n ** 2
+    delta = float(np.clip(b2 / d2, 0.0, 1.0)) if d2 > 0 else 1.0
+    return delta * target + (1 - delta) * S, delta
+
+def covarianza_campionaria(X: np.ndarray):
+    """Covarianza campionaria (n-1) calcolata come un unico prodotto matriciale."""
+    Xc = _standardizza_colonne(X)
+    return Xc.T @ Xc / max(len(Xc) - 1, 1)
+
+def covarianza_in_correlazione(cov: np.ndarray):
+    deviazioni = np.sqrt(np.clip(np.diag(cov), 1e-18, None))
+    corr = cov / np.outer(deviazioni, deviazioni)
+    np.fill_diagonal(corr, 1.0)
+    return np.clip(corr, -1.0, 1.0)
+
+def ordine_cluster(corr: np.ndarray):
+    """
+    Ordine delle foglie di un clustering gerarchico (average linkage) sulla distanza 1 - ρ,
+    così i ticker correlati finiscono vicini nella heatmap. Solo NumPy: p-1 fusioni su una matrice p × p.
+    """
+    p = len(corr)
+    if p < 3: return list(range(p))
+    D = 1.0 - corr.astype(float)
+    np.fill_diagonal(D, np.inf)
+    membri = {i: [i] for i in range(p)}
+    for _ in range(p - 1):
+        i, j = np.unravel_index(np.argmin(D), D.shape)
+        if i > j: i, j = j, i
+        ni, nj = len(membri[i]), len(membri[j])
+        nuova = (ni * D[i] + nj * D[j]) / (ni + nj)
+        D[i, :], D[:, i] = nuova, nuova
+        D[i, i] = np.inf
+        D[j, :], D[:, j] = np.inf, np.inf
+        membri[i] = membri[i] + membri.pop(j)
+    return next(iter(membri.values()))
+
+def correlazione_media_mobile(X: np.ndarray, finestra: int, passo: int = 1, blocco: int = 32):
+    """
+    Correlazione media tra tutte le coppie su finestre mobili.
+    Sfrutta Σ_ij ρ_ij = Var(Σ_i z_i): per ogni finestra basta sommare i rendimenti standardizzati,
+    quindi il costo è O(finestre × giorni × ticker) invece di una matrice p × p per finestra.
+    Le finestre sono elaborate a blocchi di dimensione fissa per limitare la memoria.
+    """
+    n, p = X.shape
+    if n < finestra or p < 2: return np.array([]), np.array([], dtype=int)
+    viste = np.lib.stride_tricks.sliding_window_view(X, finestra, axis=0)[::passo]  # (w, p, finestra), senza copie
+    risultati = []
+    for inizio in range(0, len(viste), blocco):
+        finestre = viste[inizio:inizio + blocco]
+        validi = ~np.isnan(finestre)
+        conteggi = validi.sum(axis=2)
+        medie = np.nansum(finestre, axis=2) / np.maximum(conteggi, 1)
+        centrate = np.where(validi, finestre - medie[..., None], 0.0)
+        deviazioni = np.sqrt((centrate ** 2).sum(axis=2) / np.maximum(conteggi - 1, 1))
+        attivi = (conteggi >= max(finestra // 2, 2)) & (deviazioni > 0)
+        z = np.where(attivi[..., None], centrate / np.where(deviazioni > 0, deviazioni, 1.0)[..., None], 0.0)
+        somma_rho = (z.sum(axis=1) ** 2).sum(axis=1) / (finestra - 1)
+        k = attivi.sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            risultati.append(np.where(k >= 2, (somma_rho - k) / (k * (k - 1)), np.nan))
+    fine_finestra = np.arange(finestra - 1, n)[::passo]
+    return np.concatenate(risultati), fine_finestra
+
+def calcola_correlazioni(transactions_df: pd.DataFrame, username: str = None, finestra: int = 252, stimatore: str = 'shrinkage'):
+    """
+    Matrici di correlazione e covarianza (annualizzata) tra i ticker posseduti sugli ultimi `finestra` giorni,
+    in ordine di cluster, più la correlazione media mobile. In cache per (versione del portafoglio, finestra, stimatore).
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _calcola_correlazioni(transactions_df, versione, finestra, stimatore)
+
+@st.cache_data(ttl=3600, max_entries=32)
+def _calcola_correlazioni(transactions_df: pd.DataFrame, versione: int, finestra: int, stimatore: str):
+    rendimenti = _calcola_rendimenti_per_ticker(transactions_df, versione=versione)
+    if rendimenti.empty: return {}
+    recenti = rendimenti.iloc[-finestra:]
+    # Servono almeno metà delle osservazioni della finestra per stimare la correlazione di un ticker
+    recenti = recenti.loc[:, recenti.notna().sum() >= max(len(recenti) // 2, 2)]
+    if recenti.shape[1] < 2: return {}
+    X = recenti.to_numpy()
+    if stimatore == 'shrinkage':
+        cov, intensita = covarianza_ledoit_wolf(X)
+    else:
+        cov, intensita = covarianza_campionaria(X), 0.0
+    corr = covarianza_in_correlazione(cov)
+    ordine = ordine_cluster(corr)
+    nomi = recenti.columns[ordine]
+    storico = rendimenti[recenti.columns].to_numpy()
+    # Al massimo ~250 punti sulla curva mobile, indipendentemente dalla lunghezza dello storico
+    passo = max(1, (len(storico) - finestra + 1) // 250)
+    media_mobile, fine = correlazione_media_mobile(storico, finestra, passo=passo)
+    return {
+        'correlazione': pd.DataFrame(corr[np.ix_(ordine, ordine)], index=nomi, columns=nomi),
+        'covarianza': pd.DataFrame(cov[np.ix_(ordine, ordine)] * GIORNI_BORSA_ANNO, index=nomi, columns=nomi),
+        'intensita_shrinkage': intensita,
+        'osservazioni': len(recenti),
+        'correlazione_media_mobile': pd.Series(media_mobile, index=rendimenti.index[fine], name='Correlazione media'),
+    }
+
+# --- OTTIMIZZAZIONE DEL PORTAFOGLIO (solo NumPy) ---
+DIMENSIONE_BLOCCO_CAMPIONI = 4096
+MIN_OSSERVAZIONI_OTTIMIZZAZIONE = 60
+
+def proietta_sul_simplesso(V: np.ndarray):
+    """Proiezione euclidea di ogni riga di V sul simplesso {w ≥ 0, Σw = 1} (algoritmo per ordinamento, vettorizzato sulle righe)."""
+    V = np.atleast_2d(V)
+    U = -np.sort(-V, axis=1)
+    cumulate = np.cumsum(U, axis=1) - 1.0
+    indici = np.arange(1, V.shape[1] + 1)
+    rho = (U - cumulate / indici > 0).sum(axis=1) - 1
+    theta = cumulate[np.arange(len(V)), rho] / (rho + 1)
+    return np.maximum(V - theta[:, None], 0.0)
+
+def _statistiche_pesi(W: np.ndarray, mu: np.ndarray, cov: np.ndarray, tasso_privo_rischio: float):
+    """Rendimento, volatilità e Sharpe annualizzati per ogni riga di W."""
+    rendimento = W @ mu
+    volatilita = np.sqrt(np.maximum(((W @ cov) * W).sum(axis=1), 0.0))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sharpe = np.where(volatilita > 0, (rendimento - tasso_privo_rischio) / volatilita, np.nan)
+    return rendimento, volatilita, sharpe
+
+def campiona_portafogli_casuali(mu, cov, n_portafogli: int = 20000, tasso_privo_rischio: float = 0.0, seme: int = 0):
+    """
+    Portafogli casuali (pesi di Dirichlet) valutati a blocchi di dimensione fissa: la memoria resta
+    DIMENSIONE_BLOCCO_CAMPIONI × n_asset qualunque sia il numero di campioni. Restituisce (rendimenti, volatilità, sharpe).
+    """
+    rng = np.random.default_rng(seme)
+    risultati = []
+    for inizio in range(0, n_portafogli, DIMENSIONE_BLOCCO_CAMPIONI):
+        W = rng.dirichlet(np.full(len(mu), 0.5), size=min(DIMENSIONE_BLOCCO_CAMPIONI, n_portafogli - inizio))
+        risultati.append(_statistiche_pesi(W, mu, cov, tasso_privo_rischio))
+    return tuple(np.concatenate(parti) for parti in zip(*risultati))
+
+def _passo_lipschitz(cov: np.ndarray):
+    # La norma di Frobenius maggiora l'autovalore massimo: passo sicuro senza decomposizioni
+    return 1.0 / (2.0 * max(np.linalg.norm(cov), 1e-12))
+
+def frontiera_efficiente(mu, cov, n_punti: int = 40, iterazioni: int = 500):
+    """
+    Frontiera efficiente long-only: minimizza w'Σw - λ·w'μ per una griglia di avversioni λ,
+    risolvendo tutti i punti insieme con gradiente proiettato accelerato (una matrice n_punti × n_asset).
+    """
+    passo = _passo_lipschitz(cov)
+    scala = np.linalg.norm(cov) / max(np.abs(mu).max(), 1e-12)
+    lambdas = np.concatenate([[0.0], np.geomspace(1e-3, 1e2, n_punti - 1)]) * scala
+    W = np.full((n_punti, len(mu)), 1.0 / len(mu))
+    Y, t = W.copy(), 1.0
+    for _ in range(iterazioni):
+        gradiente = 2.0 * Y @ cov - lambdas[:, None] * mu[None, :]
+        W_nuovo = proietta_sul_simplesso(Y - passo * gradiente)
+        t_nuovo = (1 + np.sqrt(1 + 4 * t * t)) / 2
+        Y = W_nuovo + ((t - 1) / t_nuovo) * (W_nuovo - W)
+        W, t = W_nuovo, t_nuovo
+    return W
+
+def portafoglio_massimo_sharpe(mu, cov, tasso_privo_rischio: float = 0.0, iterazioni: int = 1000, pesi_iniziali=None):
+    """Massimo Sharpe long-only con gradiente proiettato e backtracking (il rapporto non è convesso: si parte da un buon candidato)."""
+    def sharpe(w):
+        volatilita = np.sqrt(max(w @ cov @ w, 1e-18))
+        return (w @ mu - tasso_privo_rischio) / volatilita, volatilita
+    w = np.full(len(mu), 1.0 / len(mu)) if pesi_iniziali is None else np.asarray(pesi_iniziali, dtype=float)
+    valore, volatilita = sharpe(w)
+    passo = 1.0
+    for _ in range(iterazioni):
+        eccesso = w @ mu - tasso_privo_rischio
+        gradiente = mu / volatilita - eccesso * (cov @ w) / volatilita ** 3
+        while passo > 1e-10:
+            candidato = proietta_sul_simplesso(w + passo * gradiente)[0]
+            valore_candidato, volatilita_candidata = sharpe(candidato)
+            if valore_candidato >= valore: break
+            passo /= 2
+        else:
+            break
+        miglioramento = valore_candidato - valore
+        w, valore, volatilita, passo = candidato, valore_candidato, volatilita_candidata, passo * 2
+        if miglioramento < 1e-12: break
+    return w
+
+def pesi_da_sequenza(sequenza: list, tickers) -> pd.Series:
+    """Pesi obiettivo impliciti nella 'Sequenza Guidata': ogni comparsa di un ticker vale una quota uguale."""
+    conteggi = pd.Series(sequenza, dtype=object).value_counts()
+    pesi = conteggi.reindex(tickers).fillna(0.0)
+    return pesi / pesi.sum() if pesi.sum() > 0 else pesi
+
+def suggerisci_ribilanciamento(valori_correnti: pd.Series, pesi_obiettivo: pd.Series) -> pd.DataFrame:
+    """Differenze tra pesi attuali e obiettivo con l'importo (€) da acquistare (+) o ridurre (-) per ciascun ticker."""
+    tickers = valori_correnti.index.union(pesi_obiettivo.index)
+    valori = valori_correnti.reindex(tickers).fillna(0.0)
+    totale = valori.sum()
+    tabella = pd.DataFrame({'Peso Attuale': valori / totale if totale else 0.0, 'Peso Obiettivo': pesi_obiettivo.reindex(tickers).fillna(0.0)})
+    tabella['Differenza'] = tabella['Peso Obiettivo'] - tabella['Peso Attuale']
+    tabella['Importo (€)'] = tabella['Differenza'] * totale
+    return tabella.sort_values('Importo (€)', ascending=False)
+
+def calcola_ottimizzazione(transactions_df: pd.DataFrame, username: str = None, tasso_privo_rischio: float = 0.0):
+    """
+    Frontiera efficiente, portafoglio a minima varianza e a massimo Sharpe sui ticker posseduti,
+    partendo dagli stessi rendimenti della valutazione storica. In cache per versione del portafoglio.
+    """
+    versione = _richiedi_dataset('valutazione', username) if username else 0
+    return _calcola_ottimizzazione(transactions_df, versione, tasso_privo_rischio)
+
+@st.cache_data(ttl=3600, max_entries=16)
+def _calcola_ottimizzazione(transactions_df: pd.DataFrame, versione: int, tasso_privo_rischio: float):
+    rendimenti = _calcola_rendimenti_per_ticker(transactions_df, versione=versione)
+    if rendimenti.empty: return {}
+    rendimenti = rendimenti.loc[:, rendimenti.notna().sum() >= MIN_OSSERVAZIONI_OTTIMIZZAZIONE]
+    if rendimenti.shape[1] < 2: return {}
+    X = rendimenti.to_numpy()
+    mu = np.nanmean(X, axis=0) * GIORNI_BORSA_ANNO
+    cov = covarianza_ledoit_wolf(X)[0] * GIORNI_BORSA_ANNO
+
+    frontiera = frontiera_efficiente(mu, cov)
+    pesi_min_varianza = frontiera[0]
+    rend_f, vol_f, sharpe_f = _statistiche_pesi(frontiera, mu, cov, tasso_privo_rischio)
+    rend_c, vol_c, sharpe_c = campiona_portafogli_casuali(mu, cov, tasso_privo_rischio=tasso_privo_rischio)
+    # Il miglior punto della frontiera è il punto di partenza del solutore per il massimo Sharpe
+    pesi_max_sharpe = portafoglio_massimo_sharpe(mu, cov, tasso_privo_rischio, pesi_iniziali=frontiera[np.nanargmax(sharpe_f)])
+
+    tickers = rendimenti.columns
+    return {
+        'tickers': list(tickers),
+        'mu': pd.Series(mu, index=tickers),
+        'cov': pd.DataFrame(cov, index=tickers, columns=tickers),
+        'frontiera': pd.DataFrame({'Volatilità': vol_f, 'Rendimento': rend_f, 'Sharpe': sharpe_f}).sort_values('Volatilità'),
+        # Per il grafico basta un sottoinsieme dei campioni
+        'campioni': pd.DataFrame({'Volatilità': vol_c, 'Rendimento': rend_c, 'Sharpe': sharpe_c}).iloc[::4],
+        'pesi': pd.DataFrame({'Minima Varianza': pesi_min_varianza, 'Massimo Sharpe': pesi_max_sharpe}, index=tickers),
+    }
+
+def statistiche_portafoglio(pesi: pd.Series, risultati: dict, tasso_privo_rischio: float = 0.0):
+    """(rendimento, volatilità, sharpe) annualizzati di un vettore di pesi sui ticker dell'ottimizzazione."""
+    w = pesi.reindex(risultati['tickers']).fillna(0.0).to_numpy()[None, :]
+    if w.sum() > 0: w = w / w.sum()
+    return tuple(float(x[0]) for x in _statistiche_pesi(w, risultati['mu'].to_numpy(), risultati['cov'].to_numpy(), tasso_privo_rischio))
+
+# --- SCENARI DI RISPARMIO E INVESTIMENTO (simulazione vettoriale scenario × mese) ---
+MESI_BASE_SCENARI = 12                      # mesi recenti da cui stimare reddito e tasso di risparmio di partenza
+MEMORIA_MASSIMA_SIMULAZIONE = 64 * 2**20    # byte di lavoro per blocco di scenari
+BYTE_PER_CELLA_SIMULAZIONE = 12 * 8         # array float64 vivi per ogni cella (scenario, mese) del blocco
+PERCENTILI_SCENARI = (5, 25, 50, 75, 95)
+
+def base_scenari(mensile_complessivo: pd.DataFrame, mesi: int = MESI_BASE_SCENARI) -> dict:
+    """Entrate e uscite medie e tasso di risparmio degli ultimi `mesi` mesi con entrate (dal cubo 'Entrate'/'Uscite')."""
+    con_entrate = mensile_complessivo[mensile_complessivo['Entrate'] > 0].iloc[-mesi:]
+    if con_entrate.empty: return {'entrate_mensili': 0.0, 'uscite_mensili': 0.0, 'tasso_risparmio': 0.0, 'mesi': 0}
+    entrate, uscite = con_entrate['Entrate'].mean(), con_entrate['Uscite'].mean()
+    return {'entrate_mensili': float(entrate), 'uscite_mensili': float(uscite), 'tasso_risparmio': float(1 - uscite / entrate), 'mesi': len(con_entrate)}
+
+def covarianza_comparti(pesi: pd.DataFrame, covarianza: pd.DataFrame) -> np.ndarray:
+    """
+    Covarianza annua (comparti × comparti) di portafogli ribilanciati con i pesi per colonna di `pesi` (ticker × comparto).
+    I ticker senza covarianza sono esclusi e i pesi rinormalizzati.
+    """
+    W = pesi.reindex(covarianza.index).fillna(0.0).to_numpy()
+    somme = W.sum(axis=0)
+    W = W / np.where(somme > 0, somme, 1.0)
+    return W.T @ covarianza.to_numpy() @ W
+
+def campiona_ipercubo_latino(n: int, intervalli: dict, seme: int = 0) -> dict:
+    """
+    n valori per parametro, uniformi negli intervalli {nome: (minimo, massimo)} e stratificati (Latin hypercube):
+    ogni parametro copre tutti gli n strati anche con pochi scenari, con combinazioni casuali tra i parametri.
+    """
+    rng = np.random.default_rng(seme)
+    campioni = {}
+    for nome, (minimo, massimo) in intervalli.items():
+        u = (rng.permutation(n) + rng.random(n)) / n
+        campioni[nome] = minimo + u * (massimo - minimo)
+    return campioni
+
+def _radice_covarianza(cov: np.ndarray) -> np.ndarray:
+    """L con L @ L.T = cov anche per matrici solo semidefinite (es. due comparti con gli stessi pesi)."""
+    autovalori, autovettori = np.linalg.eigh(cov)
+    return autovettori * np.sqrt(np.clip(autovalori, 0.0, None))
+
+def _percentili_righe(matrice: np.ndarray, percentili) -> np.ndarray:
+    """Percentili (interpolazione lineare, come np.percentile) di ogni riga; ordina `matrice` sul posto."""
+    matrice.sort(axis=1)  # un sort per riga è più rapido della partizione con più kth di np.percentile
+    posizioni = np.asarray(percentili, dtype=np.float64) / 100 * (matrice.shape[1] - 1)
+    sotto = np.floor(posizioni).astype(int)
+    sopra = np.minimum(sotto + 1, matrice.shape[1] - 1)
+    frazione = (posizioni - sotto)[:, None]
+    return (matrice[:, sotto].T * (1 - frazione) + matrice[:, sopra].T * frazione).astype(np.float64)
+
+def simula_patrimonio(valore_portafoglio: float, liquidita: float, entrate_mensili: float, cov_comparti: np.ndarray,
+                      tassi_risparmio, rendimenti_annui, inflazioni, quota_investita: float, mesi: int,
+                      percentili=PERCENTILI_SCENARI, seme: int = 0, memoria_massima: int = MEMORIA_MASSIMA_SIMULAZIONE) -> dict:
+    """
+    Patrimonio (portafoglio attuale + portafoglio dei nuovi contributi + liquidità) mese per mese, per tutti gli scenari.
+    Ogni scenario ha il suo tasso di risparmio (sulle entrate), rendimento annuo atteso e inflazione; entrate e risparmi
+    crescono con l'inflazione. I due comparti hanno rendimenti mensili lognormali correlati con `cov_comparti` (annua,
+    2 × 2) e lo stesso rendimento atteso; la quota di risparmio non investita resta liquidità a rendimento nullo.
+
+    Calcolo a blocchi di scenari, ciascuno interamente vettoriale sull'asse dei mesi: crescita cumulata con un cumsum
+    dei log-rendimenti e valore dei contributi come G_t · Σ c_k / G_k. Il blocco rispetta `memoria_massima` byte.
+    Restituisce i percentili (percentile × mese, mese 0 = oggi) nominali e reali e il patrimonio reale finale per scenario.
+    """
+    tassi_risparmio, rendimenti_annui, inflazioni = (np.asarray(x, dtype=np.float64) for x in (tassi_risparmio, rendimenti_annui, inflazioni))
+    n_scenari = len(tassi_risparmio)
+    L = _radice_covarianza(np.asarray(cov_comparti, dtype=np.float64) / 12)
+    varianze_mensili = np.einsum('ij,ij->i', L, L)
+    anni = np.arange(1, mesi + 1) / 12
+
+    # Risultati per mese × scenario: i percentili ordinano righe contigue
+    nominale = np.empty((mesi + 1, n_scenari), dtype=np.float32)
+    reale = np.empty((mesi + 1, n_scenari), dtype=np.float32)
+    nominale[0] = reale[0] = valore_portafoglio + liquidita
+    blocco = max(1, int(memoria_massima // (BYTE_PER_CELLA_SIMULAZIONE * max(mesi, 1))))
+    generatori = np.random.SeedSequence(seme).spawn(-(-n_scenari // blocco))
+    for inizio, seq in zip(range(0, n_scenari, blocco), generatori):
+        fine = min(inizio + blocco, n_scenari)
+        rng = np.random.default_rng(seq)
+        # Log-rendimenti mensili (scenario × mese × comparto) con media tale che E[1 + r] = (1 + R)^(1/12)
+        deriva = np.log1p(rendimenti_annui[inizio:fine])[:, None] / 12 - varianze_mensili[None, :] / 2
+        log_rendimenti = rng.standard_normal((fine - inizio, mesi, 2)) @ L.T
+        log_rendimenti += deriva[:, None, :]
+        crescita = np.exp(np.cumsum(log_rendimenti, axis=1, out=log_rendimenti), out=log_rendimenti)
+        del log_rendimenti
+        indicizzazione = (1 + inflazioni[inizio:fine, None]) ** anni[None, :]
+        risparmio = tassi_risparmio[inizio:fine, None] * entrate_mensili * indicizzazione
+        contributi = crescita[:, :, 1] * np.cumsum(quota_investita * risparmio / crescita[:, :, 1], axis=1)
+        patrimonio = valore_portafoglio * crescita[:, :, 0] + contributi + liquidita + np.cumsum((1 - quota_investita) * risparmio, axis=1)
+        nominale[1:, inizio:fine] = patrimonio.T
+        reale[1:, inizio:fine] = (patrimonio / indicizzazione).T
+
+    finale_reale = reale[-1].astype(np.float64)
+    return {
+        'percentili': list(percentili),
+        'nominale': _percentili_righe(nominale, percentili),
+        'reale': _percentili_righe(reale, percentili),
+        'finale_reale': finale_reale,
+    }
+
+@st.cache_data(max_entries=32)
+def proietta_patrimonio(valore_portafoglio: float, liquidita: float, entrate_mensili: float, cov_comparti: tuple,
+                        intervalli: tuple, quota_investita: float, mesi: int, n_scenari: int, seme: int = 0) -> dict:
+    """
+    Campiona `n_scenari` combinazioni di ('Tasso Risparmio', 'Rendimento', 'Inflazione') negli intervalli dati
+    (tupla di (nome, minimo, massimo)) e le simula con `simula_patrimonio`. In cache: tornare a un valore già
+    visto dei cursori è immediato. `cov_comparti` è una tupla di tuple per poter entrare nella chiave.
+    """
+    campioni = campiona_ipercubo_latino(n_scenari, {nome: (minimo, massimo) for nome, minimo, massimo in intervalli}, seme)
+    risultato = simula_patrimonio(valore_portafoglio, liquidita, entrate_mensili, np.array(cov_comparti), campioni['Tasso Risparmio'],
+                                  campioni['Rendimento'], campioni['Inflazione'], quota_investita, mesi, seme=seme)
+    risultato['campioni'] = campioni
+    return risultato
+
+# --- DIAGNOSTICA DEI CARICAMENTI (dati puri, sicuri dentro le funzioni in cache) ---
+def nuova_diagnostica(fonte: str) -> dict:
+    """Diagnostica strutturata di un caricamento: ancore trovate, righe lette, tempi, avvisi ed eventuale errore."""
+    return {'fonte': fonte, 'ancore': {}, 'righe_lette': 0, 'celle_lette': 0, 'colonne_mesi': 0, 'tempi_ms': {}, 'avvisi': [], 'errore': None}
+
+def mostra_diagnostica(diagnostiche):
+    """Vista di debug opzionale: mostra le diagnostiche restituite dai loader (da chiamare fuori dalla cache)."""
+    for diagnostica in diagnostiche:
+        if not diagnostica: continue
+        with st.expander(f"🔍 Debug: Caricamento Dati da Foglio '{diagnostica['fonte']}'"):
+            if diagnostica['errore']: st.error(diagnostica['errore'])
+            for avviso in diagnostica['avvisi']: st.warning(avviso)
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Righe lette", diagnostica['righe_lette'])
+            c2.metric("Colonne mesi", diagnostica['colonne_mesi'])
+            c3.metric("Tempo totale", f"{sum(diagnostica['tempi_ms'].values()):.0f} ms")
+            if diagnostica['celle_lette']: st.write("**Celle lette (solo righe e colonne necessarie):**", diagnostica['celle_lette'])
+            st.write("**Ancore trovate (indice di riga):**", diagnostica['ancore'])
+            st.write("**Tempi (ms):**", diagnostica['tempi_ms'])
 
 # --- FUNZIONI SPECIFICHE PER IL CASH FLOW ---
-@st.cache_data(ttl=600)
 def carica_configurazione_da_foglio(username: str):
 #   Legge il foglio 'appconfig' e restituisce config e df_config.
 #   Ora include anche la sequenza per l'inserimento guidato.
+    return _carica_configurazione_da_foglio(username, versione=_richiedi_dataset('appconfig', username))
+
+@st.cache_data(ttl=600)
+def _carica_configurazione_da_foglio(username: str, versione: int = 0):
+    _registra_miss('appconfig')
     try:
-        user_config = st.secrets.database.users[username]
-        user_creds = st.secrets.google_credentials[username]
-        google_sheet_name = user_config.sheet_name
-        client = get_gspread_client_for_user(dict(user_creds))
-        if client is None: return None, None
-        
-        config_sheet = client.open(google_sheet_name).worksheet("appconfig")
-        df_config = pd.DataFrame(config_sheet.get_all_records())
+        valori_config = leggi_valori_foglio(username, "appconfig")
+        if valori_config is None: return None, None
+        df_config = pd.DataFrame(valori_config[1:], columns=valori_config[0]) if valori_config else pd.DataFrame()
         
         # --- MODIFICA CHIAVE: Pulizia delle liste da valori vuoti ---
         def clean_list(series):
@@ -163,169 +1866,458 @@ def carica_configurazione_da_foglio(username: str):
             "Micro ENTRATE": sorted(clean_list(df_config["Micro ENTRATE"])),
             "Macro USCITE": clean_list(df_config["Macro USCITE"]),
             "Micro USCITE": sorted([item for item in micro_uscite_list if isinstance(item, str) and item.strip()]),
-            "Sequenza Guidata": clean_list(df_config["Sequenza Guidata"])
+            "Sequenza Guidata": clean_list(df_config["Sequenza Guidata"]),
+            "Simboli Yahoo": {}
         }
+        # Sostituzioni opzionali ticker foglio -> simbolo Yahoo (colonne 'Ticker Foglio' e 'Simbolo Yahoo')
+        if {"Ticker Foglio", "Simbolo Yahoo"} <= set(df_config.columns):
+            coppie = df_config[["Ticker Foglio", "Simbolo Yahoo"]].astype(str).apply(lambda col: col.str.strip())
+            coppie = coppie[(coppie["Ticker Foglio"] != '') & (coppie["Simbolo Yahoo"] != '')]
+            config["Simboli Yahoo"] = dict(zip(coppie["Ticker Foglio"], coppie["Simbolo Yahoo"]))
+        # Metodo di carico per le vendite (colonna opzionale 'Metodo Carico': 'FIFO' o 'Medio', predefinito FIFO)
+        metodo = clean_list(df_config["Metodo Carico"])[:1] if "Metodo Carico" in df_config.columns else []
+        config["Metodo Carico"] = next((m for m in METODI_CARICO if metodo and metodo[0].casefold() == m.casefold()), 'FIFO')
+        # Macro di appartenenza delle Micro USCITE, quando le colonne sono 'Micro USCITE <Macro>'
+        config["Macro per Micro"] = {}
+        for col in micro_uscite_cols:
+            macro = col.replace('Micro USCITE', '').strip()
+            if macro in config["Macro USCITE"]:
+                config["Macro per Micro"].update({micro: macro for micro in clean_list(df_config[col])})
         return config, df_config
     except Exception as e:
         st.error(f"Errore caricamento da 'appconfig': {e}"); return None, None
         
-@st.cache_data(ttl=600)
 def load_cash_flow_data(username: str, config: dict):
-    """Legge il foglio 'IN/OUT' e restituisce dati puliti."""
-    if not config: return {}, []
+    """
+    Legge il foglio 'IN/OUT' e restituisce il cubo categoria × mese del cash flow.
+    Il cubo viene costruito una sola volta qui: la pagina deve solo affettarlo e sommarlo.
+    """
+    return _load_cash_flow_data(username, config, versione=_richiedi_dataset('IN/OUT', username))
+
+@st.cache_data(ttl=600)
+def _load_cash_flow_data(username: str, config: dict, versione: int = 0):
+    _registra_miss('IN/OUT')
+    if not config: return {}
+    diagnostica = nuova_diagnostica('IN/OUT')
     try:
-        user_config = st.secrets.database.users[username]
-        user_creds = st.secrets.google_credentials[username]
-        google_sheet_name = user_config.sheet_name
-        client = get_gspread_client_for_user(user_creds)
-        if client is None: return {}, []
-
-        sheet_in_out = client.open(google_sheet_name).worksheet("IN/OUT")
-        all_values = sheet_in_out.get_all_values()
+        sezioni = {
+            'Totali': {'Entrate': 'TOTALE ENTRATE', 'Uscite': 'TOTALE USCITE'},
+            'Macro USCITE': {cat: cat for cat in config['Macro USCITE']},
+            'Micro USCITE': {cat: cat for cat in config['Micro USCITE']},
+            'Micro ENTRATE': {cat: cat for cat in config['Micro ENTRATE']},
+        }
+        ancore = tuple(sorted({ancora for etichette in sezioni.values() for ancora in etichette.values()}))
+        inizio = time.perf_counter()
+        lettura = condividi_lettura((username, "IN/OUT", ancore), lambda: leggi_cash_flow_a_blocchi(username, ancore))
+        diagnostica['tempi_ms']['lettura'] = (time.perf_counter() - inizio) * 1000
+        if lettura is None: return {}
+        inizio = time.perf_counter()
+        diagnostica['righe_lette'] = lettura['righe_colonna_b']
+        diagnostica['celle_lette'] = lettura['celle_lette']
+        if lettura['riga_mesi'] is None: return {}
+        diagnostica['ancore']['Macro ENTRATE'] = lettura['riga_mesi']
+        diagnostica['colonne_mesi'] = len(lettura['periodi'])
+
+        # Importi già convertiti in numeri, una riga per ancora trovata in colonna B (indice = riga del foglio, 0-based)
+        importi, indice_righe = lettura['importi'], lettura['righe']
+        blocchi = {}
+        for sezione, etichette in sezioni.items():
+            nomi = [nome for nome, ancora in etichette.items() if ancora in indice_righe]
+            mancanti = [ancora for ancora in etichette.values() if ancora not in indice_righe]
+            if mancanti: diagnostica['avvisi'].append(f"{sezione}: righe non trovate in colonna B: {', '.join(mancanti)}")
+            blocchi[sezione] = pd.DataFrame(importi[[indice_righe[etichette[nome]] for nome in nomi]], index=nomi, columns=lettura['periodi'])
+
+        mensile = pd.concat(blocchi, names=['Sezione', 'Categoria']).T
+        cubo = completa_cubo_cash_flow(mensile)
+        diagnostica['ancore'].update({ancora: lettura['righe_foglio'][ancora] for ancora in ('TOTALE ENTRATE', 'TOTALE USCITE') if ancora in indice_righe})
+        diagnostica['tempi_ms']['elaborazione'] = (time.perf_counter() - inizio) * 1000
+        cubo['diagnostica'] = diagnostica
+        return cubo
+    except Exception as e:
+        st.error(f"Errore caricamento da 'IN/OUT': {e}"); return {}
+
+def leggi_cash_flow_a_blocchi(username: str, ancore: tuple):
+    """
+    Legge da 'IN/OUT' solo ciò che serve al cubo: la colonna B (etichette), la riga dei mesi ('Macro ENTRATE' in
+    colonna B) e, per le sole righe delle `ancore`, le sole colonne dei mesi, convertite in importi blocco per blocco.
+    Restituisce None se la connessione fallisce, altrimenti un dizionario con 'periodi', 'importi' (righe trovate × mesi),
+    'righe' (ancora -> riga di 'importi'), 'righe_foglio' (ancora -> riga del foglio, 0-based) e i conteggi letti.
+    """
+    sheet = apri_worksheet(username, "IN/OUT")
+    if sheet is None: return None
+    colonna_b = pd.Series(esegui_chiamata_sheets(username, lambda: sheet.col_values(2)), dtype=object).str.strip()
+    lettura = {'righe_colonna_b': len(colonna_b), 'celle_lette': len(colonna_b), 'riga_mesi': None}
+    header_row_matches = colonna_b[colonna_b == 'Macro ENTRATE']
+    if header_row_matches.empty: return lettura
+    lettura['riga_mesi'] = int(header_row_matches.index[0])
+
+    # Asse dei mesi: le etichette 'MMM/YYYY' vengono convertite una volta sola in Period mensili
+    header_row_values = esegui_chiamata_sheets(username, lambda: sheet.row_values(lettura['riga_mesi'] + 1))
+    periodi_header = parse_mesi_ita(header_row_values)
+    col_mesi = np.flatnonzero(periodi_header.notna() & ~periodi_header.duplicated())
+    lettura['periodi'] = periodi_header[col_mesi]
+
+    # Prima riga in colonna B per ogni ancora presente, in ordine di foglio (per tratti contigui nella lettura)
+    indice_righe = pd.Series(colonna_b.index, index=colonna_b.values)
+    indice_righe = indice_righe[~indice_righe.index.duplicated(keep='first')].reindex(list(ancore)).dropna().astype(int).sort_values()
+    lettura['righe_foglio'] = indice_righe.to_dict()
+    lettura['righe'] = {ancora: i for i, ancora in enumerate(indice_righe.index)}
+    importi = np.zeros((len(indice_righe), len(col_mesi)))
+    if len(indice_righe) and len(col_mesi):
+        for righe_blocco, blocco in leggi_blocchi_foglio(username, sheet, indice_righe.to_numpy() + 1, col_mesi + 1):
+            posizioni = np.searchsorted(indice_righe.to_numpy() + 1, righe_blocco)
+            importi[posizioni] = converti_importi(pd.Series(blocco.ravel())).to_numpy().reshape(blocco.shape)
+    lettura['importi'] = importi
+    lettura['celle_lette'] += len(header_row_values) + importi.size
+    return lettura
+
+def completa_cubo_cash_flow(mensile: pd.DataFrame) -> dict:
+    """
+    Porta il cubo mensile su un PeriodIndex contiguo (mesi mancanti = 0) e precalcola i rollup.
+    Restituisce un dizionario con 'mensile', 'trimestrale', 'annuale' e 'anni' (decrescenti).
+    """
+    mensile = mensile.groupby(level=0).sum()
+    if not mensile.empty:
+        asse_mesi = pd.period_range(mensile.index.min(), mensile.index.max(), freq='M', name='Mese')
+        mensile = mensile.reindex(asse_mesi, fill_value=0)
+    return {
+        'mensile': mensile,
+        'trimestrale': mensile.groupby(mensile.index.asfreq('Q')).sum().rename_axis('Trimestre'),
+        'annuale': mensile.groupby(mensile.index.year).sum().rename_axis('Anno'),
+        'anni': sorted(mensile.index.year.unique().tolist(), reverse=True),
+    }
+
+@st.cache_data
+def unisci_storico_al_cubo(cubo: dict, entrate_storico: pd.Series, uscite_storico: pd.Series) -> dict:
+    """Aggiunge al cubo la sezione 'Storico' (Entrate/Uscite) allineando tutto sullo stesso asse mensile."""
+    entrate_storico, uscite_storico = (serie if isinstance(serie.index, pd.PeriodIndex) else indicizza_per_mese(serie)
+                                       for serie in (entrate_storico, uscite_storico))
+    storico = pd.concat({('Storico', 'Entrate'): entrate_storico, ('Storico', 'Uscite'): uscite_storico}, axis=1)
+    storico.columns.names = ['Sezione', 'Categoria']
+    mensile = pd.concat([cubo.get('mensile', pd.DataFrame()), storico], axis=1).fillna(0)
+    return completa_cubo_cash_flow(mensile)
+
+def seleziona_mesi(mensile: pd.DataFrame, mesi_selezionati) -> pd.DataFrame:
+    """Righe del cubo per i mesi scelti: una fetta contigua quando possibile, altrimenti una selezione posizionale."""
+    posizioni = mensile.index.get_indexer(pd.PeriodIndex(list(mesi_selezionati), freq='M'))
+    posizioni = np.unique(posizioni[posizioni >= 0])
+    if len(posizioni) == 0: return mensile.iloc[0:0]
+    if posizioni[-1] - posizioni[0] + 1 == len(posizioni):
+        return mensile.iloc[posizioni[0]:posizioni[-1] + 1]
+    return mensile.iloc[posizioni]
+
+def entrate_uscite_complessive(mensile: pd.DataFrame) -> pd.DataFrame:
+    """Entrate e Uscite mensili complessive: per ogni mese il massimo tra il dettaglio ('Totali') e il foglio 'Storico'."""
+    return pd.DataFrame({voce: np.maximum(mensile.get(('Totali', voce), 0.0), mensile.get(('Storico', voce), 0.0))
+                         for voce in ('Entrate', 'Uscite')}, index=mensile.index)
+
+# --- NUOVA FUNZIONE PER LEGGERE IL FOGLIO 'Storico' ---
+def load_historical_totals(username: str):
+    """
+    Legge il foglio 'Storico' e restituisce (entrate, uscite, diagnostica).
+    Le serie sono indicizzate per mese (PeriodIndex); la diagnostica si visualizza a parte con `mostra_diagnostica`.
+    """
+    return _load_historical_totals(username, versione=_richiedi_dataset('Storico', username))
+
+@st.cache_data(ttl=600)
+def _load_historical_totals(username: str, versione: int = 0):
+    _registra_miss('Storico')
+    diagnostica = nuova_diagnostica('Storico')
+    vuota = pd.Series(dtype=float, index=pd.PeriodIndex([], freq='M'))
+    try:
+        inizio = time.perf_counter()
+        all_values = leggi_valori_foglio(username, "Storico")
+        diagnostica['tempi_ms']['lettura'] = (time.perf_counter() - inizio) * 1000
+        if all_values is None:
+            diagnostica['errore'] = "Connessione a Google fallita."
+            return vuota, vuota, diagnostica
+
+        inizio = time.perf_counter()
         df_raw = pd.DataFrame(all_values)
-        
-        colonna_b_raw = df_raw.iloc[:, 1]
-        header_row_matches = colonna_b_raw[colonna_b_raw.str.strip() == 'Macro ENTRATE']
-        if header_row_matches.empty: return {}, []
-        
+        diagnostica['righe_lette'] = len(df_raw)
+        colonna_b = df_raw.iloc[:, 1].str.strip()
+
+        # 1. Trova l'header dei mesi
+        header_row_matches = colonna_b[colonna_b == 'STORICO']
+        if header_row_matches.empty:
+            diagnostica['errore'] = "Non ho trovato la parola 'STORICO' nella colonna B."
+            return vuota, vuota, diagnostica
         header_row_index = header_row_matches.index[0]
-        header_row_values = df_raw.iloc[header_row_index].tolist()
-        
-        master_headers_mesi = [h for h in header_row_values if isinstance(h, str) and '/' in h]
-        header_to_col_index = {h: i for i, h in enumerate(header_row_values) if h in master_headers_mesi}
-        
-        tables = {}
-        
-        def extract_specific_rows(df, categories_to_find, index_col_name='Categoria'):
-            rows = []
-            for cat in categories_to_find:
-                row_data = df[df.iloc[:, 1].str.strip() == cat]
-                if not row_data.empty:
-                    data = {mese: row_data.iloc[0, idx] for mese, idx in header_to_col_index.items()}
-                    data[index_col_name] = cat
-                    rows.append(data)
-            if not rows: return pd.DataFrame()
-            return pd.DataFrame(rows).set_index(index_col_name)
-
-        # --- MODIFICA CHIAVE QUI: CONTROLLO ANTI-CRASH ---
-        df_tot_entrate = extract_specific_rows(df_raw, ['TOTALE ENTRATE'], 'Totale')
-        tables['total_entrate'] = df_tot_entrate.iloc[0] if not df_tot_entrate.empty else pd.Series(dtype=object)
-        
-        df_tot_uscite = extract_specific_rows(df_raw, ['TOTALE USCITE'], 'Totale')
-        tables['total_uscite'] = df_tot_uscite.iloc[0] if not df_tot_uscite.empty else pd.Series(dtype=object)
-        
-        tables['macro_uscite'] = extract_specific_rows(df_raw, config['Macro USCITE'])
-        tables['micro_uscite'] = extract_specific_rows(df_raw, config['Micro USCITE'])
-        tables['micro_entrate'] = extract_specific_rows(df_raw, config['Micro ENTRATE'])
-        
-        def clean_df_or_series(data):
-            if data.empty: return data
-            def to_numeric_cleaned(series):
-                return pd.to_numeric(
-                    series.astype(str).str.replace('€', '', regex=False).str.replace('.', '', regex=False)
-                    .str.replace(',', '.', regex=False).str.strip(),
-                    errors='coerce').fillna(0)
-            if isinstance(data, pd.Series):
-                return to_numeric_cleaned(data)
-            else:
-                return data.apply(to_numeric_cleaned)
-            
-        for name, data in tables.items():
-            tables[name] = clean_df_or_series(data)
+        diagnostica['ancore']['STORICO'] = int(header_row_index)
+
+        periodi_header = parse_mesi_ita(df_raw.iloc[header_row_index])
+        col_mesi = np.flatnonzero(periodi_header.notna() & ~periodi_header.duplicated())
+        diagnostica['colonne_mesi'] = len(col_mesi)
+
+        # 2. Estrai le righe 'Entrate' e 'Uscite'
+        def extract_row_data(anchor_text):
+            row_matches = colonna_b[colonna_b == anchor_text]
+            if row_matches.empty:
+                diagnostica['avvisi'].append(f"Non ho trovato la riga '{anchor_text}' nella colonna B.")
+                return vuota
+            diagnostica['ancore'][anchor_text] = int(row_matches.index[0])
+            valori = converti_importi(df_raw.iloc[row_matches.index[0], col_mesi])
+            return pd.Series(valori.to_numpy(), index=periodi_header[col_mesi]).sort_index()
+
+        entrate_storico, uscite_storico = extract_row_data("Entrate"), extract_row_data("Uscite")
+        diagnostica['tempi_ms']['elaborazione'] = (time.perf_counter() - inizio) * 1000
+        return entrate_storico, uscite_storico, diagnostica
 
-        available_years = sorted(list({int(m.split('/')[1]) for m in master_headers_mesi}), reverse=True)
-        return tables, available_years
     except Exception as e:
-        st.error(f"Errore caricamento da 'IN/OUT': {e}"); return {}, []
+        diagnostica['errore'] = f"Errore durante il caricamento del foglio 'Storico': {e}"
+        return vuota, vuota, diagnostica
+
+
+# --- VISTA AGGREGATA DEL NUCLEO FAMILIARE (più utenti collegati) ---
+MAX_UTENTI_PARALLELI = 4
+
+def utenti_collegati(username: str) -> list:
+    """
+    Utenti inclusi nella vista aggregata: l'utente stesso più quelli elencati in 'utenti_collegati' della sua voce in
+    st.secrets.database.users. L'autorizzazione la decide chi gestisce i secrets; gli utenti non configurati sono ignorati.
+    """
+    utenti = st.secrets.database.users
+    if username not in utenti: return []
+    collegati = [u for u in utenti[username].get('utenti_collegati', []) if u in utenti and u != username]
+    return [username] + list(dict.fromkeys(collegati))
+
+def _carica_dati_utente(username: str) -> dict:
+    """Holding, cubo IN/OUT e storico di un utente, con i loader in cache già esistenti (eseguito nel pool di thread)."""
+    try:
+        df = load_and_clean_data(username)
+        if df.empty: return {'errore': "nessun dato letto dal foglio 'Holding'"}
+        config, _ = carica_configurazione_da_foglio(username)
+        cubo = load_cash_flow_data(username, config) if config else {}
+        entrate, uscite, _ = load_historical_totals(username)
+        return {'portafoglio': df, 'cubo': unisci_storico_al_cubo(cubo, entrate, uscite)}
+    except Exception as e:
+        return {'errore': str(e)}
+
+def carica_nucleo(utenti) -> dict:
+    """
+    Portafoglio e cash flow combinati degli utenti indicati, letti in parallelo e messi in cache insieme.
+    Le versioni dei dataset di ogni utente fanno parte della chiave: 'Aggiorna Dati' di uno invalida anche l'aggregato.
+    Restituisce 'portafoglio' (transazioni con la colonna 'Utente'), 'cubo', 'utenti' caricati ed 'errori' per utente.
+    """
+    utenti = tuple(utenti)
+    versioni = tuple(tuple(_richiedi_dataset(dataset, u) for dataset in ('Holding', 'appconfig', 'IN/OUT', 'Storico')) for u in utenti)
+    return _carica_nucleo(utenti, versioni)
 
-# --- NUOVA FUNZIONE PER LEGGERE IL FOGLIO 'Storico' ---
 @st.cache_data(ttl=600)
-def load_historical_totals(username: str):
+def _carica_nucleo(utenti: tuple, versioni: tuple):
+    with ThreadPoolExecutor(max_workers=min(MAX_UTENTI_PARALLELI, len(utenti))) as pool:
+        risultati = dict(zip(utenti, pool.map(_carica_dati_utente, utenti)))
+    errori = {u: r['errore'] for u, r in risultati.items() if 'errore' in r}
+    caricati = {u: r for u, r in risultati.items() if 'errore' not in r}
+    if not caricati:
+        return {'portafoglio': pd.DataFrame(), 'cubo': {}, 'utenti': [], 'errori': errori}
+
+    # Un unico portafoglio: i ticker in comune condividono un solo download dei prezzi nelle valutazioni successive
+    portafoglio = pd.concat([r['portafoglio'].assign(Utente=u) for u, r in caricati.items()], ignore_index=True)
+
+    # Cubi sommati mese per mese; 'Complessivo' = max(dettaglio, storico) per utente, come nella Dashboard Cash Flow
+    mensili = []
+    for r in caricati.values():
+        mensile = r['cubo'].get('mensile', pd.DataFrame())
+        if mensile.empty: continue
+        complessivo = entrate_uscite_complessive(mensile)
+        complessivo.columns = pd.MultiIndex.from_product([['Complessivo'], complessivo.columns])
+        mensili.append(pd.concat([mensile, complessivo], axis=1))
+    cubo = completa_cubo_cash_flow(pd.concat(mensili).fillna(0.0)) if mensili else {}
+    return {'portafoglio': portafoglio, 'cubo': cubo, 'utenti': list(caricati), 'errori': errori}
+
+# --- SCRITTURA DEI MOVIMENTI NEI FOGLI MENSILI (una lettura e un batch_update per mese) ---
+CAMPI_MOVIMENTO_CASH_FLOW = ('Conto', 'Tipo', 'Voce', 'Importo', 'Data', 'Macro', 'Micro')
+
+def nome_foglio_mese(data) -> str:
+    """Nome del foglio mensile dei movimenti ('GEN', 'FEB', ...), indipendente dal locale del server."""
+    return MESI_ITA[pd.Timestamp(data).month - 1]
+
+def individua_sezione_cash_flow(valori: list, tipo_sezione: str):
     """
-    Legge il foglio 'Storico' con stampe di debug dettagliate.
+    Nella griglia del foglio mensile (get_all_values) trova la sezione 'USCITE' o 'ENTRATE': la cella con il nome
+    della sezione, la prima riga di intestazioni sottostante che contiene 'Voce' e le colonne dei campi alla sua destra.
+    Restituisce (colonne, prima_riga_libera) con indici 1-based di gspread, oppure (None, None) se non trovata.
     """
-    with st.expander("🔍 Debug: Caricamento Dati da Foglio 'Storico'"):
-        try:
-            st.write("--- **Inizio `load_historical_totals`** ---")
-            
-            user_config = st.secrets.database.users[username]
-            user_creds = st.secrets.google_credentials[username]
-            google_sheet_name = user_config.sheet_name
-            
-            client = get_gspread_client_for_user(user_creds)
-            if client is None: 
-                st.error("Debug: Connessione a Google fallita.")
-                return pd.Series(dtype=float), pd.Series(dtype=float)
-
-            st.write(f"✅ Connesso. Apro il foglio: **{google_sheet_name}**, worksheet: **Storico**")
-
-            sheet = client.open(google_sheet_name).worksheet("Storico")
-            all_values = sheet.get_all_values()
-            df_raw = pd.DataFrame(all_values)
-
-            st.write("✅ Foglio 'Storico' letto. **DataFrame grezzo (prime 20 righe):**")
-
-            st.dataframe(df_raw.head(20))
-
-            # DEBUG: Ispezioniamo la colonna B (indice 1)
-            colonna_b_raw = df_raw.iloc[:, 1]
-            st.write("**Contenuto della Colonna B (indice 1) dove cerco le parole chiave:**")
-            st.dataframe(colonna_b_raw.str.strip().to_frame(name="Valori in Colonna B (puliti)"))
-
-            # 1. Trova l'header dei mesi
-            st.write("Cerco la parola 'STORICO'...")
-            header_row_matches = colonna_b_raw[colonna_b_raw.str.strip() == 'STORICO']
-            st.write(f"Risultati trovati per 'STORICO': `{len(header_row_matches)}`")
-            if header_row_matches.empty:
-                st.error("ERRORE CRITICO: Non ho trovato la parola 'STORICO' nella colonna B.")
-                return pd.Series(dtype=float), pd.Series(dtype=float)
-            header_row_index = header_row_matches.index[0]
-            
-            st.write(f"✅ Trovato 'STORICO' all'indice di riga: `{header_row_index}`")
-
-            header_row_values = df_raw.iloc[header_row_index].tolist()
-            master_headers_mesi = [h for h in header_row_values if isinstance(h, str) and '/' in h]
-            header_to_col_index = {h: i for i, h in enumerate(header_row_values) if h in master_headers_mesi}
-            st.write("✅ Header mesi identificati:", master_headers_mesi)
-            
-            # 2. Estrai le righe 'Entrate' e 'Uscite'
-            def extract_row_data(anchor_text):
-                st.write(f"Cerco la parola '{anchor_text}'...")
-                row_matches = df_raw[df_raw.iloc[:, 1].str.strip() == anchor_text]
-                st.write(f"Risultati trovati per '{anchor_text}': `{len(row_matches)}`")
-                if row_matches.empty:
-                    st.warning(f"Non ho trovato la riga '{anchor_text}' nella colonna B.")
-                    return pd.Series(dtype=object)
-                
-                row = row_matches.iloc[0].tolist()
-                data = {mese: row[idx] for mese, idx in header_to_col_index.items()}
-                return pd.Series(data)
-
-            entrate_storico_raw = extract_row_data("Entrate")
-            uscite_storico_raw = extract_row_data("Uscite")
-
-            st.write("✅ Dati grezzi estratti per Entrate e Uscite.")
-
-            def clean_series(series):
-                return pd.to_numeric(
-                    series.astype(str).str.replace('€', '', regex=False).str.replace('.', '', regex=False)
-                    .str.replace(',', '.', regex=False).str.strip(),
-                    errors='coerce').fillna(0)
-
-            st.success("✅ Funzione `load_historical_totals` completata con successo.")
-            return clean_series(entrate_storico_raw), clean_series(uscite_storico_raw)
-
-        except Exception as e:
-            st.error(f"❌ Errore grave durante l'esecuzione di `load_historical_totals`: {e}")
-            st.exception(e)
-            return pd.Series(dtype=float), pd.Series(dtype=float)
-
-
-
-#
+    griglia = pd.DataFrame(valori).fillna('').astype(str).apply(lambda col: col.str.strip())
+    if griglia.empty: return None, None
+    righe_sezione, colonne_sezione = np.nonzero((griglia == tipo_sezione).to_numpy())
+    if not len(righe_sezione): return None, None
+    riga_sezione, colonna_sezione = righe_sezione[0], colonne_sezione[0]
+    sotto = griglia.iloc[riga_sezione:, colonna_sezione:]
+    righe_intestazioni = np.flatnonzero((sotto == 'Voce').any(axis=1).to_numpy())
+    if not len(righe_intestazioni): return None, None
+    riga_intestazioni = riga_sezione + righe_intestazioni[0]
+    intestazioni = griglia.iloc[riga_intestazioni, colonna_sezione:]
+    colonne = {}
+    for posizione, valore in intestazioni.items():
+        if valore in CAMPI_MOVIMENTO_CASH_FLOW and valore not in colonne: colonne[valore] = posizione
+    # Prima riga sotto le intestazioni con tutti i campi della sezione vuoti
+    corpo = griglia.iloc[riga_intestazioni + 1:, list(colonne.values())]
+    vuote = np.flatnonzero((corpo == '').all(axis=1).to_numpy())
+    prima_riga_libera = riga_intestazioni + 1 + (vuote[0] if len(vuote) else len(corpo))
+    return {campo: colonna + 1 for campo, colonna in colonne.items()}, prima_riga_libera + 1
+
+def salva_operazioni_cash_flow(username: str, mese: str, righe_per_sezione: dict) -> int:
+    """
+    Scrive nel foglio del mese i movimenti ({'USCITE': [dict, ...], 'ENTRATE': [...]}, dizionari campo -> valore)
+    in coda alle rispettive sezioni: una lettura del foglio e un unico batch_update con un intervallo per colonna.
+    Restituisce il numero di movimenti scritti.
+    """
+    righe_per_sezione = {sezione: righe for sezione, righe in righe_per_sezione.items() if righe}
+    if not righe_per_sezione: return 0
+    from gspread.utils import rowcol_to_a1
+    user_config = st.secrets.database.users[username]
+    client = get_gspread_client_for_user(st.secrets.google_credentials[username])
+    if client is None: raise Exception("Impossibile connettersi a Google Sheets.")
+    def chiama(funzione): return esegui_chiamata_sheets(username, funzione, scrittura=True)
+    foglio = chiama(lambda: client.open(user_config.sheet_name))
+    sheet = chiama(lambda: foglio.worksheet(mese))
+    valori = chiama(lambda: sheet.get_all_values())
+    intervalli, ultima_riga, scritte = [], 0, 0
+    for sezione, righe in righe_per_sezione.items():
+        colonne, prima_riga = individua_sezione_cash_flow(valori, sezione)
+        if not colonne: raise ValueError(f"Sezione '{sezione}' non trovata nel foglio '{mese}'.")
+        for campo, colonna in colonne.items():
+            inizio, fine = rowcol_to_a1(prima_riga, colonna), rowcol_to_a1(prima_riga + len(righe) - 1, colonna)
+            intervalli.append({'range': f"{inizio}:{fine}", 'values': [[riga.get(campo, '')] for riga in righe]})
+        ultima_riga, scritte = max(ultima_riga, prima_riga + len(righe) - 1), scritte + len(righe)
+    if ultima_riga > sheet.row_count:
+        chiama(lambda: sheet.add_rows(ultima_riga - sheet.row_count))
+    chiama(lambda: sheet.batch_update(intervalli, value_input_option='USER_ENTERED'))
+    return scritte
+
 def trova_prossima_riga_vuota_cash_flow(sheet, tipo_sezione):
-    # ...
-    pass
+    """Prima riga libera (1-based) della sezione nel foglio mensile, o None se la sezione non c'è."""
+    return individua_sezione_cash_flow(sheet.get_all_values(), tipo_sezione)[1]
+
 def salva_operazione_cash_flow(username, mese, data_to_write, tipo_sezione):
-    # ...
-    pass
\ No newline at end of file
+    """Singolo movimento dai form: stessa scrittura dell'importazione, con una sola riga."""
+    try:
+        scritte = salva_operazioni_cash_flow(username, mese, {tipo_sezione: [data_to_write]})
+    except Exception as e:
+        st.error(f"Errore durante il salvataggio: {e}"); return False
+    if scritte: invalida_cache_utente(username, ['IN/OUT'])
+    return bool(scritte)
+
+# --- IMPORTAZIONE DEGLI ESTRATTI CONTO BANCARI E CATEGORIZZAZIONE AUTOMATICA ---
+COLONNE_CSV_BANCA = {
+    'Data': ['data', 'date', 'data operazione', 'data contabile', 'data valuta', 'booking date', 'datum', 'buchungstag'],
+    'Voce': ['descrizione', 'description', 'causale', 'voce', 'dettagli', 'merchant', 'payee', 'beneficiario', 'verwendungszweck'],
+    'Importo': ['importo', 'amount', 'importo (eur)', 'betrag'],
+    'Uscite': ['dare', 'addebiti', 'uscite', 'debit', 'soll'],
+    'Entrate': ['avere', 'accrediti', 'entrate', 'credit', 'haben'],
+}
+PERCORSO_CATEGORIE_VOCI = os.path.join(os.path.dirname(PERCORSO_REGISTRO_SIMBOLI), 'categorie_voci.json')
+_LOCK_CATEGORIE_VOCI = threading.Lock()
+
+@st.cache_resource
+def _categorie_voci() -> dict:
+    """Scelte manuali passate, condivise tra sessioni e salvate su disco: utente -> 'SEZIONE|voce normalizzata' -> [Macro, Micro]."""
+    try:
+        with open(PERCORSO_CATEGORIE_VOCI, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def salva_categorie_voci():
+    """Scrive le scelte manuali su disco (scrittura atomica, un thread alla volta)."""
+    with _LOCK_CATEGORIE_VOCI:
+        try:
+            os.makedirs(os.path.dirname(PERCORSO_CATEGORIE_VOCI), exist_ok=True)
+            percorso_tmp = f"{PERCORSO_CATEGORIE_VOCI}.tmp"
+            with open(percorso_tmp, 'w', encoding='utf-8') as f:
+                json.dump(_categorie_voci(), f)
+            os.replace(percorso_tmp, PERCORSO_CATEGORIE_VOCI)
+        except OSError:
+            pass  # come il registro dei simboli: senza disco scrivibile si ricorda solo in memoria
+
+def normalizza_voci(voci: pd.Series) -> pd.Series:
+    """Descrizioni confrontabili: minuscole, senza cifre (date, numeri di carta/riferimento) né punteggiatura."""
+    return (voci.fillna('').astype(str).str.casefold()
+            .str.replace(r'[\d\W_]+', ' ', regex=True).str.split().str.join(' '))
+
+def regole_categorie(config: dict, df_config: pd.DataFrame) -> list:
+    """
+    Regole (regex compilata, sezione, Macro, Micro) in ordine di priorità:
+    1. quelle dell'utente in 'appconfig' (colonne 'Parola Chiave' e 'Categoria', con 'Macro' opzionale; regex ammesse);
+    2. i nomi stessi delle categorie Micro, come parole intere.
+    """
+    macro_per_micro = config.get("Macro per Micro", {})
+    def regola(regex, micro, macro=''):
+        if micro in config.get("Micro ENTRATE", []):
+            return regex, 'ENTRATE', macro or (config["Macro ENTRATE"][0] if config.get("Macro ENTRATE") else ''), micro
+        return regex, 'USCITE', macro or macro_per_micro.get(micro, micro if micro in config.get("Macro USCITE", []) else ''), micro
+    regole = []
+    if df_config is not None and {"Parola Chiave", "Categoria"} <= set(df_config.columns):
+        utente = df_config.reindex(columns=["Parola Chiave", "Categoria", "Macro"]).fillna('').astype(str).apply(lambda col: col.str.strip())
+        for chiave, micro, macro in utente[(utente["Parola Chiave"] != '') & (utente["Categoria"] != '')].itertuples(index=False):
+            try:
+                regex = re.compile(chiave, re.IGNORECASE)
+            except re.error:
+                regex = re.compile(re.escape(chiave), re.IGNORECASE)  # testo semplice se non è una regex valida
+            regole.append(regola(regex, micro, macro))
+    for micro in list(config.get("Micro USCITE", [])) + list(config.get("Micro ENTRATE", [])):
+        regole.append(regola(re.compile(rf"\b{re.escape(micro)}\b", re.IGNORECASE), micro))
+    return regole
+
+def categorizza_movimenti(voci: pd.Series, sezioni: pd.Series, regole: list, memoria: dict = None) -> pd.DataFrame:
+    """
+    'Macro', 'Micro' e 'Origine' ('Memoria', 'Regola' o '') per ogni movimento. Le scelte manuali ricordate per la stessa
+    voce normalizzata hanno la precedenza; poi vince la prima regola della sezione che corrisponde (np.select sulle regole).
+    """
+    categorie = pd.DataFrame({'Macro': '', 'Micro': '', 'Origine': ''}, index=voci.index)
+    if regole:
+        testo = voci.fillna('').astype(str)
+        condizioni = [testo.str.contains(regex, regex=True) & (sezioni == sezione) for regex, sezione, _, _ in regole]
+        categorie['Macro'] = np.select(condizioni, [macro for _, _, macro, _ in regole], default='')
+        categorie['Micro'] = np.select(condizioni, [micro for _, _, _, micro in regole], default='')
+        categorie.loc[np.logical_or.reduce(condizioni), 'Origine'] = 'Regola'
+    if memoria:
+        ricordate = (sezioni + '|' + normalizza_voci(voci)).map(memoria).dropna()
+        categorie.loc[ricordate.index, 'Macro'] = ricordate.str[0]
+        categorie.loc[ricordate.index, 'Micro'] = ricordate.str[1]
+        categorie.loc[ricordate.index, 'Origine'] = 'Memoria'
+    return categorie
+
+def memoria_categorie(username: str) -> dict:
+    """Scelte manuali ricordate per l'utente."""
+    return _categorie_voci().get(username, {})
+
+def ricorda_categorie(username: str, movimenti: pd.DataFrame):
+    """Memorizza Macro/Micro scelte a mano per le voci dei movimenti (colonne 'Voce', 'Sezione', 'Macro', 'Micro')."""
+    if movimenti.empty: return
+    chiavi = movimenti['Sezione'] + '|' + normalizza_voci(movimenti['Voce'])
+    memoria = _categorie_voci().setdefault(username, {})
+    memoria.update({chiave: [macro, micro] for chiave, macro, micro in zip(chiavi, movimenti['Macro'], movimenti['Micro']) if chiave.split('|', 1)[1]})
+    salva_categorie_voci()
+
+def normalizza_estratto_banca(df_csv: pd.DataFrame, colonne: dict) -> pd.DataFrame:
+    """
+    Movimenti del CSV bancario con 'Data', 'Voce', 'Importo' (positivo) e 'Sezione' ('USCITE' o 'ENTRATE').
+    Il segno viene da 'Importo' oppure dalle colonne separate Dare/Avere.
+    """
+    zero = pd.Series(0.0, index=df_csv.index)
+    colonna = lambda campo: df_csv[colonne[campo]] if colonne.get(campo) else pd.Series(np.nan, index=df_csv.index)
+    if colonne.get('Importo'):
+        importo = converti_numeri_testo(colonna('Importo'))
+    else:
+        importo = converti_numeri_testo(colonna('Entrate')).abs().fillna(zero) - converti_numeri_testo(colonna('Uscite')).abs().fillna(zero)
+    movimenti = pd.DataFrame({
+        'Data': pd.to_datetime(colonna('Data').astype(str).str.strip().str[:10], dayfirst=True, errors='coerce', format='mixed').dt.normalize(),
+        'Voce': colonna('Voce').fillna('').astype(str).str.split().str.join(' '),
+        'Importo': importo.abs(),
+        'Sezione': np.where(importo < 0, 'USCITE', 'ENTRATE'),
+    })
+    return movimenti[movimenti['Data'].notna() & (movimenti['Importo'] > 0)].reset_index(drop=True)
+
+def righe_cash_flow_da_movimenti(movimenti: pd.DataFrame, conto: str, tipo: str) -> dict:
+    """{foglio del mese: {sezione: [dizionari campo -> valore]}} come quelli dei form Uscita/Entrata."""
+    righe = {}
+    for mese, sezione, data, voce, importo, macro, micro in zip(
+            movimenti['Data'].map(nome_foglio_mese), movimenti['Sezione'], movimenti['Data'], movimenti['Voce'],
+            movimenti['Importo'], movimenti['Macro'], movimenti['Micro']):
+        righe.setdefault(mese, {}).setdefault(sezione, []).append({
+            "Conto": conto, "Tipo": tipo if sezione == 'USCITE' else "N/A", "Voce": voce,
+            "Importo": f"€ {importo:.2f}".replace('.', ','), "Data": data.strftime('%d/%m/%Y'), "Macro": macro, "Micro": micro})
+    return righe
\ No newline at end of file